@@ -0,0 +1,25 @@
+import json
+from pathlib import Path
+
+from OrderBook.benchmark import *
+
+
+def test_every_benchmark_runs_at_a_constant_depth(tmp_path, monkeypatch):
+    # the benchmarks copy the database of the folder they are run from
+    monkeypatch.chdir(Path(__file__).resolve().parent.parent)
+    results = in_database_copy(run, list(BENCHMARKS), [100], [1, 3], 20)
+
+    assert [(r.name, r.clients) for r in results] == [
+        (name, clients) for name in BENCHMARKS for clients in (1, 3)
+    ]
+    assert all(r.samples == 20 and r.p50 <= r.p99 <= r.p999 for r in results)
+    book = OrderBook.get_book_by_ticker(TICKER)
+    assert len(book.bids) + len(book.asks) == 100  # refilled after every sample
+
+    save(results, tmp_path / "baseline.json")
+    baseline = json.loads((tmp_path / "baseline.json").read_text())
+    assert regressions(results, baseline, tolerance=0) == []
+
+    baseline[results[0].key]["p99"] = results[0].p99 / 2
+    (found,) = regressions(results, baseline, tolerance=0.5)
+    assert found.startswith(f"{results[0].key}: p99")
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+import pytest
+from OrderBook.OrderBook import *
+from OrderBook.engine import MatchingEngine
+
+
+@pytest.fixture
+def engine():
+    engine = MatchingEngine()
+    engine.start()
+    yield engine
+    engine.stop()
+
+
+def test_commands_run_in_order_on_the_engine_thread(engine):
+    threads, results = [], []
+    for i in range(100):
+        future = engine.submit(
+            lambda i=i: threads.append(threading.current_thread()) or i
+        )
+        results.append(future)
+
+    assert [future.result(timeout=1) for future in results] == list(range(100))
+    assert set(threads) == {engine._thread}
+
+
+def test_exceptions_are_returned_through_the_future(engine):
+    future = engine.submit(OrderBook.get_book_by_ticker, "NOT_A_TICKER")
+    with pytest.raises(KeyError):
+        future.result(timeout=1)
+    assert engine.submit(len, "still running").result(timeout=1) == 13
+
+
+def test_stop_runs_pending_commands():
+    engine = MatchingEngine()
+    engine.start()
+    futures = [engine.submit(pow, 2, i) for i in range(10)]
+    engine.stop()
+
+    assert all(future.done() for future in futures)
+    with pytest.raises(RuntimeError):
+        engine.submit(pow, 2, 10)
+
+
+def test_orders_through_the_engine():
+    async def trade():
+        engine = MatchingEngine()
+        engine.start()
+        book = OrderBook("AAPL")
+        name = f"engine_{id(engine)}"
+        buyer = Client(name, "pw", f"{name}@test.com", "En", "Gine", 1_000_000)
+        seller = Client(
+            f"{name}_s", "pw", f"{name}_s@test.com", "En", "Gine", 0, {"AAPL": 10}
+        )
+
+        loop_thread = threading.current_thread()
+        deltas = []
+        book.add_listener(
+            engine.on_loop(
+                lambda delta: deltas.append((threading.current_thread(), delta))
+            )
+        )
+
+        await engine.run(OrderBook.place_order, "AAPL", SELL, 100, 10, seller)
+        await engine.run(OrderBook.place_order, "AAPL", BUY, 100, 4, buyer)
+        best = await engine.run(OrderBook.get_best, "AAPL")
+        await asyncio.sleep(0)  # let the listeners called back run
+        engine.stop()
+        return loop_thread, best, buyer, deltas
+
+    loop_thread, best, buyer, deltas = asyncio.run(trade())
+
+    assert best == (0, 100)
+    assert buyer.portfolio == {"AAPL": 4}
+    assert [delta["sequence"] for _, delta in deltas] == [1, 2]
+    assert {thread for thread, _ in deltas} == {loop_thread}
@@ -0,0 +1,77 @@
+import itertools
+import os
+from collections import OrderedDict
+from contextlib import redirect_stdout
+
+import numpy as np
+import pytest
+from OrderBook.testGenerator import *
+
+
+def test_flow_is_streamed_in_chunks_and_seeded():
+    flow = OrderFlow(tickers=200, chunk_size=10_000, seed=7)
+    chunks = list(flow.chunks(25_000))
+    assert [len(chunk) for chunk in chunks] == [10_000, 10_000, 5_000]
+    assert all(chunk.dtype == EVENT_DTYPE for chunk in chunks)
+
+    events = np.concatenate(chunks)
+    assert np.all(np.diff(events["time"]) > 0)
+    again = OrderFlow(tickers=200, chunk_size=10_000, seed=7).chunks(25_000)
+    assert np.array_equal(events, np.concatenate(list(again)))
+
+    # a flow of millions of events is only computed as it is read
+    huge = OrderFlow(seed=7).events(10**9)
+    assert [event.index for event in itertools.islice(huge, 3)] == [0, 1, 2]
+
+
+def test_flow_shape():
+    flow = OrderFlow(
+        tickers=50, rate=500, market_share=0.1, cancel_share=0.3, depth_ticks=10, seed=1
+    )
+    events = np.concatenate(list(flow.chunks(200_000)))
+    kinds = np.bincount(events["kind"], minlength=3) / len(events)
+    assert kinds == pytest.approx([0.6, 0.1, 0.3], abs=0.01)
+    assert np.mean(np.diff(events["time"])) == pytest.approx(1 / 500, rel=0.02)
+
+    # the most popular tickers get the most events
+    per_ticker = np.bincount(events["ticker"], minlength=50)
+    assert per_ticker[0] > per_ticker[1] > per_ticker[10] > 0
+
+    assert flow.mid("T0000") != 50  # the mids have moved from their opening prices
+
+    # limit orders rest around the mid, on their side of it unless they cross it
+    still = OrderFlow(tickers=1, volatility=0, depth_ticks=10, cross_share=0.05, seed=1)
+    limits = np.concatenate(list(still.chunks(100_000)))
+    limits = limits[limits["kind"] == 0]
+    ticks = np.rint(limits["price"] * TICKS_PER_UNIT) - 50 * TICKS_PER_UNIT
+    away = -ticks * limits["side"]  # ticks away from the mid, on the side of the order
+    assert np.mean(away < 0) == pytest.approx(0.05, abs=0.01)
+    assert np.mean(np.abs(away)) == pytest.approx(9.5, abs=0.3)  # rounded down
+    assert np.all(events["volume"][events["kind"] != 2] >= 1)
+
+    # cancels are for earlier limit orders of the same ticker
+    cancels = events[(events["kind"] == 2) & (events["target"] >= 0)]
+    targets = events[cancels["target"]]
+    assert np.all(targets["kind"] == 0)
+    assert np.array_equal(targets["ticker"], cancels["ticker"])
+    cancelled = np.flatnonzero(events["kind"] == 2)[
+        events["target"][events["kind"] == 2] >= 0
+    ]
+    assert np.all(cancels["target"] < cancelled)
+
+
+def test_flow_replays_in_the_order_books(monkeypatch):
+    # keep the orders left resting out of the registries the other tests share
+    monkeypatch.setattr(Order, "_live", {})
+    monkeypatch.setattr(Order, "_archive", OrderedDict())
+    flow = OrderFlow(tickers=["AAPL", "GOOG"], clients=5, seed=3)
+    clients = generateFlowClients(flow)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        outcomes = replayFlow(flow, 2_000, clients)
+        Transaction.journal.flush()
+
+    assert sum(outcomes.values()) == 2_000
+    assert outcomes["limit"] > outcomes["cancel"] > outcomes["market"] > 0
+    assert outcomes["rejected"] == 0
+    book = OrderBook.get_book_by_ticker("AAPL")
+    assert book.bids.best_price() < book.asks.best_price()
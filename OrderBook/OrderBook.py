@@ -1,10 +1,24 @@
+import itertools
+import math
+import time
 from enum import Enum
-from typing import Self
+from typing import Callable, Iterator, NamedTuple, Self
 
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-from sortedcontainers import SortedList
+import numpy as np
+from sortedcontainers import SortedDict, SortedKeyList
 from database import Database
-from .tickers import OPENING_PRICES
+from journal import Fill, FillJournal
+from .tickers import OPENING_PRICES, TICKS_PER_UNIT
+from .trades import (
+    COLUMNS,
+    TradeRecord,
+    TradeStore,
+    from_nanoseconds,
+    to_nanoseconds,
+)
 
 
 class BuyOrSell(Enum):
@@ -31,10 +45,72 @@ MARKET = OrderType.MARKET
 LIMIT = OrderType.LIMIT
 
 
+class SelfTradePrevention(Enum):
+    """What happens when an order would trade with a resting order of the same client."""
+
+    CANCEL_NEWEST = "cancel_newest"  # the incoming order is cancelled
+    CANCEL_OLDEST = "cancel_oldest"  # the resting order is cancelled, matching goes on
+    SKIP = "skip"  # the resting order is left in the book, and matching walks past it
+
+
+def to_ticks(price: float) -> int:
+    """Returns a price as a whole number of ticks, rounded to the nearest tick."""
+    return round(price * TICKS_PER_UNIT)
+
+
+def from_ticks(ticks: int) -> float:
+    return ticks / TICKS_PER_UNIT
+
+
+def cash_ticks(cash: float) -> int:
+    """Returns an amount of cash as a whole number of ticks, rounded down so as not to exceed it."""
+    return math.floor(cash * TICKS_PER_UNIT + 1e-9)
+
+
+class FundingIndex:
+    """
+    The resting orders of a client, indexed by what funds them: bids highest price first,
+    and asks by ticker. Should the funds of the client drop below what its orders reserve,
+    e.g. when a shard learns of cash spent in another one, the orders to cancel are found
+    without looking at the others.
+    """
+
+    def __init__(self):
+        self._bids = SortedKeyList(key=lambda order: -order.ticks)
+        self._asks: dict[str, dict[int, "Order"]] = {}  # ticker -> order_id -> order
+
+    def __len__(self) -> int:
+        return len(self._bids) + sum(len(asks) for asks in self._asks.values())
+
+    def add(self, order: "Order"):
+        if order.side == BUY:
+            self._bids.add(order)
+        else:
+            self._asks.setdefault(order.ticker, {})[order.order_id] = order
+
+    def remove(self, order: "Order"):
+        if order.side == BUY:
+            self._bids.discard(order)
+            return
+        asks = self._asks.get(order.ticker)
+        if asks is not None:
+            asks.pop(order.order_id, None)
+            if not asks:
+                del self._asks[order.ticker]
+
+    def highest_bid(self) -> "Order | None":
+        return self._bids[0] if self._bids else None
+
+    def newest_ask(self, ticker: str) -> "Order | None":
+        asks = self._asks.get(ticker)
+        return next(reversed(asks.values())) if asks else None
+
+
 class Client:
     counter = 0
     _all_clients: list[Self] = []
-    _usernames = set[str]()
+    _clients_by_username: dict[str, Self] = {}
+    _clients_by_email: dict[str, Self] = {}
 
     def __init__(
         self,
@@ -45,17 +121,20 @@ class Client:
         last_name: str,
         balance: float = 0,
         portfolio: dict[str, float] = None,
+        db_id: int = None,
     ):
+        if username in Client._clients_by_username:
+            raise ValueError(f"Username {username} is not available")
+
         self.client_id = Client.counter
         Client.counter += 1
         Client._all_clients += [self]
-        if username in Client._usernames:
-            raise ValueError(f"Username {username} is not available")
 
         self.username = username
-        Client._usernames.add(username)
+        Client._clients_by_username[username] = self
         self.password = password
         self.email = email
+        Client._clients_by_email.setdefault(email, self)
         self.first_names = first_names
         self.last_name = last_name
 
@@ -63,6 +142,19 @@ class Client:
         self.portfolio = portfolio if portfolio is not None else {}
         self._daily_portfolio_value = OrderBook.portfolio_value(self)
 
+        # client_id of the client in the database, looked up by email the first time it is needed if not given
+        self.db_id = db_id
+
+        # functions called with the client when its balance or portfolio changes
+        self._listeners: list[Callable[[Self], None]] = []
+
+        # cash and shares set aside for the open limit orders of the client, so that the
+        # same funds never back two orders; cash is counted in ticks so that it adds up exactly
+        self.reserved_cash = 0
+        self.reserved_shares: dict[str, int] = {}  # ticker -> shares
+        # resting orders of the client, should its reservations have to be cut back
+        self.funding = FundingIndex()
+
     def __str__(self):
         return f"{self.first_names} {self.last_name} ({self.username})"
 
@@ -75,17 +167,11 @@ class Client:
 
     @classmethod
     def get_client_by_username(cls, username: str) -> Self:
-        for client in cls._all_clients:
-            if client.username == username:
-                return client
-        return None
+        return cls._clients_by_username.get(username)
 
     @classmethod
     def get_client_by_email(cls, email: str) -> Self:
-        for client in cls._all_clients:
-            if client.email == email:
-                return client
-        return None
+        return cls._clients_by_email.get(email)
 
     @classmethod
     def resolve(cls, client_info) -> Self:
@@ -108,6 +194,47 @@ class Client:
     def get_id(self) -> int:
         return self.client_id
 
+    def get_db_id(self) -> int:
+        """Returns the id of the client in the database, or -1 if the client is not in it."""
+        if self.db_id is None:
+            self.db_id = Transaction.journal.database().account_from_email(self.email)[
+                0
+            ]
+        return self.db_id
+
+    def set_db_id(self, db_id: int):
+        self.db_id = db_id
+
+    def set_username(self, username: str):
+        """Renames the client, keeping the username index up to date."""
+        if username == self.username:
+            return
+        if username in Client._clients_by_username:
+            raise ValueError(f"Username {username} is not available")
+
+        del Client._clients_by_username[self.username]
+        Client._clients_by_username[username] = self
+        self.username = username
+
+    def set_email(self, email: str):
+        """Changes the client's email, keeping the email index up to date."""
+        if Client._clients_by_email.get(self.email) is self:
+            del Client._clients_by_email[self.email]
+        self.email = email
+        Client._clients_by_email.setdefault(email, self)
+
+    def add_listener(self, listener: Callable[[Self], None]):
+        """Registers a function called with the client whenever its balance or portfolio changes."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[Self], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _changed(self):
+        for listener in list(self._listeners):
+            listener(self)
+
     def get_balance(self) -> float:
         return self.balance
 
@@ -128,6 +255,7 @@ class Client:
             self.portfolio[ticker] = vol
         else:
             self.portfolio[ticker] += vol
+        self._changed()
 
     def sell_stock(self, stock_id: int, price: float, vol: int):
         # add money to balance
@@ -148,6 +276,62 @@ class Client:
             self.portfolio[ticker] -= vol
             if self.portfolio[ticker] == 0:  # if stock is no longer held
                 del self.portfolio[ticker]  # remove from portfolio
+        self._changed()
+
+    def available_cash(self) -> float:
+        """Returns the balance not reserved by open orders."""
+        return self.balance - from_ticks(self.reserved_cash)
+
+    def available_shares(self, ticker: str) -> int:
+        """Returns the shares of a stock held and not reserved by open orders."""
+        return self.portfolio.get(ticker, 0) - self.reserved_shares.get(ticker, 0)
+
+    def affordable_volume(self, ticks: int) -> int:
+        """Returns how many shares the cash not reserved buys at a price in ticks."""
+        return max(cash_ticks(self.balance) - self.reserved_cash, 0) // ticks
+
+    def reserve(self, side: BuyOrSell, ticker: str, ticks: int, volume: int):
+        """Sets aside what an order needs to be filled: cash for a bid, shares for an ask."""
+        if ticks < 1:
+            raise ValueError(f"Price must be at least {from_ticks(1)}")
+        if volume <= 0:
+            raise ValueError("Volume must be positive")
+        if side == BUY:
+            if self.affordable_volume(ticks) < volume:
+                raise ValueError(f"Buyer {self.username} has insufficient funds")
+            self.reserved_cash += ticks * volume
+        else:  # side == SELL
+            if self.available_shares(ticker) < volume:
+                raise ValueError(f"Seller {self.username} has insufficient stock")
+            self.reserved_shares[ticker] = self.reserved_shares.get(ticker, 0) + volume
+
+    def release(self, side: BuyOrSell, ticker: str, ticks: int, volume: int):
+        """Gives back what reserve set aside, once the order is filled or cancelled."""
+        if side == BUY:
+            self.reserved_cash -= ticks * volume
+        else:  # side == SELL
+            self.reserved_shares[ticker] -= volume
+            if self.reserved_shares[ticker] == 0:
+                del self.reserved_shares[ticker]
+
+    def _purge_unfunded(self):
+        """
+        Cancels resting orders until the funds of the client cover its reservations again,
+        the highest bids and the newest asks first. Trades never leave them uncovered, but
+        funds changed from outside, e.g. synchronised from another shard, may.
+        """
+        while (
+            self.reserved_cash > cash_ticks(self.balance) and self.funding.highest_bid()
+        ):
+            self._cancel(self.funding.highest_bid())
+        for ticker in list(self.reserved_shares):
+            while self.available_shares(ticker) < 0 and self.funding.newest_ask(ticker):
+                self._cancel(self.funding.newest_ask(ticker))
+
+    @staticmethod
+    def _cancel(order: "Order"):
+        book = OrderBook.get_book_by_id(order.stock_id)
+        book._remove_order(order, cancelling=True)
 
     def display_portfolio(self) -> str:
         res = f"Portfolio of {str(self)}:"
@@ -168,6 +352,7 @@ class Client:
         NOTE: Should only be called at the start of each trading day.
         """
         self._daily_portfolio_value = OrderBook.portfolio_value(self)
+        self._changed()  # the portfolio pnl is relative to this value
         return self._daily_portfolio_value
 
     @staticmethod
@@ -180,8 +365,35 @@ ClientInfo = Client | int | str
 
 
 class Order:
+    """
+    A compact order record. Prices are kept as integer numbers of ticks, and time priority is
+    given by a sequence number rather than by the time the order was made.
+    """
+
+    __slots__ = (
+        "order_id",
+        "sequence",
+        "created",
+        "stock_id",
+        "side",
+        "ticks",
+        "volume",
+        "client",
+        "terminated",
+        "type",
+        "_total_volume",
+        "transaction_ids",
+    )
+
     counter = 0
-    _all_orders: list[Self] = []
+    counter_step = 1  # processes matching in parallel interleave their ids
+    _live: dict[int, Self] = {}  # order_id -> order, only while it is open
+    # order_id -> record of a terminated order, oldest first
+    _archive: OrderedDict[int, "OrderRecord"] = OrderedDict()
+    archive_size = 100_000  # terminated orders remembered, the oldest are forgotten
+    _sequence = itertools.count()  # orders with a lower sequence number have priority
+    # called with every order terminated other than by its last fill
+    _listeners: list[Callable[[Self], None]] = []
 
     def __init__(
         self,
@@ -192,35 +404,90 @@ class Order:
         client_id: int,
         is_market_order: bool = False,
     ):
-        self.order_id = Order.counter
-        Order.counter += 1
-        Order._all_orders += [self]
-
-        self.timestamp = datetime.now(timezone.utc)
         self.stock_id = stock_id
-        self.stock: OrderBook = OrderBook.get_book_by_id(stock_id)
-        self.ticker: str = self.stock.ticker
         self.side = side
-        self.price = price
+        self.ticks = to_ticks(price)
         self.volume = volume  # this is volume left to trade
-        self.client_id = client_id
         self.client: Client = Client.get_client_by_id(client_id)
         self.terminated = False
 
         self.type = MARKET if is_market_order else LIMIT
+        if self.type == LIMIT:
+            # a limit order may rest, so what it needs is reserved until it is filled or
+            # cancelled; a market order trades at once with what is not reserved
+            self.client.reserve(side, self.ticker, self.ticks, volume)
+
+        self.order_id = Order.counter
+        Order.counter += Order.counter_step
+        Order._live[self.order_id] = self
+
+        self.sequence = next(Order._sequence)
+        self.created = time.time()  # POSIX timestamp, only used for display
 
         self._total_volume = volume  # constant keeping track of total volume
-        self.transaction_ids: list[int] = []
+        self.transaction_ids: list[int] = None  # made on the first trade
 
     def __str__(self):
         return f"Order[{self.order_id}]: {self.side,OrderBook.get_ticker_by_id(self.stock_id),self.volume} @ {self.price}"
 
     @classmethod
-    def get_order_by_id(cls, id: int) -> Self:
-        try:
-            return cls._all_orders[id]
-        except:
-            return None
+    def get_order_by_id(cls, id: int) -> "Self | OrderRecord | None":
+        """Returns an open order, the record of a terminated one, or None if it is unknown or forgotten."""
+        order = cls._live.get(id)
+        if order is None:
+            return cls._archive.get(id)
+        return order
+
+    @classmethod
+    def get_open_order(cls, id: int) -> Self | None:
+        return cls._live.get(id)
+
+    @classmethod
+    def add_listener(cls, listener: Callable[[Self], None]):
+        """Registers a function called with every order cancelled, e.g. by self-trade prevention."""
+        cls._listeners.append(listener)
+
+    @classmethod
+    def remove_listener(cls, listener: Callable[[Self], None]):
+        if listener in cls._listeners:
+            cls._listeners.remove(listener)
+
+    def _archive_order(self):
+        """Replaces a terminated order in the registry by its record."""
+        if Order._live.pop(self.order_id, None) is None:
+            return  # already archived
+        Order._archive[self.order_id] = OrderRecord(
+            self.order_id,
+            self.stock_id,
+            self.side,
+            self.price,
+            self.volume,
+            self._total_volume,
+            self.client_id,
+            self.type,
+        )
+        if len(Order._archive) > Order.archive_size:
+            Order._archive.popitem(last=False)
+
+    @property
+    def price(self) -> float:
+        return from_ticks(self.ticks)
+
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.created, timezone.utc)
+
+    @property
+    def client_id(self) -> int:
+        return self.client.client_id
+
+    @property
+    def stock(self) -> "OrderBook":
+        return OrderBook.get_book_by_id(self.stock_id)
+
+    @property
+    def ticker(self) -> str:
+        return OrderBook.get_ticker_by_id(self.stock_id)
 
     def get_id(self) -> int:
         return self.order_id
@@ -232,7 +499,7 @@ class Order:
         return self.price
 
     def set_price(self, price: float):
-        self.price = price
+        self.ticks = to_ticks(price)
 
     def get_volume(self) -> int:
         return self.volume
@@ -257,7 +524,6 @@ class Order:
         price: float,
         vol: int,
         side: BuyOrSell,
-        update_price: bool,
     ):
         """Update state to execute trade."""
         if self.volume < vol:
@@ -265,31 +531,21 @@ class Order:
                 "Order volume was exceeded"
             )  # precondition: vol <= self.volume
 
-        self.transaction_ids += [transaction_id]
+        if self.transaction_ids is None:
+            self.transaction_ids = []
+        self.transaction_ids.append(transaction_id)
         self.volume -= vol
+        if self.type == LIMIT:
+            self.client.release(side, self.ticker, self.ticks, vol)
 
-        stock = OrderBook.get_book_by_id(self.stock_id)
         if side == BUY:
             self.client.buy_stock(self.stock_id, price, vol)
-            if self.volume > 0 and self.client.get_balance() == 0:
-                stock.cancel_order(
-                    self
-                )  # cancel the order if buyer has run out of funds
         else:  # side == SELL
             self.client.sell_stock(self.stock_id, price, vol)
 
-            ticker = stock.get_ticker()
-            if self.volume > 0 and ticker not in self.client.portfolio:
-                stock.cancel_order(
-                    self.order_id
-                )  # cancel the order if seller ran out of stock
-
         if self.volume == 0:
             self.terminated = True
-
-        if update_price:
-            stock.last_price = price
-            stock.last_timestamp = datetime.now(timezone.utc)
+            self._archive_order()
 
     def get_client(self) -> Client:
         return self.client
@@ -308,56 +564,80 @@ class Order:
 
     def terminate(self) -> str:
         """Terminate an order and return a log after the termination."""
+        was_terminated = self.terminated
+        if not self.terminated and self.type == LIMIT:
+            self.client.release(self.side, self.ticker, self.ticks, self.volume)
         self.terminated = True
+        self._archive_order()
+        if not was_terminated:
+            for listener in list(Order._listeners):
+                listener(self)
 
         # log termination
         return f"Order[{self.order_id}] terminated after {self.get_executed_volume()}/{self._total_volume} shares executed"
 
     def is_executable(self) -> bool:
         """Returns whether order is executable at desired price."""
-        if self.terminated:  # order isn't executable if terminated
-            return False
-
-        if self.type == MARKET:
-            return True
-
-        if self.side == SELL:
-            ticker = OrderBook.get_ticker_by_id(self.stock_id)
-            if ticker in self.client.portfolio:
-                return self.client.portfolio[ticker] > 0
-            elif not ticker in self.client.portfolio:
-                return False
-        else:  # self.side == BUY
-            return self.client.balance // self.price > 0
+        # a limit order is funded by its reservation, and a market order is limited by
+        # executable_volume to what is not reserved
+        return not self.terminated
 
     def executable_volume(self, price=None) -> int:
         """
         Returns the maximum possible executable volume of a given order. If 0 is returned,
         then order is cancelled or has no executable volume at the price.
-
-        Precondition: If order is a sell, then ticker is in the seller's portfolio.
         """
         if self.terminated:
             return 0
 
-        price = price if price is not None else self.price
+        if self.type == LIMIT:
+            return self.volume  # what it needs is reserved
 
         if self.side == BUY:
-            max_feasible_volume = (
-                self.client.get_balance() // price
-            )  # no fractional shares
+            ticks = to_ticks(price) if price is not None else self.ticks
+            max_feasible_volume = self.client.affordable_volume(ticks)
         else:  # self.side == SELL
-            ticker = OrderBook.get_ticker_by_id(self.stock_id)
-            if ticker not in self.client.portfolio:
-                return 0
-            max_feasible_volume = self.client.portfolio[ticker]
+            max_feasible_volume = self.client.available_shares(self.ticker)
+
+        return max(min(max_feasible_volume, self.volume), 0)
+
+
+class OrderRecord(NamedTuple):
+    """What is kept of an order once it is terminated, in place of the order itself."""
 
-        return min(max_feasible_volume, self.volume)
+    order_id: int
+    stock_id: int
+    side: BuyOrSell
+    price: float
+    volume: int  # volume left untraded
+    total_volume: int
+    client_id: int
+    type: OrderType
+
+    terminated = True
+
+    @property
+    def ticker(self) -> str:
+        return OrderBook.get_ticker_by_id(self.stock_id)
+
+    def get_volume(self) -> int:
+        return self.volume
+
+    def get_executed_volume(self) -> int:
+        return self.total_volume - self.volume
+
+    def log(self) -> str:
+        return f"Order[{self.order_id}] already terminated after {self.get_executed_volume()}/{self.total_volume} shares executed"
 
 
 class Transaction:
-    _all_transactions: list[Self] = []
-    _transaction_offset = -10
+    counter: int = None  # seeded from the database when the first transaction is made
+    counter_step = 1  # processes matching in parallel interleave their ids
+    store = (
+        TradeStore()
+    )  # the most recent transactions, the older ones are in the database
+    journal = FillJournal()  # writes the transactions to the database
+    _listeners: list[Callable[[Self], None]] = []  # called with every transaction made
 
     # object as parameter, NOT IDs
     def __init__(self, bid: Order, ask: Order, vol: int):
@@ -377,33 +657,58 @@ class Transaction:
         self.asker = ask.get_client()
         self.ask_price = ask.get_price() if ask.type == LIMIT else bid.get_price()
 
-        # trade is executed at the price of the order with earlier timestamp
-        price = bid.get_price() if bid.timestamp < ask.timestamp else ask.get_price()
+        # trade is executed at the price of the order with time priority
+        price = bid.get_price() if bid.sequence < ask.sequence else ask.get_price()
         self.price = price
         self.vol = vol
         self.stock_id = stock_id
+        self.bid_order_id = bid.order_id
+        self.ask_order_id = ask.order_id
+
+        # Ids are assigned here rather than by the database, so matching never waits for a write
+        if Transaction.counter is None:
+            Transaction.counter = (
+                Transaction.journal.database().last_transaction_id() + 1
+            )
+        self.transaction_id = Transaction.counter
+        Transaction.counter += Transaction.counter_step
 
         # Add transaction to the database
-        bidder_db_id = Database().account_from_email(self.bidder.email)[0]
-        asker_db_id = Database().account_from_email(self.asker.email)[0]
-        self.transaction_id = Database().create_transaction(
-            bidder_db_id,
-            self.bid_price,
-            asker_db_id,
-            self.ask_price,
-            self.vol,
-            bid.get_ticker(),
+        bidder_id, asker_id = self.bidder.get_db_id(), self.asker.get_db_id()
+        Transaction.journal.append(
+            Fill(
+                bidder_id,
+                self.bid_price,
+                asker_id,
+                self.ask_price,
+                self.vol,
+                bid.get_ticker(),
+                price,
+                self.transaction_id,
+                self.timestamp.astimezone().strftime("%Y-%m-%d %H:%M:%S.%f"),
+            )
+        )
+        Transaction.store.append(
+            self.transaction_id,
+            self.timestamp,
             price,
+            vol,
+            stock_id,
+            bidder_id,
+            asker_id,
         )
-        # If first transaction in the system
-        if Transaction._all_transactions == []:
-            Transaction._transaction_offset = self.transaction_id
-        Transaction._all_transactions += [self]
 
         # update the state of the orders to reflect the transaction
-        update_price = self.bidder != self.asker
-        bid.execute_trade(self.transaction_id, price, vol, BUY, update_price)
-        ask.execute_trade(self.transaction_id, price, vol, SELL, update_price)
+        bid.execute_trade(self.transaction_id, price, vol, BUY)
+        ask.execute_trade(self.transaction_id, price, vol, SELL)
+        self.bid_volume_left, self.ask_volume_left = bid.volume, ask.volume
+
+        # a client trading with themselves does not move the price
+        if self.bidder != self.asker:
+            stock._record_price(price, self.timestamp)
+        stock._trades.append(self)  # printed on the market data feed
+        for listener in list(Transaction._listeners):
+            listener(self)
 
         # log transaction
         print(self)
@@ -415,20 +720,99 @@ class Transaction:
         return self.price
 
     @classmethod
-    def get_transaction_by_id(cls, id: int) -> Self:
-        # print(id, Transaction._transaction_offset)
-        try:
-            return cls._all_transactions[id - Transaction._transaction_offset]
-        except:
-            return None
+    def add_listener(cls, listener: Callable[[Self], None]):
+        """Registers a function called with every transaction made."""
+        cls._listeners.append(listener)
+
+    @classmethod
+    def remove_listener(cls, listener: Callable[[Self], None]):
+        if listener in cls._listeners:
+            cls._listeners.remove(listener)
+
+    @classmethod
+    def get_transaction_by_id(cls, id: int) -> TradeRecord | None:
+        """Returns a transaction, from memory if it is recent enough or from the database otherwise."""
+        record = cls.store.get(id)
+        if record is None:
+            row = cls.journal.database().retrieve_transaction(id)
+            if row is not None:
+                columns = cls._columns_of_rows([row])
+                record = TradeRecord(*(columns[name][0].item() for name, _ in COLUMNS))
+                record = record._replace(timestamp=from_nanoseconds(record.timestamp))
+        return record
 
     @classmethod
     def get_all_transactions(cls) -> dict[int, tuple[datetime, float, int, int]]:
-        """Returns all transactions as a dictionary { transaction_id -> (timestamp, price, volume, stock_id) }."""
+        """Returns the transactions kept in memory as a dictionary { transaction_id -> (timestamp, price, volume, stock_id) }."""
+        columns = cls.store.columns()
         return {
-            t.transaction_id: (t.timestamp, t.price, t.vol, t.stock_id)
-            for t in cls._all_transactions
+            transaction_id: (from_nanoseconds(timestamp), price, vol, stock_id)
+            for transaction_id, timestamp, price, vol, stock_id in zip(
+                columns["transaction_id"].tolist(),
+                columns["timestamp"].tolist(),
+                columns["price"].tolist(),
+                columns["vol"].tolist(),
+                columns["stock_id"].tolist(),
+            )
+        }
+
+    @classmethod
+    def get_transactions_between(
+        cls, start: datetime = None, end: datetime = None, ticker: str = None
+    ) -> dict[str, np.ndarray]:
+        """
+        Returns the transactions made in [start, end), of one stock if a ticker is given, as
+        the columns of the trade store, oldest first. Timestamps are in nanoseconds since the
+        epoch. The transactions older than those kept in memory are read from the database.
+        """
+        stock_id = None
+        if ticker is not None:
+            stock_id = OrderBook.get_book_by_ticker(ticker).stock_id
+        recent = cls.store.between(start, end, stock_id)
+
+        kept_from = cls.store.kept_from()
+        if kept_from is not None and start is not None and start >= kept_from:
+            return recent  # nothing older is asked for
+        if kept_from is not None and (end is None or end > kept_from):
+            end = kept_from  # the rest is in memory
+
+        def time_stamp(timestamp: datetime) -> str | None:
+            if timestamp is None:
+                return None
+            return timestamp.astimezone().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+        rows = cls.journal.database().retrieve_transactions_between(
+            time_stamp(start), time_stamp(end), ticker
+        )
+        older = cls._columns_of_rows(rows)
+        # transactions made around kept_from may be both in memory and in the database
+        kept = np.isin(older["transaction_id"], cls.store.column("transaction_id"))
+        columns = {
+            name: np.concatenate((older[name][~kept], recent[name]))
+            for name, _ in COLUMNS
         }
+        order = np.lexsort((columns["transaction_id"], columns["timestamp"]))
+        return {name: column[order] for name, column in columns.items()}
+
+    @staticmethod
+    def _columns_of_rows(rows: list[tuple]) -> dict[str, np.ndarray]:
+        """Returns rows of the Transactions table as the columns of the trade store."""
+        stock_ids = {
+            ticker: book.stock_id for ticker, book in OrderBook._tickers.items()
+        }
+        values = {
+            "transaction_id": [row[0] for row in rows],
+            "timestamp": [
+                to_nanoseconds(datetime.fromisoformat(row[7]).astimezone(timezone.utc))
+                for row in rows
+            ],
+            "price": [row[8] for row in rows],
+            "vol": [row[5] for row in rows],
+            "stock_id": [stock_ids.get(row[6], -1) for row in rows],
+            "bidder_id": [row[1] for row in rows],
+            "asker_id": [row[3] for row in rows],
+        }
+        return {name: np.array(values[name], dtype) for name, dtype in COLUMNS}
 
     @classmethod
     def get_transactions_of_stock(
@@ -451,48 +835,184 @@ class Transaction:
         [7] time_stamp (str)
         [8] transaction_price (float)
         """
-        return Database().retrieve_transactions_stock(ticker)
+        return Transaction.journal.database().retrieve_transactions_stock(ticker)
 
     @staticmethod
-    def last_price_before(
-        ticker: str, timestamp: datetime = datetime.now(timezone.utc)
-    ) -> float:
-        """Returns the price of the last transaction before a given time."""
-        all = Transaction.get_transactions_of_stock(ticker)
+    def last_price_before(ticker: str, timestamp: datetime = None) -> float:
+        """Returns the price of the last transaction before a given time (now if not given)."""
+        stock = OrderBook.get_book_by_ticker(ticker)
+        return stock._last_price_before(timestamp)
+
+
+class PriceLevel:
+    """FIFO queue of the resting orders at a single price, with their total volume cached."""
+
+    __slots__ = ("ticks", "orders", "volume")
+
+    def __init__(self, ticks: int):
+        self.ticks = ticks
+        self.orders: OrderedDict[int, Order] = OrderedDict()  # order_id -> order
+        self.volume = 0  # total volume left to trade at this price
+
+    @property
+    def price(self) -> float:
+        return from_ticks(self.ticks)
+
+    def __len__(self) -> int:
+        return len(self.orders)
+
+    def __bool__(self) -> bool:
+        return bool(self.orders)
+
+    def __iter__(self) -> Iterator[Order]:
+        return iter(self.orders.values())
+
+    def append(self, order: Order):
+        """Add an order to the back of the queue."""
+        self.orders[order.order_id] = order
+        self.volume += order.volume
+
+    def remove(self, order: Order):
+        """Remove an order from the queue, wherever it is."""
+        del self.orders[order.order_id]
+        self.volume -= order.volume
+
+    def first(self) -> Order:
+        """Returns the order with the highest time priority."""
+        return next(iter(self.orders.values()))
+
+
+class BookSide:
+    """
+    One side of an order book, stored as a sorted ladder of prices where each price maps to
+    the PriceLevel holding its orders. Levels are kept best price first, so the best price
+    is always at index 0 of the ladder. The ladder is keyed by integer ticks.
+    """
+
+    def __init__(self, side: BuyOrSell):
+        self.side = side
+        # bids are keyed by the negated ticks so that the highest bid comes first
+        self._sign = -1 if side == BUY else 1
+        self._levels: SortedDict = SortedDict()  # key -> PriceLevel
+        self._index: dict[int, PriceLevel] = {}  # order_id -> level the order rests in
+        # ticks of the levels changed since the last call to take_changes, mapped to
+        # whether the level existed before the first of those changes
+        self._changed: dict[int, bool] = {}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __bool__(self) -> bool:
+        return bool(self._index)
+
+    def __iter__(self) -> Iterator[Order]:
+        """Iterates over all orders, in the order they would be matched."""
+        for level in self._levels.values():
+            yield from level
+
+    def __contains__(self, order: Order) -> bool:
+        return order.order_id in self._index
+
+    def levels(self) -> Iterator[PriceLevel]:
+        """Iterates over the price levels, best price first."""
+        return iter(self._levels.values())
+
+    def add(self, order: Order):
+        key = self._sign * order.ticks
+        level = self._levels.get(key)
+        self.touch(order.ticks, existed=level is not None)
+        if level is None:
+            level = self._levels[key] = PriceLevel(order.ticks)
+        level.append(order)
+        self._index[order.order_id] = level
+        order.client.funding.add(order)
+
+    def remove(self, order: Order):
+        level = self._index.pop(order.order_id)
+        self.touch(level.ticks)
+        level.remove(order)
+        order.client.funding.remove(order)
+        if not level:
+            del self._levels[self._sign * level.ticks]
+
+    def resize(self, order: Order, change: int):
+        """Keeps the volume of the level of an order in line after its volume changed by change, without moving it."""
+        level = self._index[order.order_id]
+        level.volume += change
+        self.touch(level.ticks)
+
+    def touch(self, ticks: int, existed: bool = True):
+        """Marks the level at a price in ticks as changed, e.g. after a resting order was partially filled."""
+        self._changed.setdefault(ticks, existed)
+
+    def take_changes(self) -> list[tuple[str, float, int, int]]:
+        """
+        Returns the levels changed since the last call as a list of 4-tuples
+        (action, price, volume, number of orders), where action is "add", "update" or "delete".
+        """
+        changes = []
+        for ticks, existed in self._changed.items():
+            level = self._levels.get(self._sign * ticks)
+            if level is not None:
+                action = "update" if existed else "add"
+                changes.append((action, level.price, level.volume, len(level)))
+            elif existed:
+                changes.append(("delete", from_ticks(ticks), 0, 0))
+        self._changed.clear()
+        return changes
+
+    def discard(self, order: Order) -> bool:
+        """Removes an order if it is resting on this side, and returns whether it was."""
+        if order.order_id not in self._index:
+            return False
+        self.remove(order)
+        return True
+
+    def level_at(self, index: int) -> PriceLevel | None:
+        """Returns the price level at a position of the ladder, 0 being the best, if there is one."""
+        if index >= len(self._levels):
+            return None
+        return self._levels.peekitem(index)[1]
+
+    def best_level(self) -> PriceLevel | None:
+        if not self._levels:
+            return None
+        return self._levels.peekitem(0)[1]
 
-        timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
-        timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f")
+    def best_order(self) -> Order | None:
+        level = self.best_level()
+        return level.first() if level is not None else None
 
-        # If there is nothing, just return initial price as the old price
-        if len(all) == 0:
-            return OPENING_PRICES[ticker]
+    def best_price(self) -> float:
+        level = self.best_level()
+        return level.price if level is not None else 0
 
-        max_before = all[0]
-        for val in all:
-            # print(timestamp, datetime.strptime(val[7], '%Y-%m-%d %H:%M:%S.%f'))
-            if (
-                datetime.strptime(val[7], "%Y-%m-%d %H:%M:%S.%f") < timestamp
-                and val[0] > max_before[0]
-            ):
-                max_before = val
+    def get_level(self, price: float) -> PriceLevel | None:
+        return self._levels.get(self._sign * to_ticks(price))
 
-        if datetime.strptime(max_before[7], "%Y-%m-%d %H:%M:%S.%f") > timestamp:
-            return OPENING_PRICES[ticker]
+    def volume_at(self, price: float) -> int:
+        level = self.get_level(price)
+        return level.volume if level is not None else 0
 
-        return max_before[8]
+    def depth(self, levels: int = None) -> list[tuple[float, int, int]]:
+        """Returns the best price levels as a list of 3-tuples (price, volume, number of orders)."""
+        values = self._levels.values()
+        if levels is not None:
+            values = values[:levels]
+        return [(level.price, level.volume, len(level)) for level in values]
 
 
 """
 OrderBook Class
 
 This class implements an order book for tracking buy and sell orders in a financial market.
-It maintains two priority queues (one for bids and one for asks) and provides methods for
+It maintains two price ladders (one for bids and one for asks) and provides methods for
 adding, modifying, and removing orders. It also automatically matches trades when possible.
 
 Attributes:
     ticker (str): The symbol representing the asset being traded.
-    bids (SortedList): A SortedList storing buy orders, sorted by price (highest first).
-    asks (SortedList): A SortedList storing sell orders, sorted by price (lowest first).
+    bids (BookSide): Price levels of buy orders, sorted by price (highest first), each a FIFO queue.
+    asks (BookSide): Price levels of sell orders, sorted by price (lowest first), each a FIFO queue.
 
 Usage:
     client1 = Client("tapple", "pw", "timcook@aol.com", "Tim", "Cook")
@@ -508,10 +1028,28 @@ Usage:
 """
 
 
+class Instruction(NamedTuple):
+    """
+    One instruction of a batch given to OrderBook.place_orders: a new limit order on a
+    ticker, or the cancellation, replacement or amendment (new price and volume) of an order.
+    """
+
+    action: str  # "new", "cancel", "replace" or "amend"
+    ticker: str = None  # for new orders
+    side: BuyOrSell = None  # for new orders
+    price: float = None  # for new and replaced orders
+    volume: int = None  # for new and replaced orders
+    order_id: int = None  # for cancelled and replaced orders
+
+
 class OrderBook:
     counter = 0
     _all_books: list[Self] = []
     _tickers: dict[str, Self] = {}
+    _in_batch = (
+        False  # fills are committed and changes published once the batch is over
+    )
+    self_trade_prevention = SelfTradePrevention.SKIP
 
     def __init__(self, ticker: str):
         self.stock_id: int = OrderBook.counter
@@ -521,19 +1059,121 @@ class OrderBook:
             ticker = "" + self.stock_id
         self.ticker = ticker
         OrderBook._tickers[ticker] = self
-        self.bids = SortedList(key=lambda o: (-o.price, o.timestamp))
-        self.asks = SortedList(key=lambda o: (o.price, o.timestamp))
+        self.bids = BookSide(BUY)
+        self.asks = BookSide(SELL)
         self._opening_price = OPENING_PRICES[ticker] if ticker in OPENING_PRICES else 50
-        self.last_price = Transaction.last_price_before(
-            ticker
-        )  # the last price of a transaction
+
+        # price history as two parallel lists sorted by time, seeded from the database once
+        self._price_times: list[float] = []  # POSIX timestamps of the transactions
+        self._prices: list[float] = []
+        self._load_price_history()
+
+        self.last_price = self._last_price_before()  # the last price of a transaction
         self.last_timestamp = datetime.now(
             timezone.utc
         )  # last date and time when a transaction has been made
 
+        # market data feed: every change of the book is published as a numbered delta
+        self.sequence = 0  # number of the last delta published
+        self._trades: list[Transaction] = []  # transactions not published yet
+        self._listeners: list[Callable[[dict], None]] = []
+
     def get_ticker(self) -> str:
         return self.ticker
 
+    def add_listener(self, listener: Callable[[dict], None]):
+        """Registers a function called with every delta published by the book."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[dict], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _end_command(self):
+        """Commits the fills of a command and publishes the changes it made, unless it is part of a batch."""
+        if OrderBook._in_batch:
+            return
+        Transaction.journal.end_batch()
+        self._publish_changes()
+
+    def _publish_changes(self):
+        """Publishes the levels changed and the trades made since the last delta, if any."""
+        bids = self.bids.take_changes()
+        asks = self.asks.take_changes()
+        trades, self._trades = self._trades, []
+        if not (bids or asks or trades):
+            return
+
+        self.sequence += 1
+        delta = {
+            "type": "delta",
+            "ticker": self.ticker,
+            "sequence": self.sequence,
+            "bids": [list(change) for change in bids],
+            "asks": [list(change) for change in asks],
+            "trades": [
+                {
+                    "transaction_id": trade.transaction_id,
+                    "price": trade.price,
+                    "volume": trade.vol,
+                    "timestamp": trade.timestamp.isoformat(),
+                }
+                for trade in trades
+            ],
+        }
+        for listener in list(self._listeners):
+            listener(delta)
+
+    def _get_snapshot(self, levels: int = None) -> dict:
+        """Returns the aggregated book together with the sequence number of the last delta it includes."""
+        return {
+            "type": "snapshot",
+            "ticker": self.ticker,
+            "sequence": self.sequence,
+            "bids": [list(level) for level in self.bids.depth(levels)],
+            "asks": [list(level) for level in self.asks.depth(levels)],
+            "last_price": self.last_price,
+            "last_timestamp": self.last_timestamp.isoformat(),
+        }
+
+    @staticmethod
+    def get_snapshot(ticker: str, levels: int = None) -> dict:
+        """Returns the snapshot of the stock identified by ticker, to which its deltas apply."""
+        stock = OrderBook.get_book_by_ticker(ticker)
+        return stock._get_snapshot(levels)
+
+    def _load_price_history(self):
+        """Loads the prices of all past transactions of the stock from the database."""
+        history = sorted(
+            (datetime.fromisoformat(row[7]).timestamp(), row[0], row[8])
+            for row in Transaction.get_transactions_of_stock(self.ticker)
+        )
+        self._price_times = [time for time, _, _ in history]
+        self._prices = [price for _, _, price in history]
+
+    def _record_price(self, price: float, timestamp: datetime):
+        """Records the price of a transaction, making it the last price."""
+        time = timestamp.timestamp()
+        index = bisect_right(
+            self._price_times, time
+        )  # the end, unless the clock went back
+        self._price_times.insert(index, time)
+        self._prices.insert(index, price)
+
+        self.last_price = price
+        self.last_timestamp = timestamp
+
+    def _last_price_before(self, timestamp: datetime = None) -> float:
+        """Returns the price of the last transaction before a given time, or the opening price if there is none."""
+        if timestamp is None:
+            index = len(self._prices)
+        else:
+            index = bisect_left(self._price_times, timestamp.timestamp())
+
+        if index == 0:
+            return self._opening_price
+        return self._prices[index - 1]
+
     def get_opening_price(self) -> float:
         return self._opening_price
 
@@ -563,45 +1203,91 @@ class OrderBook:
 
         return cls._tickers[ticker]
 
-    def _execute_trades_between(self, order: Order, opposite_book: SortedList):
-        """Executes all possible trades between a given order and the opposite book."""
-        while order.is_executable() and opposite_book:
-            other_order: Order = opposite_book[0]
-            trade_price = other_order.get_price()
-
-            # if other orders was made by the same person, then skip it
-            if other_order.client == order.client:
-                continue
-
-            # if order is limit and all trades at feasible prices have been executed, no more trades are executable
-            if order.type == LIMIT:
-                if order.side == SELL and trade_price < order.get_price():
-                    break
-                elif order.side == BUY and trade_price > order.get_price():
-                    break
-
-            # if order is executable, but has 0 volume, no more trades would be currently feasible
-            if order.executable_volume(trade_price) == 0:
+    def _execute_trades_between(self, order: Order, opposite_book: BookSide):
+        """
+        Executes all possible trades between a given order and the opposite book, best price
+        first. A level left holding only orders of the same client is walked past.
+        """
+        depth = 0  # index of the level reached, past the levels left holding only own orders
+        while order.is_executable():
+            level = opposite_book.level_at(depth)
+            if level is None:
                 break
+            if self._execute_trades_at(order, opposite_book, level):
+                break
+            if level:  # only own orders are left at this price
+                depth += 1
 
-            # if the other order can't trade at this price, skip it
-            if not other_order.is_executable():
-                self._remove_order(other_order, cancelling=True)
-                continue
-
-            # otherwise, a positive number of shares can be traded
-            trade_volume = min(
-                order.executable_volume(trade_price),
-                other_order.executable_volume(trade_price),
-            )
-
-            if order.side == BUY:
-                Transaction(order, other_order, trade_volume)
-            else:  # order.side == SELL
-                Transaction(other_order, order, trade_volume)
+    def _execute_trades_at(
+        self, order: Order, opposite_book: BookSide, level: PriceLevel
+    ) -> bool:
+        """
+        Executes the trades of an order with the orders of one level of the opposite book,
+        in time priority, and returns whether no more trades are executable. The level is
+        walked with a single iterator, so that each order is looked at once: the orders filled
+        or cancelled meanwhile are only taken out of it once the walk is over.
+        """
+        done: list[Order] = []  # to take out of the level
+        try:
+            for other_order in level:
+                if not order.is_executable():
+                    return True
+                trade_price = other_order.get_price()
+
+                # if order is limit and all trades at feasible prices have been executed, no more trades are executable
+                if order.type == LIMIT:
+                    if order.side == SELL and trade_price < order.get_price():
+                        return True
+                    elif order.side == BUY and trade_price > order.get_price():
+                        return True
+
+                # if other orders was made by the same person, then prevent the self trade
+                if other_order.client == order.client:
+                    if self.self_trade_prevention == SelfTradePrevention.CANCEL_NEWEST:
+                        order.terminate()
+                        return True
+                    if self.self_trade_prevention == SelfTradePrevention.CANCEL_OLDEST:
+                        other_order.terminate()
+                        done.append(other_order)
+                    # SelfTradePrevention.SKIP leaves the resting order where it is
+                    continue
+
+                # if order is executable, but has 0 volume, no more trades would be currently feasible
+                volume = order.executable_volume(trade_price)
+                if volume == 0:
+                    return True
+
+                # resting orders are purged as soon as their client can no longer fund them (see
+                # FundingIndex), so this only catches funds changed other than by a trade
+                other_volume = other_order.executable_volume(trade_price)
+                if other_volume == 0:
+                    other_order.terminate()
+                    done.append(other_order)
+                    continue
+
+                # otherwise, a positive number of shares can be traded
+                trade_volume = min(volume, other_volume)
+
+                volume_before = other_order.get_volume()
+                if order.side == BUY:
+                    Transaction(order, other_order, trade_volume)
+                else:  # order.side == SELL
+                    Transaction(other_order, order, trade_volume)
+
+                # keep the cached volume of the level in line with the resting order
+                level.volume -= volume_before - other_order.get_volume()
+                opposite_book.touch(level.ticks)
+                if other_order.get_volume() == 0:
+                    done.append(other_order)
+            return not order.is_executable()
+        finally:
+            for other_order in done:
+                opposite_book.discard(other_order)
 
-            if other_order.get_volume() == 0:
-                opposite_book.remove(other_order)
+    @staticmethod
+    def set_self_trade_prevention(mode: SelfTradePrevention):
+        """Sets what happens when an order would trade with another order of its client, in every book."""
+        OrderBook.self_trade_prevention = mode
 
     # object as parameter, NOT IDs
     def _add_order(self, order: Order):
@@ -614,9 +1300,8 @@ class OrderBook:
 
         self._execute_trades_between(order, opposite_book)
 
-        # an order is added even though it might not be feasible, but it may become feasible in the future
-        # this means we should add "active orders" for each client
-        if order.volume > 0:
+        # the order is funded by what it reserved when it was placed
+        if order.volume > 0 and not order.terminated:
             # all possible trades have been executed, so store the remaining order in the book
             same_book.add(order)
 
@@ -645,8 +1330,7 @@ class OrderBook:
             When I cancel an order before putting it in the book.
         """
 
-        if order in book:
-            book.remove(order)
+        book.discard(order)  # constant time, through the order id index of the book
 
         if cancelling:
             return order.terminate()  # mark order as cancelled
@@ -661,6 +1345,8 @@ class OrderBook:
         is_market: bool,
     ) -> int:
         """Place order directly with the information entered."""
+        if volume <= 0:
+            raise ValueError("Volume must be positive")
         print(
             "client info in _place_order",
             client.balance,
@@ -675,6 +1361,7 @@ class OrderBook:
         order = Order(self.stock_id, side, price, volume, client.client_id, is_market)
         print("order info in _place_order", order.price, order.client, order.price)
         self._add_order(order) if not is_market else self._market_order(order)
+        self._end_command()
         return order.order_id
 
     @staticmethod
@@ -755,18 +1442,87 @@ class OrderBook:
             return f"Order {order_id} does not exist"'''
 
         order = Order.get_order_by_id(order_id)
+        if order is None:
+            raise ValueError(f"Order {order_id} does not exist")
+        if isinstance(order, OrderRecord):
+            return order.log()
         ticker = order.ticker
         stock = OrderBook.get_book_by_ticker(ticker)
 
-        return stock._remove_order(order, cancelling=True)
+        log = stock._remove_order(order, cancelling=True)
+        stock._end_command()
+        return log
+
+    @staticmethod
+    def place_orders(
+        instructions: list[Instruction], client_info: ClientInfo
+    ) -> list[dict]:
+        """
+        Applies a batch of instructions of a client in order, in a single pass. The fills of
+        the batch are committed together, and each book publishes a single delta once the
+        whole batch is applied. An instruction that fails does not stop the others.
+
+        Returns the result of each instruction, {"ok": True, "result": ...} with what
+        place_order, cancel_order, edit_order or amend_order would return, or
+        {"ok": False, "error": ...}.
+        """
+        client = Client.resolve(client_info)
+        results = []
+        OrderBook._in_batch = True
+        try:
+            for instruction in instructions:
+                try:
+                    result = OrderBook._apply_instruction(instruction, client)
+                    results.append({"ok": True, "result": result})
+                except Exception as e:
+                    results.append({"ok": False, "error": str(e)})
+        finally:
+            OrderBook._in_batch = False
+            Transaction.journal.end_batch()
+            for stock in OrderBook._all_books:
+                stock._publish_changes()
+        return results
+
+    @staticmethod
+    def _apply_instruction(instruction: Instruction, client: Client):
+        if instruction.action == "new":
+            stock = OrderBook.get_book_by_ticker(instruction.ticker)
+            return stock._place_order(
+                instruction.side,
+                instruction.price,
+                instruction.volume,
+                client,
+                is_market=False,
+            )
+        if instruction.action not in ("cancel", "replace", "amend"):
+            raise ValueError(f"Unknown action {instruction.action}")
+
+        order = Order.get_order_by_id(instruction.order_id)
+        if order is None:  # unknown, or forgotten since it was terminated
+            raise ValueError(f"Order {instruction.order_id} does not exist")
+        if order.client_id != client.client_id:
+            raise ValueError(
+                f"Order {instruction.order_id} does not belong to {client.username}"
+            )
+        if isinstance(order, OrderRecord):  # too late, it was filled or cancelled
+            raise ValueError(f"Order {instruction.order_id} is already terminated")
+        if instruction.action == "cancel":
+            return OrderBook.cancel_order(instruction.order_id)
+        if instruction.action == "amend":
+            return OrderBook.amend_order(
+                instruction.order_id, instruction.price, instruction.volume
+            )
+        return OrderBook.edit_order(
+            instruction.order_id, instruction.price, instruction.volume
+        )
 
     def _get_best_bid(self) -> float:
         """Returns highest bid price."""
-        return self.bids[0].get_price() if self.bids else 0
+        return self.bids.best_price()
 
     def _get_best_ask(self) -> float:
         """Returns lowest ask price."""
-        return self.asks[0].get_price() if self.asks else 0
+        return self.asks.best_price()
 
     def _get_best(self) -> tuple[float, float]:
         """Returns tuple with (highest bid, lowest ask)."""
@@ -790,24 +1546,28 @@ class OrderBook:
     def _get_volume_at_price(self, side: BuyOrSell, price: float) -> int:
         """Returns volume of open orders (some of which may not be executable) for given side of the order book."""
         book = self.bids if side == BUY else self.asks
-
-        index = 0
-        volume = 0
-
-        while index < len(book) and book[index].get_price() != price:
-            index += 1
-
-        while index < len(book) and book[index].get_price() == price:
-            volume += book[index].get_volume()
-            index += 1
-
-        return volume
+        return book.volume_at(price)
 
     @staticmethod
     def get_volume_at_price(ticker: str, side: BuyOrSell, price: float) -> int:
         stock = OrderBook.get_book_by_ticker(ticker)
         return stock._get_volume_at_price(side, price)
 
+    def _get_depth(
+        self, side: BuyOrSell, levels: int = None
+    ) -> list[tuple[float, int, int]]:
+        """Returns the best price levels of one side as a list of 3-tuples (price, volume, number of orders)."""
+        book = self.bids if side == BUY else self.asks
+        return book.depth(levels)
+
+    @staticmethod
+    def get_depth(
+        ticker: str, side: BuyOrSell, levels: int = None
+    ) -> list[tuple[float, int, int]]:
+        """Returns the aggregated depth of one side of the stock identified by ticker, best price first."""
+        stock = OrderBook.get_book_by_ticker(ticker)
+        return stock._get_depth(side, levels)
+
     # objects as parameter, NOT IDs
     def _edit_order(
         self, order: Order, new_price: float, new_vol: int
@@ -817,15 +1577,12 @@ class OrderBook:
         if order == None:
             return (0, "Order does not exist")
 
-        self._remove_order(
-            order, cancelling=False
-        )  # and temporarily remove from the order book
-
-        # then update it and add back
-        order.set_price(new_price)
-        diff = order.set_volume(new_vol)
-        self._add_order(order)
-        return (diff, "Order edited")  # is this really desired ? @Crroco
+        state = self._amend_order(order, new_price, new_vol)
+        self._end_command()
+        return (
+            state["volume_change"],
+            "Order edited",
+        )  # is this really desired ? @Crroco
         # I think we can have this, maybe it helps when we try to automate the trading, so we actually know how much the new order actually is)
         # I think the only "ambiguity" here is for the following case:
         # first I have an order for 10 shares and 7 of them go through, so I am left with 3s.
@@ -834,10 +1591,91 @@ class OrderBook:
         # 2. Try to do the inverse order with volume =  7 - 2 at the same price, so we "technically" lose no money
         # 3. Don't allow the change and throw an error. (this seems pointless, but I still included it)
 
+    def _amend_order(self, order: Order, new_price: float, new_vol: int) -> dict:
+        """
+        Changes the price and total volume of a resting order, and returns its new state.
+
+        An order keeping its price and not growing keeps its place in the queue, and is
+        resized where it rests. Otherwise it goes to the back of the queue at its new price,
+        and trades first if that price crosses the book.
+        """
+        book = self.bids if order.side == BUY else self.asks
+        ticks = to_ticks(new_price)
+        if ticks < 1:
+            raise ValueError(f"Price must be at least {from_ticks(1)}")
+        if new_vol <= 0:
+            raise ValueError("Volume must be positive")
+        priority_kept = ticks == order.ticks and new_vol <= order.get_total_volume()
+
+        # the reservation follows the order, which is left as it was if it cannot be funded
+        client, ticker = order.client, order.ticker
+        volume = order.volume + max(new_vol - order.get_total_volume(), -order.volume)
+        client.release(order.side, ticker, order.ticks, order.volume)
+        try:
+            # nothing is left to reserve if it was sized down to what was executed
+            if volume > 0:
+                client.reserve(order.side, ticker, ticks, volume)
+        except ValueError:
+            client.reserve(order.side, ticker, order.ticks, order.volume)
+            raise
+
+        if priority_kept:
+            diff = order.set_volume(new_vol)
+            book.resize(order, diff)
+        else:
+            book.discard(order)
+            order.ticks = ticks
+            order.sequence = next(Order._sequence)
+            diff = order.set_volume(new_vol)
+
+        if order.volume == 0:  # e.g. sized down to what was already executed
+            self._remove_order(order, cancelling=True)
+        elif not priority_kept:
+            self._add_order(order)
+
+        return OrderBook._order_state(order, diff, priority_kept)
+
+    @staticmethod
+    def _order_state(
+        order: Order | OrderRecord, volume_change: int = 0, priority_kept: bool = False
+    ) -> dict:
+        return {
+            "order_id": order.order_id,
+            "ticker": order.ticker,
+            "side": order.side.value,
+            "price": order.price,
+            "volume": order.get_volume(),
+            "executed_volume": order.get_executed_volume(),
+            "volume_change": volume_change,
+            "priority_kept": priority_kept,
+            "terminated": order.terminated,
+        }
+
+    @staticmethod
+    def amend_order(order_id: int, new_price: float, new_vol: int) -> dict:
+        """
+        Amends an order identified by order id in place where possible, see _amend_order.
+        Returns the state of the order once amended, or as it was terminated.
+        """
+        order = Order.get_order_by_id(order_id)
+        if order is None:
+            raise ValueError(f"Order {order_id} does not exist")
+        if isinstance(order, OrderRecord):
+            return OrderBook._order_state(order)
+        stock = OrderBook.get_book_by_ticker(order.ticker)
+
+        state = stock._amend_order(order, new_price, new_vol)
+        stock._end_command()
+        return state
+
     @staticmethod
     def edit_order(order_id: int, new_price: float, new_vol: int) -> tuple[int, str]:
         """Edits order identified by order id."""
         order = Order.get_order_by_id(order_id)
+        if order is None:
+            return (0, "Order does not exist")
+        if isinstance(order, OrderRecord):
+            return (0, order.log())
         ticker = order.ticker
         stock = OrderBook.get_book_by_ticker(ticker)
 
@@ -0,0 +1,542 @@
+import os
+import tracemalloc
+from contextlib import redirect_stdout
+
+import pytest
+from OrderBook.OrderBook import *
+from OrderBook.conftest import make_client
+
+
+@pytest.fixture
+def book():
+    return OrderBook("AAPL")
+
+
+def test_best_prices(book):
+    buyer = make_client()
+    seller = make_client(portfolio={"AAPL": 100})
+
+    assert book._get_best() == (0, 0)
+
+    book._place_order(BUY, 99, 10, buyer, False)
+    book._place_order(BUY, 100, 10, buyer, False)
+    book._place_order(SELL, 102, 10, seller, False)
+    book._place_order(SELL, 101, 10, seller, False)
+
+    assert book._get_best() == (100, 101)
+
+
+def test_volume_at_price_is_aggregated(book):
+    buyer = make_client()
+
+    book._place_order(BUY, 100, 10, buyer, False)
+    book._place_order(BUY, 100, 5, buyer, False)
+    book._place_order(BUY, 99, 7, buyer, False)
+
+    assert book._get_volume_at_price(BUY, 100) == 15
+    assert book._get_volume_at_price(BUY, 99) == 7
+    assert book._get_volume_at_price(BUY, 98) == 0
+    assert book._get_depth(BUY) == [(100, 15, 2), (99, 7, 1)]
+    assert book._get_depth(BUY, 1) == [(100, 15, 2)]
+
+
+def test_orders_at_same_price_fill_in_time_order(book):
+    first = make_client(portfolio={"AAPL": 100})
+    second = make_client(portfolio={"AAPL": 100})
+    buyer = make_client()
+
+    first_id = book._place_order(SELL, 100, 10, first, False)
+    second_id = book._place_order(SELL, 100, 10, second, False)
+    book._place_order(BUY, 100, 15, buyer, False)
+
+    assert Order.get_order_by_id(first_id).get_volume() == 0
+    assert Order.get_order_by_id(second_id).get_volume() == 5
+    assert book._get_depth(SELL) == [(100, 5, 1)]
+    assert [order[0] for order in book._get_all_asks()] == [second_id]
+    assert buyer.portfolio["AAPL"] == 15
+
+
+def test_sweep_removes_emptied_levels(book):
+    seller = make_client(portfolio={"AAPL": 100})
+    buyer = make_client()
+
+    for price in (100, 101, 102):
+        book._place_order(SELL, price, 10, seller, False)
+    book._place_order(BUY, 101, 25, buyer, False)
+
+    assert book._get_depth(SELL) == [(102, 10, 1)]
+    assert book._get_depth(BUY) == [(101, 5, 1)]
+
+
+def test_cancel_updates_level_volume(book):
+    buyer = make_client()
+
+    order_id = book._place_order(BUY, 100, 10, buyer, False)
+    book._place_order(BUY, 100, 5, buyer, False)
+    OrderBook.cancel_order(order_id)
+
+    assert book._get_volume_at_price(BUY, 100) == 5
+    assert len(book.bids) == 1
+
+
+def test_cancel_order_not_in_book(book):
+    seller = make_client(portfolio={"AAPL": 100})
+    buyer = make_client()
+
+    order_id = book._place_order(SELL, 100, 10, seller, False)
+    book._place_order(BUY, 100, 10, buyer, False)
+    OrderBook.cancel_order(order_id)  # already filled, so not resting any more
+    OrderBook.cancel_order(order_id)
+
+    assert not book.asks
+    assert book._get_depth(SELL) == []
+
+
+def test_client_lookup_by_username_and_email():
+    client = make_client()
+
+    assert Client.get_client_by_username(client.username) is client
+    assert Client.get_client_by_email(client.email) is client
+    assert Client.resolve(client.username) is client
+    assert Client.get_client_by_username("no_such_user") is None
+
+    with pytest.raises(ValueError):
+        Client(client.username, "pw", "other@test.com", "Test", "Client")
+
+
+def test_client_rename_keeps_indexes_consistent():
+    client = make_client()
+    other = make_client()
+    old_username, old_email = client.username, client.email
+
+    client.set_username(f"{old_username}_renamed")
+    client.set_email(f"renamed_{old_email}")
+
+    assert Client.get_client_by_username(old_username) is None
+    assert Client.get_client_by_email(old_email) is None
+    assert Client.get_client_by_username(f"{old_username}_renamed") is client
+    assert Client.get_client_by_email(f"renamed_{old_email}") is client
+
+    with pytest.raises(ValueError):
+        client.set_username(other.username)
+    assert Client.get_client_by_username(other.username) is other
+
+
+def test_database_id_is_resolved_once(monkeypatch):
+    known = make_client()
+    known.set_db_id(42)
+    unknown = make_client()
+
+    lookups = []
+    account_from_email = Database.account_from_email
+    monkeypatch.setattr(
+        Database,
+        "account_from_email",
+        lambda self, email: lookups.append(email) or account_from_email(self, email),
+    )
+
+    assert known.get_db_id() == 42
+    assert unknown.get_db_id() == -1
+    assert unknown.get_db_id() == -1
+    assert lookups == [unknown.email]
+
+
+def test_last_price_before(book):
+    seller = make_client(portfolio={"AAPL": 100})
+    buyer = make_client()
+    start = datetime.now(timezone.utc)
+
+    assert book._last_price_before() == book.get_opening_price()
+
+    book._place_order(SELL, 100, 10, seller, False)
+    book._place_order(BUY, 100, 10, buyer, False)
+    middle = datetime.now(timezone.utc)
+    book._place_order(SELL, 110, 10, seller, False)
+    book._place_order(BUY, 110, 10, buyer, False)
+
+    assert book.last_price == 110
+    assert Transaction.last_price_before("AAPL") == 110
+    assert Transaction.last_price_before("AAPL", middle) == 100
+    assert Transaction.last_price_before("AAPL", start) == book.get_opening_price()
+    assert OrderBook.calculate_pnl("AAPL", middle) == pytest.approx(10)
+
+
+def test_price_history_is_loaded_from_database():
+    cursor = Database()._cursor()
+    for transaction_id, time_stamp, price in [
+        (1, "2025-05-01 10:00:00.000000", 200),
+        (2, "2025-05-02 10:00:00", 205),  # written without microseconds
+        (3, "2025-05-03 10:00:00.500000", 190),
+    ]:
+        cursor.execute(
+            """INSERT INTO Transactions VALUES(?, 1, ?, 2, ?, 1, "GOOG", ?, ?);""",
+            (transaction_id, price, price, time_stamp, price),
+        )
+
+    book = OrderBook("GOOG")
+
+    assert book.last_price == 190
+    assert book._last_price_before(datetime(2025, 5, 2, 12)) == 205
+    assert book._last_price_before(datetime(2025, 5, 1, 9)) == book.get_opening_price()
+
+
+def test_deltas(book):
+    buyer = make_client()
+    seller = make_client(portfolio={"AAPL": 100})
+    deltas = []
+    book.add_listener(deltas.append)
+
+    book._place_order(SELL, 101, 10, seller, False)
+    book._place_order(SELL, 101, 5, seller, False)
+    book._place_order(BUY, 101, 12, buyer, False)
+
+    assert [delta["sequence"] for delta in deltas] == [1, 2, 3]
+    assert deltas[0]["asks"] == [["add", 101, 10, 1]]
+    assert deltas[1]["asks"] == [["update", 101, 15, 2]]
+    assert deltas[2]["asks"] == [["update", 101, 3, 1]]
+    assert deltas[2]["bids"] == []  # the buy order was filled without resting
+    assert [trade["volume"] for trade in deltas[2]["trades"]] == [10, 2]
+
+    order_id = book._place_order(BUY, 99, 1, buyer, False)
+    OrderBook.cancel_order(order_id)
+    assert deltas[-1]["bids"] == [["delete", 99, 0, 0]]
+
+    snapshot = book._get_snapshot()
+    assert snapshot["sequence"] == deltas[-1]["sequence"] == 5
+    assert snapshot["asks"] == [[101, 3, 1]]
+    assert snapshot["bids"] == []
+
+
+def test_no_delta_without_change(book):
+    deltas = []
+    book.add_listener(deltas.append)
+    order = Order(book.stock_id, BUY, 100, 1, make_client().client_id)
+
+    OrderBook.cancel_order(order.order_id)  # never rested in the book
+
+    assert deltas == [] and book.sequence == 0
+
+
+def test_prices_are_kept_in_ticks(book):
+    buyer = make_client()
+    seller = make_client(portfolio={"AAPL": 100})
+
+    bid = Order.get_order_by_id(book._place_order(BUY, 100.1, 1, buyer, False))
+    book._place_order(BUY, 0.1 + 0.2 + 100, 2, buyer, False)  # not exactly 100.3
+    book._place_order(BUY, 100.304, 3, buyer, False)  # snapped to the nearest tick
+
+    assert bid.ticks == 10010 and bid.price == 100.1
+    assert not hasattr(bid, "__dict__")
+    assert book.bids.depth() == [(100.3, 5, 2), (100.1, 1, 1)]
+    assert book.bids.volume_at(100.3) == 5
+
+    book._place_order(SELL, 100.3, 5, seller, False)
+    assert book._get_best() == (100.1, 0)
+
+
+def test_terminated_orders_leave_the_registry(book, monkeypatch):
+    monkeypatch.setattr(Order, "_archive", OrderedDict())
+    monkeypatch.setattr(Order, "archive_size", 2)
+    buyer = make_client()
+    seller = make_client(portfolio={"AAPL": 100})
+
+    resting = book._place_order(BUY, 100, 10, buyer, False)
+    filled = book._place_order(SELL, 100, 4, seller, False)
+    assert Order.get_open_order(resting) is Order.get_order_by_id(resting)
+    assert Order.get_open_order(filled) is None
+    assert Order.get_order_by_id(filled) == OrderRecord(
+        filled, book.stock_id, SELL, 100, 0, 4, seller.client_id, LIMIT
+    )
+
+    assert "terminated after 4/10" in OrderBook.cancel_order(resting)
+    assert Order.get_order_by_id(resting).get_volume() == 6
+    assert "already terminated after 4/10" in OrderBook.cancel_order(resting)
+    assert OrderBook.edit_order(resting, 101, 5)[0] == 0
+    assert book._get_best() == (0, 0)
+
+    OrderBook.market_order("AAPL", BUY, 1, buyer)  # the oldest record is forgotten
+    assert Order.get_order_by_id(filled) is None
+    with pytest.raises(ValueError):
+        OrderBook.cancel_order(filled)
+
+
+def test_soak_memory_is_flat(book, monkeypatch):
+    # stands in for the RSS of a long running server: only open orders may be kept
+    monkeypatch.setattr(Order, "_archive", OrderedDict())
+    monkeypatch.setattr(Order, "archive_size", 500)
+    client = make_client()
+
+    def churn(orders):
+        for i in range(orders):
+            order_id = book._place_order(BUY, 50 + i % 100, 1, client, False)
+            OrderBook.cancel_order(order_id)
+            OrderBook.market_order("AAPL", SELL, 1, client)  # nothing to trade with
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        tracemalloc.start()
+        try:
+            churn(1_000)  # warm up, fills the archive
+            before = tracemalloc.get_traced_memory()[0]
+            churn(5_000)
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    assert after - before < 64 * 1024  # 10 000 more orders, each well over 100 bytes
+
+
+def test_transactions_are_kept_in_a_window(book, monkeypatch):
+    monkeypatch.setattr(Transaction, "store", TradeStore(capacity=2))
+    monkeypatch.setattr(Transaction, "counter", None)
+    cursor = Database()._cursor()
+    cursor.execute(
+        """INSERT INTO Transactions VALUES(1, 1, 90, 2, 90, 1, "AAPL", "2025-05-01 10:00:00", 90);"""
+    )
+    buyer = make_client()
+    seller = make_client(portfolio={"AAPL": 100})
+    for client in (buyer, seller):  # so that their transactions are written
+        client.set_db_id(
+            Database().create_client(client.username, client.email, 10_000)
+        )
+    Database().create_owned_stock(seller.db_id, "AAPL", 100)
+    start = datetime.now(timezone.utc)
+    for price in (100, 101, 102):
+        book._place_order(SELL, price, 1, seller, False)
+        book._place_order(BUY, price, 1, buyer, False)
+
+    assert list(Transaction.get_all_transactions()) == [3, 4]
+    assert Transaction.get_transaction_by_id(4).price == 102
+    assert (
+        Transaction.get_transaction_by_id(2).price == 100
+    )  # read back from the database
+    assert Transaction.get_transaction_by_id(1).timestamp.year == 2025
+
+    recent = Transaction.get_transactions_between(start, ticker="AAPL")
+    assert recent["price"].tolist() == [100, 101, 102]
+    assert Transaction.get_transactions_between()["transaction_id"].tolist() == [
+        1,
+        2,
+        3,
+        4,
+    ]
+    assert len(Transaction.get_transactions_between(ticker="GOOG")["price"]) == 0
+
+
+def test_batch_of_instructions(book):
+    maker = make_client(portfolio={"AAPL": 100})
+    other = make_client()
+    deltas = []
+    book.add_listener(deltas.append)
+    foreign = book._place_order(BUY, 90, 1, other, False)
+    deltas.clear()
+
+    bid, ask = OrderBook.place_orders(
+        [
+            Instruction("new", "AAPL", BUY, 99, 10),
+            Instruction("new", "AAPL", SELL, 101, 10),
+        ],
+        maker,
+    )
+    assert bid["ok"] and ask["ok"]
+    assert len(deltas) == 1  # the batch is published as a whole
+    assert deltas[0]["bids"] == [["add", 99, 10, 1]]
+
+    results = OrderBook.place_orders(
+        [
+            Instruction("cancel", order_id=ask["result"]),
+            Instruction("replace", price=98, volume=5, order_id=bid["result"]),
+            Instruction("cancel", order_id=foreign),
+            Instruction("new", "NONE", BUY, 10, 1),
+            Instruction("modify", order_id=bid["result"]),
+            Instruction("replace", price=98, volume=5, order_id=-1),
+            Instruction("cancel", order_id=-1),
+            Instruction("amend", price=98, volume=5, order_id=-1),
+        ],
+        maker,
+    )
+    assert [result["ok"] for result in results] == [True, True] + [False] * 6
+    assert "terminated after 0/10" in results[0]["result"]
+    assert results[1]["result"] == (-5, "Order edited")
+    assert "does not belong" in results[2]["error"]
+    # an unknown order is rejected whatever is done with it
+    assert [result["error"] for result in results[5:]] == [
+        "Order -1 does not exist"
+    ] * 3
+    assert book._get_depth(BUY) == [(98, 5, 1), (90, 1, 1)]
+    assert book._get_depth(SELL) == []
+    assert len(deltas) == 2
+
+
+def test_amend_keeps_priority_when_sizing_down(book):
+    first, second = make_client(), make_client()
+    seller = make_client(portfolio={"AAPL": 100})
+    a = book._place_order(BUY, 100, 10, first, False)
+    b = book._place_order(BUY, 100, 10, second, False)
+    deltas = []
+    book.add_listener(deltas.append)
+
+    state = OrderBook.amend_order(a, 100, 6)
+    assert state["priority_kept"] and state["volume_change"] == -4
+    assert book.bids.best_order().order_id == a
+    assert deltas[-1]["bids"] == [["update", 100, 16, 2]]
+
+    # growing or moving an order sends it to the back of the queue
+    assert not OrderBook.amend_order(a, 100, 8)["priority_kept"]
+    assert book.bids.best_order().order_id == b
+    book._place_order(SELL, 101, 5, seller, False)
+    state = OrderBook.amend_order(b, 101, 10)
+    assert state["executed_volume"] == 5 and state["volume"] == 5
+    assert book._get_last_price() == 101  # at the price of the resting ask
+    assert book._get_depth(BUY) == [(101, 5, 1), (100, 8, 1)]
+
+    # sizing down to what was executed leaves nothing to trade
+    state = OrderBook.amend_order(b, 101, 3)
+    assert state["terminated"] and state["volume"] == 0
+    assert book._get_depth(BUY) == [(100, 8, 1)]
+    assert OrderBook.amend_order(b, 100, 10) == state | {
+        "volume_change": 0,
+        "priority_kept": False,
+    }
+    with pytest.raises(ValueError):
+        OrderBook.amend_order(-1, 100, 1)
+
+
+@pytest.mark.parametrize(
+    "mode, depth, asks",
+    [
+        (SelfTradePrevention.SKIP, [(101, 3, 1)], [(100, 5, 1), (101, 5, 1)]),
+        (SelfTradePrevention.CANCEL_OLDEST, [(101, 3, 1)], []),
+        (SelfTradePrevention.CANCEL_NEWEST, [], [(100, 10, 2), (101, 5, 1)]),
+    ],
+)
+def test_self_trade_prevention(book, monkeypatch, mode, depth, asks):
+    monkeypatch.setattr(OrderBook, "self_trade_prevention", mode)
+    trader = make_client(portfolio={"AAPL": 100})
+    other = make_client(portfolio={"AAPL": 100})
+    book._place_order(SELL, 100, 5, trader, False)
+    book._place_order(SELL, 100, 5, other, False)
+    book._place_order(SELL, 101, 5, trader, False)
+
+    order_id = book._place_order(BUY, 101, 8, trader, False)
+    traded = 0 if mode == SelfTradePrevention.CANCEL_NEWEST else 5
+    assert Order.get_order_by_id(order_id).get_executed_volume() == traded
+    assert book._get_depth(BUY) == depth
+    assert book._get_depth(SELL) == asks
+
+    # a market order walks past the orders of its client too, instead of spinning on them
+    OrderBook.market_order("AAPL", BUY, 20, trader)
+    assert book._get_depth(SELL) == asks
+
+
+def test_own_orders_are_walked_past_once(book, monkeypatch):
+    monkeypatch.setattr(OrderBook, "self_trade_prevention", SelfTradePrevention.SKIP)
+    trader = make_client(portfolio={"AAPL": 2000})
+    other = make_client(portfolio={"AAPL": 10})
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for _ in range(2000):
+            book._place_order(SELL, 100, 1, trader, False)
+    book._place_order(SELL, 100, 5, other, False)
+    book._place_order(SELL, 101, 5, other, False)
+
+    visited = 0
+    iterate = PriceLevel.__iter__
+
+    def counted(level):
+        nonlocal visited
+        for order in iterate(level):
+            visited += 1
+            yield order
+
+    monkeypatch.setattr(PriceLevel, "__iter__", counted)
+    order_id = book._place_order(BUY, 101, 8, trader, False)
+    assert Order.get_order_by_id(order_id).get_executed_volume() == 8
+    assert visited == 2002  # each resting order was looked at once
+    assert book._get_depth(SELL) == [(100, 2000, 2000), (101, 2, 1)]
+
+
+def test_orders_reserve_their_funds(book):
+    buyer = make_client(balance=1000)
+    seller = make_client(portfolio={"AAPL": 11})
+    book._place_order(BUY, 100, 6, buyer, False)
+    bid = book._place_order(BUY, 50, 6, buyer, False)
+    next_id = Order.counter
+    with pytest.raises(ValueError):  # the 100 left cannot back another order at 200
+        book._place_order(BUY, 200, 1, buyer, False)
+    assert Order.counter == next_id  # and the order was never made
+    book._place_order(SELL, 101, 5, seller, False)
+    with pytest.raises(ValueError):
+        book._place_order(SELL, 102, 7, seller, False)
+    book._place_order(SELL, 102, 5, seller, False)
+    assert buyer.available_cash() == 100 and seller.available_shares("AAPL") == 1
+
+    # filling or cancelling an order releases what it reserved
+    book._place_order(SELL, 100, 1, seller, False)
+    OrderBook.cancel_order(bid)
+    assert buyer.available_cash() == 400 and buyer.reserved_cash == to_ticks(500)
+    assert seller.available_shares("AAPL") == 0
+
+    # an amend must be funded too, and is undone if it is not
+    with pytest.raises(ValueError):
+        OrderBook.amend_order(book._place_order(BUY, 90, 1, buyer, False), 500, 1)
+    assert buyer.available_cash() == 310
+    assert book._get_depth(BUY) == [(100, 5, 1), (90, 1, 1)]
+
+    # a market order only trades what is not reserved
+    OrderBook.market_order("AAPL", BUY, 20, buyer)
+    assert buyer.portfolio == {"AAPL": 4}
+    assert book._get_depth(SELL) == [(101, 2, 1), (102, 5, 1)]
+
+
+def test_reservations_never_exceed_the_cash(book):
+    buyer = make_client(balance=10.006)  # a fraction of a tick short of 10.01
+    with pytest.raises(ValueError):
+        book._place_order(BUY, 10.01, 1, buyer, False)
+    book._place_order(BUY, 10, 1, buyer, False)
+    assert buyer.reserved_cash == to_ticks(10)
+
+    for price in (0.004, 0):  # less than a tick
+        with pytest.raises(ValueError):
+            book._place_order(BUY, price, 1, buyer, False)
+    assert book._get_depth(BUY) == [(10, 1, 1)]
+
+
+def test_orders_must_have_a_positive_volume(book):
+    buyer = make_client(balance=1000)
+    seller = make_client(portfolio={"AAPL": 10})
+    bid = book._place_order(BUY, 100, 1, buyer, False)
+    live, next_id = dict(Order._live), Order.counter
+    for volume in (-50, 0):
+        with pytest.raises(ValueError):
+            book._place_order(BUY, 100, volume, buyer, False)
+        with pytest.raises(ValueError):
+            OrderBook.market_order("AAPL", SELL, volume, seller)
+        with pytest.raises(ValueError):
+            OrderBook.amend_order(bid, 100, volume)
+    with pytest.raises(ValueError):
+        OrderBook.amend_order(bid, 0, 1)
+
+    # nothing was made, reserved or resized
+    assert Order._live == live and Order.counter == next_id
+    assert buyer.reserved_cash == to_ticks(100) and buyer.available_cash() == 900
+    assert book._get_depth(BUY) == [(100, 1, 1)]
+    with pytest.raises(ValueError):  # so a bid cannot go beyond the balance
+        book._place_order(BUY, 100, 10, buyer, False)
+
+
+def test_unfunded_orders_are_purged(book):
+    buyer = make_client(balance=1000)
+    seller = make_client(portfolio={"AAPL": 10})
+    book._place_order(BUY, 600, 1, buyer, False)
+    book._place_order(BUY, 300, 1, buyer, False)
+    book._place_order(SELL, 700, 5, seller, False)
+    book._place_order(SELL, 800, 5, seller, False)
+    assert len(buyer.funding) == 2 and len(seller.funding) == 2
+
+    # funds changed from outside, as a shard learning of trades made in another one
+    buyer.balance = 500
+    seller.portfolio["AAPL"] = 6
+    buyer._purge_unfunded()
+    seller._purge_unfunded()
+    assert book._get_depth(BUY) == [(300, 1, 1)]  # the highest bid goes first
+    assert book._get_depth(SELL) == [(700, 5, 1)]  # and the newest ask
+    assert buyer.reserved_cash == to_ticks(300) and len(seller.funding) == 1
@@ -0,0 +1,208 @@
+import asyncio
+import threading
+
+import pytest
+from OrderBook.OrderBook import *
+from OrderBook.conftest import make_client
+from OrderBook.engine import Termination
+from OrderBook.shards import ShardedEngine
+
+
+@pytest.fixture(autouse=True)
+def mirrored_books(database):
+    # the books of this process mirror the books of the shards
+    for ticker in ("AAPL", "GOOG"):
+        OrderBook(ticker)
+
+
+def run_sharded(test, shard_map):
+    """Runs the coroutine function test with an engine started with shard_map."""
+
+    async def main():
+        books = {ticker: OrderBook.get_book_by_ticker(ticker) for ticker in shard_map}
+        engine = ShardedEngine(list(shard_map), shard_map=shard_map)
+        engine.start()
+        try:
+            return await test(engine, books)
+        finally:
+            engine.stop()
+
+    return asyncio.run(main())
+
+
+def test_orders_are_routed_to_the_shard_of_their_ticker():
+    buyer = make_client()
+    seller = make_client(balance=0, portfolio={"AAPL": 10, "GOOG": 10})
+
+    async def test(engine, books):
+        deltas = []
+        for book in books.values():
+            book.add_listener(engine.on_loop(deltas.append))
+
+        apple = await engine.place_order("AAPL", SELL, 100, 10, seller)
+        google = await engine.place_order("GOOG", SELL, 50, 10, seller)
+        await engine.place_order("AAPL", BUY, 100, 4, buyer)
+        await engine.place_order("GOOG", BUY, 50, 10, buyer)
+
+        depth = await engine.query("AAPL", OrderBook.get_depth, "AAPL", SELL)
+        cancelled = await engine.cancel_order(apple)
+        await engine.query("AAPL", OrderBook.get_best, "AAPL")  # deltas are in by now
+        return google, depth, cancelled, deltas
+
+    google, depth, cancelled, deltas = run_sharded(test, {"AAPL": 0, "GOOG": 1})
+
+    assert google != 0  # ids are unique across shards
+    assert depth == [(100, 6, 1)]
+    assert "terminated after 4/10" in cancelled
+
+    # the trades are applied to the clients of this process
+    assert buyer.portfolio == {"AAPL": 4, "GOOG": 10}
+    assert buyer.balance == 1_000_000 - 400 - 500
+    assert seller.portfolio == {"AAPL": 6}
+    assert seller.balance == 900
+    assert OrderBook.get_last_price("GOOG") == 50
+
+    # and the deltas of both shards reach the listeners of the mirrored books
+    assert {(delta["ticker"], delta["sequence"]) for delta in deltas} == {
+        ("AAPL", 1),
+        ("AAPL", 2),
+        ("AAPL", 3),
+        ("GOOG", 1),
+        ("GOOG", 2),
+    }
+
+
+def test_cash_spent_in_one_shard_is_known_to_the_others():
+    buyer = make_client(balance=1050)
+    seller = make_client(balance=0, portfolio={"AAPL": 10, "GOOG": 10})
+
+    async def test(engine, books):
+        await engine.place_order("AAPL", SELL, 100, 10, seller)
+        await engine.place_order("GOOG", SELL, 100, 10, seller)
+        await engine.place_order("GOOG", BUY, 100, 5, buyer)
+        # the shard of AAPL has not matched the buyer before, but knows 500 have been spent
+        with pytest.raises(ValueError):
+            await engine.place_order("AAPL", BUY, 100, 10, buyer)
+        await engine.place_order("AAPL", BUY, 100, 5, buyer)
+        return await engine.query("AAPL", OrderBook.get_depth, "AAPL", SELL)
+
+    asks = run_sharded(test, {"AAPL": 0, "GOOG": 1})
+
+    assert buyer.balance == 50
+    assert buyer.portfolio == {"AAPL": 5, "GOOG": 5}
+    assert asks == [(100, 5, 1)]
+
+
+def test_orders_cancelled_in_the_shards_are_reported():
+    buyer = make_client(balance=1000)
+    seller = make_client(balance=0, portfolio={"GOOG": 10})
+
+    async def test(engine, books):
+        terminations = []
+        engine.add_termination_listener(terminations.append)
+        cancelled = await engine.place_order("AAPL", BUY, 100, 1, buyer)
+        await engine.cancel_order(cancelled)
+        purged = await engine.place_order("AAPL", BUY, 100, 5, buyer)
+        await engine.place_order("GOOG", SELL, 100, 6, seller)
+        await engine.place_order("GOOG", BUY, 100, 6, buyer)  # leaves 400 for 500
+        await engine.query("AAPL", OrderBook.get_best, "AAPL")  # purged by now
+        await engine.run(lambda: None)  # and reported
+        engine.remove_termination_listener(terminations.append)
+        return cancelled, purged, terminations
+
+    cancelled, purged, terminations = run_sharded(test, {"AAPL": 0, "GOOG": 1})
+    assert terminations == [
+        Termination(cancelled, "AAPL", buyer.username),
+        Termination(purged, "AAPL", buyer.username),
+    ]
+
+
+def test_transactions_are_found_across_shards(monkeypatch):
+    monkeypatch.setattr(Transaction, "store", TradeStore(capacity=2))
+    buyer = make_client()
+    seller = make_client(portfolio={"AAPL": 10, "GOOG": 10})
+    for client in (buyer, seller):  # so that their transactions are written
+        client.set_db_id(
+            Database().create_client(client.username, client.email, 1_000_000)
+        )
+    for ticker in ("AAPL", "GOOG"):
+        Database().create_owned_stock(seller.db_id, ticker, 10)
+    start = datetime.now(timezone.utc)
+
+    async def test(engine, books):
+        for ticker in ("AAPL", "AAPL", "GOOG"):
+            await engine.place_order(ticker, SELL, 100, 1, seller)
+            await engine.place_order(ticker, BUY, 100, 1, buyer)
+
+    run_sharded(test, {"AAPL": 0, "GOOG": 1})
+    Transaction.journal.flush()
+
+    # the ids of the shards are interleaved, so the last one kept is not the highest
+    second, third = Transaction.get_all_transactions()
+    assert second == third + 1
+    first = second - 2
+    for transaction_id in (first, second, third):
+        assert Transaction.get_transaction_by_id(transaction_id).price == 100
+    made = Transaction.get_transactions_between(start)["transaction_id"]
+    assert made.tolist() == [first, second, third]  # each once, in the order made
+
+
+def test_clients_of_this_process_are_only_used_on_one_thread():
+    buyer = make_client()
+    seller = make_client(portfolio={"AAPL": 10})
+    changed = set()  # threads the trades were applied to the clients on
+    for client in (buyer, seller):
+        client.add_listener(lambda client: changed.add(threading.get_ident()))
+
+    async def test(engine, books):
+        loop = threading.get_ident()
+        ran = await engine.run(threading.get_ident)
+        with pytest.raises(KeyError):
+            await engine.run(OrderBook.get_book_by_ticker, "NONE")
+        await engine.place_order("AAPL", SELL, 100, 5, seller)
+        await engine.place_order("AAPL", BUY, 100, 5, buyer)
+        return loop, ran
+
+    loop, ran = run_sharded(test, {"AAPL": 0})
+    assert ran != loop  # so the event loop is left free
+    assert changed == {ran}
+    assert buyer.portfolio == {"AAPL": 5} and seller.portfolio == {"AAPL": 5}
+
+
+def test_errors_are_raised_to_the_caller():
+    async def test(engine, books):
+        with pytest.raises(ValueError):
+            await engine.cancel_order(12345)
+        with pytest.raises(KeyError):
+            await engine.query("AAPL", OrderBook.get_book_by_ticker, "GOOG")
+
+    run_sharded(test, {"AAPL": 0})
+
+
+def test_batches_are_split_between_the_shards():
+    maker = make_client(portfolio={"AAPL": 10, "GOOG": 10})
+
+    async def test(engine, books):
+        quotes = await engine.place_orders(
+            [
+                Instruction("new", "AAPL", SELL, 101, 5),
+                Instruction("new", "GOOG", SELL, 51, 5),
+                Instruction("new", "NONE", SELL, 1, 1),
+                Instruction("new", "AAPL", BUY, 99, 5),
+            ],
+            maker,
+        )
+        cancels = await engine.place_orders(
+            [Instruction("cancel", order_id=quote["result"]) for quote in quotes[:2]],
+            maker,
+        )
+        asks = await engine.query("AAPL", OrderBook.get_depth, "AAPL", SELL)
+        bids = await engine.query("AAPL", OrderBook.get_depth, "AAPL", BUY)
+        return quotes, cancels, asks, bids
+
+    quotes, cancels, asks, bids = run_sharded(test, {"AAPL": 0, "GOOG": 1})
+
+    assert [quote["ok"] for quote in quotes] == [True, True, False, True]
+    assert quotes[2]["error"] == "Ticker NONE not found"
+    assert all(cancel["ok"] for cancel in cancels)
+    assert asks == [] and bids == [(99, 5, 1)]
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from OrderBook.trades import *
+
+START = datetime(2025, 5, 1, 10, tzinfo=timezone.utc)
+
+
+def fill(store: TradeStore, count: int, first_id: int = 0):
+    for i in range(count):
+        store.append(
+            first_id + i, START + timedelta(seconds=i), 100 + i, 1, i % 2, 7, 8
+        )
+
+
+def test_timestamps_keep_microseconds():
+    timestamp = START + timedelta(microseconds=1)
+    assert to_nanoseconds(timestamp) == to_nanoseconds(START) + 1000
+    assert from_nanoseconds(to_nanoseconds(timestamp)) == timestamp
+
+
+def test_rows_before_the_store_is_full():
+    store = TradeStore(capacity=10)
+    assert len(store) == 0 and store.oldest() is None
+
+    fill(store, 3)
+
+    assert len(store) == 3
+    assert store.column("price").tolist() == [100, 101, 102]
+    assert store.get(1) == TradeRecord(1, START + timedelta(seconds=1), 101, 1, 1, 7, 8)
+    assert store.get(3) is None
+
+
+def test_oldest_rows_are_overwritten():
+    store = TradeStore(capacity=4)
+    fill(store, 10, first_id=100)
+
+    assert len(store) == 4
+    assert store.column("transaction_id").tolist() == [106, 107, 108, 109]
+    assert store.oldest().transaction_id == 106
+    assert store.get(105) is None
+    assert store.get(106).price == 106 and store.get(109).price == 109
+
+
+def test_interleaved_ids():
+    # shards interleave their ids, and their trades are appended as they complete
+    store = TradeStore(capacity=6)
+    for i, transaction_id in enumerate([0, 2, 4, 6, 8, 1, 3]):
+        store.append(transaction_id, START + timedelta(seconds=i), 100, 1, 0, 7, 8)
+
+    assert store.get(1).timestamp == START + timedelta(seconds=5)
+    assert store.get(3) is not None and store.get(0) is None
+    assert [store.get(i) is not None for i in (2, 4, 6, 8)] == [True] * 4
+    assert store.kept_from() == START + timedelta(microseconds=1)
+
+
+def test_kept_from():
+    store = TradeStore(capacity=2)
+    assert store.kept_from() is None
+    store.append(1, START + timedelta(seconds=1), 100, 1, 0, 7, 8)
+    store.append(0, START, 100, 1, 0, 7, 8)  # completed later, by another shard
+    assert store.kept_from() == START
+    store.append(2, START + timedelta(seconds=2), 100, 1, 0, 7, 8)
+    assert store.kept_from() == START + timedelta(seconds=1, microseconds=1)
+
+
+def test_between():
+    store = TradeStore(capacity=8)
+    fill(store, 12)
+
+    columns = store.between(
+        START + timedelta(seconds=5), START + timedelta(seconds=10), stock_id=0
+    )
+    assert columns["transaction_id"].tolist() == [6, 8]
+    assert set(columns) == {name for name, _ in COLUMNS}
+    assert len(store.between()["price"]) == 8
+
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        TradeStore(capacity=0)
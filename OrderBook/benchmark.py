@@ -0,0 +1,353 @@
+"""
+Benchmarks for the order book. Run from the stock-market folder, e.g.:
+
+    python -m OrderBook.benchmark cancel sweep --depths 1000 10000 --clients 1 100
+
+Every benchmark times one kind of command at a time on a book holding a given number of
+resting orders, spread over a given number of clients, and puts the book back as it was
+after each command, untimed, so that every sample sees the same depth. Latencies are
+reported in microseconds per command, with the throughput of the timed commands.
+
+Results can be saved as a JSON baseline, and later runs compared to it:
+
+    python -m OrderBook.benchmark --save baseline.json
+    python -m OrderBook.benchmark --compare baseline.json  # exits with 1 on a regression
+
+Baselines only compare runs on the same machine, so none is kept in the repository. The
+benchmarks run against a copy of the database, which is never written to.
+"""
+
+from .OrderBook import *
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from typing import NamedTuple
+
+from journal import DurabilityMode
+
+_names = itertools.count()
+
+TICKER = "AAPL"
+VOLUME = 10  # volume of every resting order
+
+
+def make_client(balance=1_000_000_000_000, portfolio=None) -> Client:
+    name = f"benchmark_{next(_names)}"
+    if portfolio is None:
+        portfolio = {TICKER: 1_000_000_000}
+    return Client(
+        name, "pw", f"{name}@benchmark.com", "Bench", "Mark", balance, portfolio
+    )
+
+
+def bid_price(level: int) -> float:
+    return round(99.99 - level * 0.01, 2)
+
+
+def ask_price(level: int) -> float:
+    return round(100.01 + level * 0.01, 2)
+
+
+class Market:
+    """
+    A book with depth resting orders, half of them bids and half asks spread over levels
+    prices on each side, owned in turn by the makers. The taker sends the timed commands.
+    """
+
+    def __init__(self, depth: int, clients: int, levels: int = 1000):
+        self.book = OrderBook(TICKER)
+        self.levels = levels
+        self.makers = [make_client() for _ in range(clients)]
+        self.taker = make_client()
+        self._makers = itertools.cycle(self.makers)
+        self.order_ids: list[int] = []
+        for i in range(depth):
+            level = (i // 2) % levels
+            if i % 2 == 0:
+                self.order_ids.append(self.rest(BUY, bid_price(level)))
+            else:
+                self.order_ids.append(self.rest(SELL, ask_price(level)))
+
+    def rest(self, side: BuyOrSell, price: float) -> int:
+        """Rests an order of the next maker and returns its id."""
+        return OrderBook.place_order(TICKER, side, price, VOLUME, next(self._makers))
+
+    def refill(self, levels: list[tuple[float, int, int]]):
+        """Rests orders again until each (price, volume, orders) ask level is as it was."""
+        for price, volume, _ in levels:
+            missing = volume - self.book.asks.volume_at(price)
+            for _ in range(-(-missing // VOLUME)):
+                self.rest(SELL, price)
+
+
+class Result(NamedTuple):
+    name: str
+    depth: int
+    clients: int
+    samples: int
+    throughput: float  # commands per second
+    mean: float  # latencies in microseconds
+    p50: float
+    p99: float
+    p999: float
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}/depth={self.depth}/clients={self.clients}"
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(len(samples) * pct / 100))
+    return samples[index]
+
+
+def summarise(name: str, depth: int, clients: int, timings: list[int]) -> Result:
+    micros = sorted(ns / 1000 for ns in timings)
+    return Result(
+        name,
+        depth,
+        clients,
+        len(micros),
+        len(micros) / (sum(timings) / 1e9),
+        statistics.fmean(micros),
+        percentile(micros, 50),
+        percentile(micros, 99),
+        percentile(micros, 99.9),
+    )
+
+
+def report(result: Result):
+    print(
+        f"{result.name:<7} depth={result.depth:<7} clients={result.clients:<5} "
+        f"n={result.samples:<6} {result.throughput:>10.0f} ops/s  "
+        f"mean={result.mean:8.2f}  p50={result.p50:8.2f}  p99={result.p99:8.2f}  "
+        f"p99.9={result.p999:8.2f}"
+    )
+
+
+def timed(command: Callable, *args) -> int:
+    start = time.perf_counter_ns()
+    command(*args)
+    return time.perf_counter_ns() - start
+
+
+def bench_add(market: Market, samples: int, rng: random.Random) -> list[int]:
+    """Time resting a bid that does not cross, at a random level of the book."""
+    timings = []
+    for _ in range(samples):
+        price = bid_price(rng.randrange(market.levels))
+        start = time.perf_counter_ns()
+        order_id = OrderBook.place_order(TICKER, BUY, price, VOLUME, market.taker)
+        timings.append(time.perf_counter_ns() - start)
+        OrderBook.cancel_order(order_id)
+    return timings
+
+
+def bench_cancel(market: Market, samples: int, rng: random.Random) -> list[int]:
+    """Time cancelling random resting orders, each replaced by a new one at its price."""
+    timings = []
+    for _ in range(samples):
+        index = rng.randrange(len(market.order_ids))
+        order = Order.get_open_order(market.order_ids[index])
+        timings.append(timed(OrderBook.cancel_order, order.order_id))
+        market.order_ids[index] = market.rest(order.side, order.price)
+    return timings
+
+
+def bench_edit(market: Market, samples: int, rng: random.Random) -> list[int]:
+    """Time moving random resting orders to another random price on their side."""
+    timings = []
+    for _ in range(samples):
+        order = Order.get_open_order(rng.choice(market.order_ids))
+        level = rng.randrange(market.levels)
+        price = bid_price(level) if order.side == BUY else ask_price(level)
+        timings.append(timed(OrderBook.edit_order, order.order_id, price, VOLUME))
+    return timings
+
+
+def bench_cross(market: Market, samples: int, rng: random.Random) -> list[int]:
+    """Time a limit order filling the first resting order at the best ask."""
+    timings = []
+    for _ in range(samples):
+        levels = market.book.asks.depth(1)
+        price = levels[0][0]
+        timings.append(
+            timed(OrderBook.place_order, TICKER, BUY, price, VOLUME, market.taker)
+        )
+        market.refill(levels)
+    return timings
+
+
+def bench_sweep(
+    market: Market, samples: int, rng: random.Random, levels: int = 10
+) -> list[int]:
+    """Time a limit order filling every resting order of the best levels asks."""
+    timings = []
+    for _ in range(samples):
+        swept = market.book.asks.depth(levels)
+        price = swept[-1][0]
+        volume = sum(level_volume for _, level_volume, _ in swept)
+        timings.append(
+            timed(OrderBook.place_order, TICKER, BUY, price, volume, market.taker)
+        )
+        market.refill(swept)
+    return timings
+
+
+def bench_market(market: Market, samples: int, rng: random.Random) -> list[int]:
+    """Time a market order filling the first resting order at the best ask."""
+    timings = []
+    for _ in range(samples):
+        levels = market.book.asks.depth(1)
+        timings.append(timed(OrderBook.market_order, TICKER, BUY, VOLUME, market.taker))
+        market.refill(levels)
+    return timings
+
+
+BENCHMARKS = {
+    "add": bench_add,
+    "cancel": bench_cancel,
+    "edit": bench_edit,
+    "cross": bench_cross,
+    "sweep": bench_sweep,
+    "market": bench_market,
+}
+
+
+def run(
+    names: list[str],
+    depths: list[int],
+    clients: list[int],
+    samples: int,
+    seed: int = 0,
+) -> list[Result]:
+    """Runs every benchmark named at every depth and number of clients, reporting each result."""
+    results = []
+    for name, depth, count in itertools.product(names, depths, clients):
+        rng = random.Random(seed)
+        # the order book prints every order and transaction it handles
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            market = Market(depth, count)
+            timings = BENCHMARKS[name](market, samples, rng)
+            Transaction.journal.flush()
+        result = summarise(name, depth, count, timings)
+        report(result)
+        results.append(result)
+    return results
+
+
+def save(results: list[Result], path: str):
+    with open(path, "w") as f:
+        json.dump({result.key: result._asdict() for result in results}, f, indent=2)
+
+
+def regressions(
+    results: list[Result], baseline: dict[str, dict], tolerance: float
+) -> list[str]:
+    """
+    Returns a description of every result whose p50 or p99 latency is more than tolerance
+    (e.g. 0.25 for 25%) above the same benchmark in the baseline.
+    """
+    found = []
+    for result in results:
+        before = baseline.get(result.key)
+        if before is None:
+            continue
+        for stat in ("p50", "p99"):
+            now, then = getattr(result, stat), before[stat]
+            if now > then * (1 + tolerance):
+                found.append(
+                    f"{result.key}: {stat} {then:.2f}us -> {now:.2f}us "
+                    f"(+{(now / then - 1) * 100:.0f}%)"
+                )
+    return found
+
+
+def in_database_copy(function: Callable, *args):
+    """Runs function(*args) in a temporary folder holding a copy of the database."""
+    database = os.path.abspath("stock_market_database.db")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        if os.path.exists(database):
+            shutil.copy(database, directory)
+        os.chdir(directory)
+        try:
+            return function(*args)
+        finally:
+            Transaction.journal.close()
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for OrderBook")
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        choices=list(BENCHMARKS),
+        help="Benchmarks to run (default: all)",
+    )
+    parser.add_argument(
+        "-d",
+        "--depths",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 100_000],
+        help="Number of resting orders in the book (default: 1000 10000 100000)",
+    )
+    parser.add_argument(
+        "-c",
+        "--clients",
+        type=int,
+        nargs="+",
+        default=[1, 100],
+        help="Number of clients owning the resting orders (default: 1 100)",
+    )
+    parser.add_argument(
+        "-n",
+        "--samples",
+        type=int,
+        default=1_000,
+        help="Number of timed operations per benchmark (default: 1000)",
+    )
+    parser.add_argument(
+        "--durability",
+        choices=[mode.value for mode in DurabilityMode],
+        default="async",
+        help="How fills are written to the database copy (default: async, as the server)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="Write the results to a JSON baseline")
+    parser.add_argument(
+        "--compare", help="Compare the results to a JSON baseline saved before"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Slowdown of p50 or p99 reported as a regression (default: 0.25)",
+    )
+    args = parser.parse_args()
+
+    Transaction.journal.set_mode(DurabilityMode(args.durability))
+    names = args.benchmarks or list(BENCHMARKS)
+    results = in_database_copy(
+        run, names, args.depths, args.clients, args.samples, args.seed
+    )
+
+    if args.save:
+        save(results, args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,24 @@
+import itertools
+import shutil
+from pathlib import Path
+
+import pytest
+from database import Database
+from OrderBook.OrderBook import Client
+
+DATABASE = Path(__file__).resolve().parent.parent / "stock_market_database.db"
+_names = itertools.count()
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    # trades are written to the database, so run every test against a copy of it
+    shutil.copy(DATABASE, tmp_path / DATABASE.name)
+    monkeypatch.chdir(tmp_path)
+    yield
+    Database().close()  # connections are kept by thread until they are closed
+
+
+def make_client(balance=1_000_000, portfolio=None) -> Client:
+    name = f"test_client_{next(_names)}"
+    return Client(name, "pw", f"{name}@test.com", "Test", "Client", balance, portfolio)
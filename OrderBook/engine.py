@@ -0,0 +1,241 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, Callable, NamedTuple
+
+from database import Database
+from .OrderBook import OrderBook, BuyOrSell, Client, Instruction, Order, Transaction
+
+
+class Trade(NamedTuple):
+    """A trade as reported to the trade listeners of an engine, with the clients by username."""
+
+    transaction_id: int
+    ticker: str
+    price: float
+    vol: int
+    timestamp: datetime
+    bidder: str
+    asker: str
+    bid_order_id: int
+    ask_order_id: int
+    bid_volume_left: int  # volume of each order left to trade once this trade is made
+    ask_volume_left: int
+
+    @classmethod
+    def of(cls, transaction: Transaction) -> "Trade":
+        return cls(
+            transaction.transaction_id,
+            OrderBook.get_ticker_by_id(transaction.stock_id),
+            transaction.price,
+            transaction.vol,
+            transaction.timestamp,
+            transaction.bidder.username,
+            transaction.asker.username,
+            transaction.bid_order_id,
+            transaction.ask_order_id,
+            transaction.bid_volume_left,
+            transaction.ask_volume_left,
+        )
+
+
+class Termination(NamedTuple):
+    """An order cancelled, as reported to the termination listeners of an engine."""
+
+    order_id: int
+    ticker: str
+    username: str  # of the client of the order
+
+    @classmethod
+    def of(cls, order: Order) -> "Termination":
+        return cls(order.order_id, order.ticker, order.client.username)
+
+
+class MatchingEngine:
+    """
+    Runs every command on the order books, in the order they are submitted, on a single
+    thread of its own. Callers enqueue a command and get a future for its result, so an
+    event loop never waits for matching or for the database.
+
+    Listeners of the books and clients are called on the engine thread; wrap them with
+    on_loop to run them on the event loop instead.
+
+    Usage:
+        engine = MatchingEngine()
+        engine.start()  # from the event loop that awaits the results
+        order_id = await engine.run(OrderBook.place_order, "AAPL", BUY, 100, 10, client)
+        engine.stop()
+    """
+
+    def __init__(self):
+        self._commands: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread = None
+        self._loop: asyncio.AbstractEventLoop = None
+        self._loop_thread: int = None  # id of the thread running the event loop
+        self._trade_listeners: list[Callable[[Trade], None]] = []
+        self._on_transaction = self.on_loop(self._publish_trade)
+        self._termination_listeners: list[Callable[[Termination], None]] = []
+        self._on_termination = self.on_loop(self._publish_termination)
+
+    def start(self):
+        """Starts the engine thread, remembering the running event loop if there is one."""
+        try:
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread = threading.get_ident()
+        except RuntimeError:
+            self._loop = None
+        if not self.is_running():
+            self._thread = threading.Thread(
+                target=self._run, name="matching-engine", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        """Runs the commands already submitted, then stops the engine thread."""
+        if self.is_running():
+            self._commands.put(None)
+            self._thread.join()
+        self._thread = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def submit(self, function: Callable, *args) -> Future:
+        """Enqueues a call of function(*args) and returns the future of its result."""
+        if not self.is_running():
+            raise RuntimeError("The matching engine is not running")
+        future = Future()
+        self._commands.put((future, function, args))
+        return future
+
+    def submit_to(self, ticker: str, function: Callable, *args) -> Future:
+        """Enqueues a call of function(*args) where the book of ticker is matched."""
+        return self.submit(function, *args)
+
+    async def run(self, function: Callable, *args) -> Any:
+        """Runs function(*args) on the engine and waits for its result without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(function, *args))
+
+    async def query(self, ticker: str, function: Callable, *args) -> Any:
+        """Runs function(*args) where the book of ticker is matched and waits for its result."""
+        return await asyncio.wrap_future(self.submit_to(ticker, function, *args))
+
+    async def broadcast(self, function: Callable, *args):
+        """Runs function(*args) everywhere books are kept, e.g. to update all of them."""
+        await self.run(function, *args)
+
+    async def place_order(
+        self, ticker: str, side: BuyOrSell, price: float, volume: int, client: Client
+    ) -> int:
+        return await self.query(
+            ticker, OrderBook.place_order, ticker, side, price, volume, client
+        )
+
+    async def market_order(
+        self, ticker: str, side: BuyOrSell, volume: int, client: Client
+    ) -> int:
+        return await self.query(
+            ticker, OrderBook.market_order, ticker, side, volume, client
+        )
+
+    async def cancel_order(self, order_id: int) -> str:
+        return await self.run(OrderBook.cancel_order, order_id)
+
+    async def place_orders(
+        self, instructions: list[Instruction], client: Client
+    ) -> list[dict]:
+        """Applies a batch of instructions in one command, see OrderBook.place_orders."""
+        return await self.run(OrderBook.place_orders, instructions, client)
+
+    async def edit_order(
+        self, order_id: int, new_price: float, new_vol: int
+    ) -> tuple[int, str]:
+        return await self.run(OrderBook.edit_order, order_id, new_price, new_vol)
+
+    async def amend_order(self, order_id: int, new_price: float, new_vol: int) -> dict:
+        """Amends an order and returns its new state, see OrderBook.amend_order."""
+        return await self.run(OrderBook.amend_order, order_id, new_price, new_vol)
+
+    def add_trade_listener(self, listener: Callable[[Trade], None]):
+        """Registers a function called on the event loop with every trade made."""
+        if not self._trade_listeners:
+            Transaction.add_listener(self._transaction_made)
+        self._trade_listeners.append(listener)
+
+    def remove_trade_listener(self, listener: Callable[[Trade], None]):
+        if listener in self._trade_listeners:
+            self._trade_listeners.remove(listener)
+            if not self._trade_listeners:
+                Transaction.remove_listener(self._transaction_made)
+
+    def _transaction_made(self, transaction: Transaction):
+        self._on_transaction(Trade.of(transaction))
+
+    def _publish_trade(self, trade: Trade):
+        for listener in list(self._trade_listeners):
+            listener(trade)
+
+    def add_termination_listener(self, listener: Callable[[Termination], None]):
+        """
+        Registers a function called on the event loop with every order cancelled, whether by
+        its client, by self-trade prevention, or because its client can no longer fund it.
+        """
+        if not self._termination_listeners:
+            Order.add_listener(self._order_terminated)
+        self._termination_listeners.append(listener)
+
+    def remove_termination_listener(self, listener: Callable[[Termination], None]):
+        if listener in self._termination_listeners:
+            self._termination_listeners.remove(listener)
+            if not self._termination_listeners:
+                Order.remove_listener(self._order_terminated)
+
+    def _order_terminated(self, order: Order):
+        self._on_termination(Termination.of(order))
+
+    def _publish_termination(self, termination: Termination):
+        for listener in list(self._termination_listeners):
+            listener(termination)
+
+    def on_loop(self, callback: Callable) -> Callable:
+        """Returns a function that calls back on the event loop the engine was started from."""
+
+        def dispatch(*args):
+            if self._loop is None or threading.get_ident() == self._loop_thread:
+                callback(*args)
+            else:
+                self._loop.call_soon_threadsafe(callback, *args)
+
+        return dispatch
+
+    def _run(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                break
+            future, function, args = command
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+        Database().close()  # the connection of the engine thread
+
+
+async def call(engine: MatchingEngine, function: Callable, *args) -> Any:
+    """Runs function(*args) on the engine if there is one, or straight away otherwise."""
+    if engine is None:
+        return function(*args)
+    return await engine.run(function, *args)
+
+
+async def call_for(
+    engine: MatchingEngine, ticker: str, function: Callable, *args
+) -> Any:
+    """Runs function(*args) where the book of ticker is matched if there is an engine, or straight away otherwise."""
+    if engine is None:
+        return function(*args)
+    return await engine.query(ticker, function, *args)
@@ -0,0 +1,460 @@
+import asyncio
+import itertools
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, NamedTuple
+
+from journal import FillJournal
+from .OrderBook import *
+from .engine import MatchingEngine, Termination, Trade
+
+
+class ClientState(NamedTuple):
+    """What a shard needs to know about a client, sent in place of the client itself."""
+
+    username: str
+    email: str
+    db_id: int
+    balance: float
+    portfolio: dict[str, float]  # only the tickers of the shard
+
+
+class ShardJournal(FillJournal):
+    """Journal of a shard: the fills are handed to the parent process, which writes them."""
+
+    def __init__(self):
+        super().__init__()
+        self.fills: list[Fill] = []
+
+    def append(self, fill: Fill):
+        self.fills.append(fill)
+
+    def end_batch(self):
+        pass
+
+    def take(self) -> list[Fill]:
+        fills, self.fills = self.fills, []
+        return fills
+
+
+def _shard_main(
+    shard: int,
+    shard_count: int,
+    first_transaction_id: int,
+    tickers: list[str],
+    commands: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+):
+    """
+    Worker process of a shard: keeps the books of its tickers and runs the commands sent to
+    it in order. Every command is answered with its result, the fills to write and the
+    trades made, and the deltas of the books and the orders cancelled are forwarded as they
+    happen.
+    """
+    Transaction.journal = ShardJournal()
+    # given by the parent, as a shard starting late would see the trades of the others
+    Transaction.counter = first_transaction_id + shard
+    Transaction.counter_step = shard_count  # ids do not collide with the other shards
+    Order.counter, Order.counter_step = shard, shard_count  # nor do the order ids
+
+    for ticker in tickers:
+        book = OrderBook(ticker)
+        book.add_listener(
+            lambda delta, ticker=ticker: results.put(("delta", ticker, delta))
+        )
+
+    made: list[Transaction] = []  # transactions of the command being run
+    Transaction.add_listener(made.append)
+    # forwarded straight away, as orders purged by a sync are cancelled with no result to send
+    Order.add_listener(
+        lambda order: results.put(("terminated", None, Termination.of(order)))
+    )
+
+    # cash moved by the commands the parent has not acknowledged yet, so that a client
+    # synchronised from the parent keeps the trades made here in the meantime
+    unacknowledged: deque[tuple[int, dict[str, float]]] = deque()
+    sequence = itertools.count(1)
+
+    def replica(state: ClientState) -> Client:
+        client = Client.get_client_by_username(state.username)
+        if client is None:
+            # the holdings of the tickers of a shard only change in the shard
+            client = Client(
+                state.username,
+                "",
+                state.email,
+                "",
+                "",
+                state.balance,
+                dict(state.portfolio),
+                state.db_id,
+            )
+        return client
+
+    def synchronise(state: ClientState, acknowledged: int):
+        client = replica(state)
+        while unacknowledged and unacknowledged[0][0] <= acknowledged:
+            unacknowledged.popleft()
+        client.balance = state.balance + sum(
+            cash.get(state.username, 0) for _, cash in unacknowledged
+        )
+        client._purge_unfunded()  # cash spent in other shards may be reserved here
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        kind, request_id, payload = command
+
+        if kind == "sync":
+            states, acknowledged = payload
+            for state in states:
+                synchronise(state, acknowledged)
+            continue
+
+        states, acknowledged, function, args = payload
+        for state in states:
+            synchronise(state, acknowledged)
+        args = [replica(arg) if isinstance(arg, ClientState) else arg for arg in args]
+
+        made.clear()
+        try:
+            value, ok = function(*args), True
+        except Exception as e:
+            value, ok = e, False
+
+        trades, cash = [Trade.of(transaction) for transaction in made], {}
+        for trade in trades:
+            amount = trade.price * trade.vol
+            cash[trade.bidder] = cash.get(trade.bidder, 0) - amount
+            cash[trade.asker] = cash.get(trade.asker, 0) + amount
+        number = next(sequence)
+        if cash:
+            unacknowledged.append((number, cash))
+
+        results.put(
+            (
+                "result",
+                shard,
+                (number, request_id, ok, value, Transaction.journal.take(), trades),
+            )
+        )
+
+
+class ShardedEngine(MatchingEngine):
+    """
+    Matches the books of the tickers in worker processes, each shard owning the books of
+    some tickers, so that books of different shards are matched in parallel. Commands are
+    routed to the shard of their ticker, and the deltas of the books are forwarded to the
+    listeners of the books of the same tickers in this process, which only mirror them.
+
+    The clients stay in this process, where they are only read and changed on one thread:
+    the calls made with run or submit, e.g. to create clients, the states of the clients
+    sent to the shards, and the trades the shards report, which are written and applied to
+    the clients there. The event loop never waits for the database, and never sees a client
+    halfway through a trade. Each shard keeps a copy of the clients it matches, synchronised
+    with every order they send and after every trade. A shard owns the holdings of its
+    tickers, but cash is shared: an order is checked against the cash the shard knows of, so
+    a client trading in several shards at once may briefly spend more than it has.
+
+    Usage:
+        engine = ShardedEngine(TICKERS, shards=2)
+        engine.start()  # from the event loop that awaits the results
+        order_id = await engine.place_order("AAPL", BUY, 100, 10, client)
+        engine.stop()
+    """
+
+    def __init__(
+        self, tickers: list[str], shards: int = None, shard_map: dict[str, int] = None
+    ):
+        super().__init__()
+        if shard_map is None:
+            shards = shards or multiprocessing.cpu_count()
+            shard_map = {ticker: i % shards for i, ticker in enumerate(tickers)}
+        self.shard_map = shard_map  # ticker -> shard matching its book
+        self.shard_count = max(shard_map.values()) + 1
+
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: list[multiprocessing.Process] = []
+        self._commands: list[multiprocessing.Queue] = []
+        self._results: multiprocessing.Queue = None
+        self._reader: threading.Thread = None
+        # the thread of this process reading and changing the clients
+        self._parent: ThreadPoolExecutor = None
+
+        self._request_ids = itertools.count()
+        self._requests: dict[int, Future] = {}  # waiting for a shard
+        self._acknowledged = [0] * self.shard_count  # last result applied per shard
+
+    def start(self):
+        """Starts the shards and the thread reading their results."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        if self.is_running():
+            return
+
+        self._parent = ThreadPoolExecutor(1, thread_name_prefix="matching-parent")
+        Transaction.journal.flush()  # so that every id used is in the database
+        first_transaction_id = Transaction.journal.database().last_transaction_id() + 1
+        self._results = self._context.Queue()
+        self._commands = [self._context.Queue() for _ in range(self.shard_count)]
+        self._processes = []
+        for shard in range(self.shard_count):
+            tickers = [t for t, s in self.shard_map.items() if s == shard]
+            process = self._context.Process(
+                target=_shard_main,
+                args=(
+                    shard,
+                    self.shard_count,
+                    first_transaction_id,
+                    tickers,
+                    self._commands[shard],
+                    self._results,
+                ),
+                name=f"matching-shard-{shard}",
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+        self._reader = threading.Thread(
+            target=self._read_results, name="matching-shard-reader", daemon=True
+        )
+        self._reader.start()
+
+    def stop(self):
+        """Runs the commands already sent, then stops the shards."""
+        if not self.is_running():
+            return
+        for commands in self._commands:
+            # after the commands the parent thread is still to send
+            self._parent.submit(commands.put, None).result()
+        for process in self._processes:
+            process.join()
+        self._results.put(None)
+        self._reader.join()
+        self._processes = []
+        self._parent.shutdown()  # once the last results are applied
+
+    def is_running(self) -> bool:
+        return any(process.is_alive() for process in self._processes)
+
+    def submit(self, function: Callable, *args) -> Future:
+        """Enqueues a call of function(*args) on the clients and mirrored books of this process."""
+        if not self.is_running():
+            raise RuntimeError("The matching engine is not running")
+        return self._parent.submit(function, *args)
+
+    def submit_to(self, ticker: str, function: Callable, *args) -> Future:
+        """Sends a call of function(*args) to the shard of ticker. Clients are sent as their state."""
+        return self._send(self.shard_map[ticker], function, args)
+
+    async def run(self, function: Callable, *args) -> Any:
+        return await asyncio.wrap_future(self.submit(function, *args))
+
+    async def broadcast(self, function: Callable, *args):
+        await self.run(function, *args)
+        await asyncio.gather(
+            *(
+                asyncio.wrap_future(self._send(shard, function, args))
+                for shard in range(self.shard_count)
+            )
+        )
+
+    async def place_order(
+        self, ticker: str, side: BuyOrSell, price: float, volume: int, client: Client
+    ) -> int:
+        shard = self.shard_map[ticker]
+        future = self._send(
+            shard, OrderBook.place_order, (ticker, side, price, volume, client)
+        )
+        return await asyncio.wrap_future(future)
+
+    async def market_order(
+        self, ticker: str, side: BuyOrSell, volume: int, client: Client
+    ) -> int:
+        shard = self.shard_map[ticker]
+        future = self._send(
+            shard, OrderBook.market_order, (ticker, side, volume, client)
+        )
+        return await asyncio.wrap_future(future)
+
+    async def cancel_order(self, order_id: int) -> str:
+        future = self._send(
+            self._shard_of(order_id), OrderBook.cancel_order, (order_id,)
+        )
+        return await asyncio.wrap_future(future)
+
+    async def place_orders(
+        self, instructions: list[Instruction], client: Client
+    ) -> list[dict]:
+        """Sends the instructions of each shard to it as one batch, and puts the results back in order."""
+        results: list[dict] = [None] * len(instructions)
+        batches: dict[int, list[int]] = {}  # shard -> indexes of its instructions
+        for index, instruction in enumerate(instructions):
+            try:
+                shard = self._shard_of_instruction(instruction)
+            except ValueError as e:
+                results[index] = {"ok": False, "error": str(e)}
+                continue
+            batches.setdefault(shard, []).append(index)
+
+        futures = [
+            self._send(
+                shard,
+                OrderBook.place_orders,
+                ([instructions[index] for index in indexes], client),
+            )
+            for shard, indexes in batches.items()
+        ]
+        for indexes, batch in zip(
+            batches.values(),
+            await asyncio.gather(*(asyncio.wrap_future(f) for f in futures)),
+        ):
+            for index, result in zip(indexes, batch):
+                results[index] = result
+        return results
+
+    async def edit_order(
+        self, order_id: int, new_price: float, new_vol: int
+    ) -> tuple[int, str]:
+        future = self._send(
+            self._shard_of(order_id),
+            OrderBook.edit_order,
+            (order_id, new_price, new_vol),
+        )
+        return await asyncio.wrap_future(future)
+
+    async def amend_order(self, order_id: int, new_price: float, new_vol: int) -> dict:
+        future = self._send(
+            self._shard_of(order_id),
+            OrderBook.amend_order,
+            (order_id, new_price, new_vol),
+        )
+        return await asyncio.wrap_future(future)
+
+    def _shard_of_instruction(self, instruction: Instruction) -> int:
+        if instruction.action == "new":
+            if instruction.ticker not in self.shard_map:
+                raise ValueError(f"Ticker {instruction.ticker} not found")
+            return self.shard_map[instruction.ticker]
+        if not isinstance(instruction.order_id, int):
+            raise ValueError(f"Order {instruction.order_id} does not exist")
+        return self._shard_of(instruction.order_id)
+
+    def _shard_of(self, order_id: int) -> int:
+        """Returns the shard that made an order, whose ids are interleaved like those of the trades."""
+        if order_id < 0:
+            raise ValueError(f"Order {order_id} does not exist")
+        return order_id % self.shard_count
+
+    def _state(self, client: Client, shard: int) -> ClientState:
+        portfolio = {
+            ticker: volume
+            for ticker, volume in client.portfolio.items()
+            if self.shard_map.get(ticker) == shard
+        }
+        return ClientState(
+            client.username, client.email, client.db_id, client.balance, portfolio
+        )
+
+    def _send(self, shard: int, function: Callable, args: tuple) -> Future:
+        """Sends a call to a shard from the parent thread, where the clients are read, and returns the future of its result."""
+        if not self.is_running():
+            raise RuntimeError("The matching engine is not running")
+        future = Future()
+        self._parent.submit(self._put, future, shard, function, args)
+        return future
+
+    def _put(self, future: Future, shard: int, function: Callable, args: tuple):
+        try:
+            states = [
+                self._state(arg, shard) for arg in args if isinstance(arg, Client)
+            ]
+            args = tuple(
+                self._state(arg, shard) if isinstance(arg, Client) else arg
+                for arg in args
+            )
+        except Exception as e:
+            future.set_exception(e)
+            return
+        request_id = next(self._request_ids)
+        self._requests[request_id] = future
+        self._commands[shard].put(
+            ("call", request_id, (states, self._acknowledged[shard], function, args))
+        )
+
+    def _read_results(self):
+        """Reader thread: hands the deltas of the shards to the event loop and their results and cancelled orders to the parent thread, in order."""
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            kind, key, payload = message
+            if kind == "delta":
+                self._loop.call_soon_threadsafe(self._publish_delta, key, payload)
+            elif kind == "terminated":
+                # after the trades the shard reported before
+                self._parent.submit(self._on_termination, payload)
+            else:
+                self._parent.submit(self._complete, key, payload)
+
+    def _publish_delta(self, ticker: str, delta: dict):
+        book = OrderBook.get_book_by_ticker(ticker)
+        book.sequence = delta["sequence"]
+        for listener in list(book._listeners):
+            listener(delta)
+
+    def _complete(self, shard: int, result: tuple):
+        number, request_id, ok, value, fills, trades = result
+        for fill in fills:
+            Transaction.journal.append(fill)
+        Transaction.journal.end_batch()
+
+        changed = {}
+        # every trade was journaled as one fill, in the same order
+        for fill, trade in zip(fills, trades):
+            ticker, price, vol = trade.ticker, trade.price, trade.vol
+            Transaction.store.append(
+                trade.transaction_id,
+                trade.timestamp,
+                price,
+                vol,
+                OrderBook.get_book_by_ticker(ticker).stock_id,
+                fill.bidder_id,
+                fill.asker_id,
+            )
+            buyer = Client.get_client_by_username(trade.bidder)
+            seller = Client.get_client_by_username(trade.asker)
+            buyer.balance -= price * vol
+            buyer.portfolio[ticker] = buyer.portfolio.get(ticker, 0) + vol
+            seller.balance += price * vol
+            seller.portfolio[ticker] -= vol
+            if seller.portfolio[ticker] == 0:
+                del seller.portfolio[ticker]
+            changed[buyer.username] = buyer
+            changed[seller.username] = seller
+            if buyer != seller:
+                book = OrderBook.get_book_by_ticker(ticker)
+                book._record_price(price, trade.timestamp)
+        self._acknowledged[shard] = number
+
+        for client in changed.values():
+            client._changed()
+        if changed:
+            # the other shards matching these clients learn of their new cash
+            for other in range(self.shard_count):
+                states = [self._state(client, other) for client in changed.values()]
+                self._commands[other].put(
+                    ("sync", None, (states, self._acknowledged[other]))
+                )
+        for trade in trades:
+            self._on_transaction(trade)  # published on the event loop
+
+        future = self._requests.pop(request_id)
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
@@ -1,6 +1,11 @@
 from .OrderBook import *
+from .tickers import OPENING_PRICES, TICKS_PER_UNIT
 import random
 import string
+from collections import OrderedDict
+from typing import Iterator, NamedTuple
+
+import numpy as np
 
 """
 To keep in mind when generating test cases:
@@ -104,3 +109,260 @@ def generateTest(all_random=False, num_clients=10, num_orders=20, num_tickers=1)
     orders = generateOrders(num_orders, tickers, num_clients)
 
     return clients, orders, tickers
+
+
+"""
+Synthetic order flow, for load tests that need realistic depth rather than a few random orders.
+Events are computed with NumPy a chunk at a time and streamed, so that millions of them only
+ever take the memory of one chunk.
+"""
+
+EVENT_KINDS = ("limit", "market", "cancel")  # index of the kind of an event
+
+EVENT_DTYPE = np.dtype(
+    [
+        ("time", np.float64),  # seconds since the start of the flow
+        ("kind", np.uint8),  # index in EVENT_KINDS
+        ("ticker", np.int32),  # index in OrderFlow.tickers
+        ("side", np.int8),  # 1 to buy, -1 to sell
+        ("price", np.float64),  # limit price, 0 for market orders and cancels
+        ("volume", np.int64),
+        ("client", np.int32),  # index of the client, in [0, clients)
+        ("target", np.int64),  # index of the limit order a cancel is for, or -1
+    ]
+)
+
+
+class FlowEvent(NamedTuple):
+    index: int  # position of the event in the flow, counting from 0
+    time: float
+    kind: str  # "limit", "market" or "cancel"
+    ticker: str
+    side: BuyOrSell  # None for cancels
+    price: float  # None for market orders and cancels
+    volume: int  # None for cancels
+    client: int
+    target: int  # for cancels, the index of the limit order to cancel, if any
+
+
+class OrderFlow:
+    """
+    An endless stream of order events over many tickers:
+    - events arrive as a Poisson process, at rate events per second over all tickers, and
+      each is for a ticker picked by popularity (the i-th ticker weighs 1/i)
+    - the mid price of each ticker follows a geometric random walk, moving by volatility
+      (the standard deviation of the log price) at each of its events
+    - market_share of the events are market orders and cancel_share cancels of one of the
+      last cancel_window limit orders; the others are limit orders
+    - limit prices are clustered around the mid: a bid sits below it by an exponentially
+      distributed number of ticks of mean depth_ticks, an ask above it, and cross_share of
+      them cross the mid by as much instead
+    - volumes are log-normal around mean_volume, and clients are picked uniformly
+
+    The stream carries on from one call to the next, and is the same for the same seed.
+
+    Usage:
+        flow = OrderFlow(tickers=50, clients=1000, seed=1)
+        for chunk in flow.chunks(10_000_000):  # structured arrays of EVENT_DTYPE
+            ...
+        for event in flow.events(1000):  # or one FlowEvent at a time
+            ...
+    """
+
+    def __init__(
+        self,
+        tickers: list[str] | int = None,
+        clients: int = 100,
+        rate: float = 1000.0,
+        market_share: float = 0.05,
+        cancel_share: float = 0.3,
+        cross_share: float = 0.05,
+        depth_ticks: float = 20.0,
+        volatility: float = 0.0005,
+        mean_volume: float = 20.0,
+        cancel_window: int = 10_000,
+        chunk_size: int = 65_536,
+        seed: int = None,
+    ):
+        if tickers is None:
+            tickers = list(OPENING_PRICES)
+        elif isinstance(tickers, int):
+            tickers = [f"T{i:04d}" for i in range(tickers)]
+        if market_share + cancel_share > 1:
+            raise ValueError(
+                "Market orders and cancels cannot be more than every event"
+            )
+
+        self.tickers = tickers
+        self.clients = clients
+        self.rate = rate
+        self.market_share = market_share
+        self.cancel_share = cancel_share
+        self.cross_share = cross_share
+        self.depth_ticks = depth_ticks
+        self.volatility = volatility
+        self.mean_volume = mean_volume
+        self.cancel_window = cancel_window
+        self.chunk_size = chunk_size
+
+        self._rng = np.random.default_rng(seed)
+        popularity = 1 / np.arange(1, len(tickers) + 1)
+        self._popularity = popularity / popularity.sum()
+        self._log_mids = np.log(
+            [OPENING_PRICES.get(ticker, 50) for ticker in tickers], dtype=np.float64
+        )
+        self._time = 0.0
+        self._count = 0  # events generated so far
+        # indexes and tickers of the last cancel_window limit orders, oldest first
+        self._recent_limits = np.empty(0, np.int64)
+        self._recent_tickers = np.empty(0, np.int32)
+
+    def mid(self, ticker: str) -> float:
+        """Returns the mid price of a ticker, as of the last event generated."""
+        return float(np.exp(self._log_mids[self.tickers.index(ticker)]))
+
+    def chunks(self, count: int) -> Iterator[np.ndarray]:
+        """Yields the next count events, as structured arrays of at most chunk_size events."""
+        while count > 0:
+            size = min(count, self.chunk_size)
+            yield self._chunk(size)
+            count -= size
+
+    def events(self, count: int) -> Iterator[FlowEvent]:
+        """Yields the next count events one at a time."""
+        for chunk in self.chunks(count):
+            first = self._count - len(chunk)
+            for offset, row in enumerate(chunk.tolist()):
+                time, kind, ticker, side, price, volume, client, target = row
+                kind = EVENT_KINDS[kind]
+                yield FlowEvent(
+                    first + offset,
+                    time,
+                    kind,
+                    self.tickers[ticker],
+                    None if kind == "cancel" else BUY if side > 0 else SELL,
+                    price if kind == "limit" else None,
+                    None if kind == "cancel" else volume,
+                    client,
+                    target if target >= 0 else None,
+                )
+
+    def _chunk(self, size: int) -> np.ndarray:
+        rng = self._rng
+        events = np.zeros(size, EVENT_DTYPE)
+        index = self._count + np.arange(size)
+
+        events["time"] = self._time + np.cumsum(rng.exponential(1 / self.rate, size))
+        self._time = float(events["time"][-1])
+        kind = rng.choice(
+            3,
+            size,
+            p=[
+                1 - self.market_share - self.cancel_share,
+                self.market_share,
+                self.cancel_share,
+            ],
+        ).astype(np.uint8)
+        events["kind"] = kind
+        ticker = rng.choice(len(self.tickers), size, p=self._popularity).astype(
+            np.int32
+        )
+        events["ticker"] = ticker
+        side = np.where(rng.random(size) < 0.5, 1, -1).astype(np.int8)
+        events["side"] = side
+        events["client"] = rng.integers(0, self.clients, size)
+
+        # every event moves the mid of its ticker, so the mids are running sums per ticker
+        steps = rng.normal(0, self.volatility, size)
+        order = np.argsort(ticker, kind="stable")
+        sums = np.cumsum(steps[order])
+        starts = np.flatnonzero(np.r_[True, np.diff(ticker[order]) != 0])
+        lengths = np.diff(np.r_[starts, size])
+        before = np.repeat(sums[starts] - steps[order][starts], lengths)
+        log_mids = np.empty(size)
+        log_mids[order] = self._log_mids[ticker[order]] + sums - before
+        ends = starts + lengths - 1
+        self._log_mids[ticker[order][ends]] = log_mids[order][ends]
+
+        # limit prices, in ticks away from the mid on their side unless they cross it
+        distance = np.floor(rng.exponential(self.depth_ticks, size))
+        distance[rng.random(size) < self.cross_share] *= -1
+        ticks = np.rint(np.exp(log_mids) * TICKS_PER_UNIT) - side * distance
+        limit = kind == 0
+        events["price"] = np.where(limit, np.maximum(ticks, 1) / TICKS_PER_UNIT, 0)
+
+        volume = np.rint(rng.lognormal(np.log(self.mean_volume), 0.75, size))
+        events["volume"] = np.where(kind == 2, 0, np.maximum(volume, 1))
+
+        # a cancel is for one of the last cancel_window limit orders made before it
+        limits = np.concatenate([self._recent_limits, index[limit]])
+        limit_tickers = np.concatenate([self._recent_tickers, ticker[limit]])
+        made_before = len(self._recent_limits) + np.cumsum(limit) - limit
+        cancel = kind == 2
+        available = np.minimum(made_before[cancel], self.cancel_window)
+        back = np.floor(rng.random(cancel.sum()) * available).astype(np.int64)
+        position = made_before[cancel] - 1 - back
+        found = available > 0
+        target = np.full(cancel.sum(), -1, np.int64)
+        target[found] = limits[position[found]]
+        events["target"] = -1
+        events["target"][cancel] = target
+        events["ticker"][np.flatnonzero(cancel)[found]] = limit_tickers[position[found]]
+
+        self._recent_limits = limits[-self.cancel_window :]
+        self._recent_tickers = limit_tickers[-self.cancel_window :]
+        self._count += size
+        return events
+
+
+def generateFlowClients(flow: OrderFlow, balance=1_000_000_000, shares=1_000_000):
+    """
+    Makes the order books of the tickers of a flow, if need be, and generates its clients,
+    funded well enough to place every order of it.
+    """
+    for ticker in flow.tickers:
+        if ticker not in OrderBook._tickers:
+            OrderBook(ticker)
+    return [
+        Client(
+            f"flow_{generate_random_string()}_{i}",
+            generate_random_string(),
+            f"flow_{generate_random_string()}_{i}@example.com",
+            "Flow",
+            f"Client{i}",
+            balance,
+            {ticker: shares for ticker in flow.tickers},
+        )
+        for i in range(flow.clients)
+    ]
+
+
+def replayFlow(flow: OrderFlow, count: int, clients: list[Client]) -> dict[str, int]:
+    """
+    Places the next count events of a flow in the order books, for the clients generated by
+    generateFlowClients, and returns how many events of each outcome there were. Only the ids
+    of the last cancel_window limit orders are kept, which is all the cancels can target.
+    """
+    outcomes = {"limit": 0, "market": 0, "cancel": 0, "rejected": 0, "missed": 0}
+    order_ids: OrderedDict[int, int] = OrderedDict()  # event index -> order id
+    for event in flow.events(count):
+        client = clients[event.client % len(clients)]
+        try:
+            if event.kind == "limit":
+                order_ids[event.index] = OrderBook.place_order(
+                    event.ticker, event.side, event.price, event.volume, client
+                )
+                if len(order_ids) > flow.cancel_window:
+                    order_ids.popitem(last=False)
+            elif event.kind == "market":
+                OrderBook.market_order(event.ticker, event.side, event.volume, client)
+            elif event.target in order_ids:
+                OrderBook.cancel_order(order_ids[event.target])
+            else:
+                outcomes["missed"] += 1  # the order it was for was rejected
+                continue
+        except ValueError:
+            outcomes["rejected"] += 1
+            continue
+        outcomes[event.kind] += 1
+    return outcomes
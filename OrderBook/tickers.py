@@ -1,3 +1,5 @@
 TICKERS = ["AAPL", "GOOG", "TSLA"]
 
 OPENING_PRICES = {"AAPL": 210, "GOOG": 60, "TSLA": 150}
+
+TICKS_PER_UNIT = 100  # prices are whole multiples of 0.01
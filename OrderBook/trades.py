@@ -0,0 +1,161 @@
+from datetime import datetime, timezone, timedelta
+from typing import NamedTuple
+
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# name and type of each column of the store, in the order of a row
+COLUMNS = (
+    ("transaction_id", np.int64),
+    ("timestamp", np.int64),  # nanoseconds since the epoch
+    ("price", np.float64),
+    ("vol", np.int64),
+    ("stock_id", np.int32),
+    ("bidder_id", np.int64),  # ids of the clients in the database
+    ("asker_id", np.int64),
+)
+
+
+def to_nanoseconds(timestamp: datetime) -> int:
+    """Returns an aware datetime as nanoseconds since the epoch, without going through a float."""
+    return (timestamp - EPOCH) // timedelta(microseconds=1) * 1000
+
+
+def from_nanoseconds(nanoseconds: int) -> datetime:
+    return EPOCH + timedelta(microseconds=int(nanoseconds) // 1000)
+
+
+class TradeRecord(NamedTuple):
+    """A row of the trade store."""
+
+    transaction_id: int
+    timestamp: datetime
+    price: float
+    vol: int
+    stock_id: int
+    bidder_id: int
+    asker_id: int
+
+
+class TradeStore:
+    """
+    The most recent transactions, kept column by column in NumPy arrays used as a ring
+    buffer: once capacity transactions are kept, each new one overwrites the oldest. The
+    memory used is fixed, and queries over the window are vectorised.
+
+    Transactions are appended as they are completed. When matching is split between
+    processes, their ids are interleaved and their timestamps only nearly ordered, so
+    transactions are found by id through the slot holding them, never by bisection.
+
+    Usage:
+        store = TradeStore(capacity=100_000)
+        store.append(transaction_id, timestamp, price, vol, stock_id, bidder_id, asker_id)
+        columns = store.between(start, end, stock_id=0)  # { column -> array }
+    """
+
+    def __init__(self, capacity: int = 100_000):
+        if capacity <= 0:
+            raise ValueError("The capacity of a trade store must be positive")
+        self.capacity = capacity
+        self._columns = {name: np.zeros(capacity, dtype) for name, dtype in COLUMNS}
+        self._count = 0  # transactions appended so far, including the overwritten ones
+        self._slots: dict[int, int] = {}  # transaction id -> index in the arrays
+        self._kept_from: int = None  # nanoseconds from which every transaction is kept
+
+    def __len__(self) -> int:
+        return min(self._count, self.capacity)
+
+    def append(
+        self,
+        transaction_id: int,
+        timestamp: datetime,
+        price: float,
+        vol: int,
+        stock_id: int,
+        bidder_id: int,
+        asker_id: int,
+    ):
+        row = (
+            transaction_id,
+            to_nanoseconds(timestamp),
+            price,
+            vol,
+            stock_id,
+            bidder_id,
+            asker_id,
+        )
+        index = self._count % self.capacity
+        if self._count >= self.capacity:
+            overwritten = self._columns["transaction_id"][index].item()
+            if self._slots.get(overwritten) == index:
+                del self._slots[overwritten]
+            # the next microsecond, as timestamps are only as precise as that
+            overwritten_at = self._columns["timestamp"][index].item() + 1000
+            self._kept_from = max(self._kept_from, overwritten_at)
+        elif self._kept_from is None:
+            self._kept_from = row[1]
+        else:  # nothing is overwritten yet, so everything made since the earliest is kept
+            self._kept_from = min(self._kept_from, row[1])
+        self._slots[transaction_id] = index
+        for (name, _), value in zip(COLUMNS, row):
+            self._columns[name][index] = value
+        self._count += 1
+
+    def _segments(self) -> list[slice]:
+        """Returns the parts of the arrays holding transactions, oldest first."""
+        if self._count <= self.capacity:
+            return [slice(0, self._count)]
+        start = self._count % self.capacity
+        return [slice(start, self.capacity), slice(0, start)]
+
+    def column(self, name: str) -> np.ndarray:
+        """Returns a column of every transaction kept, oldest first."""
+        segments = self._segments()
+        if len(segments) == 1:
+            return self._columns[name][segments[0]].copy()
+        return np.concatenate([self._columns[name][part] for part in segments])
+
+    def columns(self) -> dict[str, np.ndarray]:
+        return {name: self.column(name) for name, _ in COLUMNS}
+
+    def oldest(self) -> TradeRecord | None:
+        """Returns the transaction kept that was appended first."""
+        if not self:
+            return None
+        return self._row(self._segments()[0].start)
+
+    def kept_from(self) -> datetime | None:
+        """
+        Returns the time from which every transaction appended is still kept, or None if
+        none is: those made before it may have been overwritten, or made before the first.
+        """
+        if self._kept_from is None:
+            return None
+        return from_nanoseconds(self._kept_from)
+
+    def get(self, transaction_id: int) -> TradeRecord | None:
+        """Returns a transaction if it is kept."""
+        index = self._slots.get(transaction_id)
+        if index is None:
+            return None
+        return self._row(index)
+
+    def between(
+        self, start: datetime = None, end: datetime = None, stock_id: int = None
+    ) -> dict[str, np.ndarray]:
+        """Returns the columns of the transactions kept made in [start, end), of one stock if given."""
+        columns = self.columns()
+        keep = np.ones(len(self), dtype=bool)
+        if start is not None:
+            keep &= columns["timestamp"] >= to_nanoseconds(start)
+        if end is not None:
+            keep &= columns["timestamp"] < to_nanoseconds(end)
+        if stock_id is not None:
+            keep &= columns["stock_id"] == stock_id
+        return {name: column[keep] for name, column in columns.items()}
+
+    def _row(self, index: int) -> TradeRecord:
+        values = [self._columns[name][index].item() for name, _ in COLUMNS]
+        values[1] = from_nanoseconds(values[1])
+        return TradeRecord(*values)
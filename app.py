@@ -1,14 +1,20 @@
 import asyncio
 import json
-from fastapi import FastAPI, WebSocket
+import os
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import RedirectResponse
-from fastapi.encoders import jsonable_encoder
 from OrderBook.OrderBook import *
 from OrderBook.tickers import *
+from OrderBook.engine import MatchingEngine
+from OrderBook.shards import ShardedEngine
 from pydantic import BaseModel
 from database import Database
+from journal import DurabilityMode
+from market_data import DeltaFeed, SnapshotPublisher
+from client_info import ClientInfoPublisher
+from order_entry import OrderEntrySession, login
 import new_user_portfolio as new_user
 from datetime import datetime, timezone, timedelta
 
@@ -24,9 +30,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Fills are written to the database by a background writer by default, so matching never waits on the disk
+Transaction.journal.set_mode(DurabilityMode(os.environ.get("FILL_DURABILITY", "async")))
+
 # Initialize order books
 order_books = [OrderBook(ticker) for ticker in TICKERS]
 
+# Once started, the order books and clients are only read and changed on the engine thread,
+# so that the endpoints never block the event loop on matching or on the database
+# With MATCHING_SHARDS=n, the books are matched in n worker processes instead, and the books here only mirror them
+matching_shards = int(os.environ.get("MATCHING_SHARDS", "0"))
+if matching_shards > 0:
+    matching_engine = ShardedEngine(TICKERS, shards=matching_shards)
+else:
+    matching_engine = MatchingEngine()
+
+# Builds the order book summary once a second for all the /ws subscribers
+market_data_publisher = SnapshotPublisher(TICKERS, engine=matching_engine)
+# Sends the changes of the order books as they happen to the /ws/market_data subscribers
+market_data_feed = DeltaFeed(TICKERS, engine=matching_engine)
+# Sends the client information to the /client_info subscribers when it changes, at most once per interval
+client_info_publisher = ClientInfoPublisher(
+    TICKERS,
+    interval=float(os.environ.get("CLIENT_INFO_INTERVAL", "1")),
+    engine=matching_engine,
+)
+
 # Two example users
 client1 = Client(
     "tapple", "pw", "timcook@aol.com", "Tim", "Cook", balance=1_000_000_000
@@ -105,7 +134,7 @@ async def place_order(order: PlaceOrderRequest):
 
     print(f"Placing order for stock {ticker}: {side} at {price} for {volume} shares")
     order_side = BUY if side.lower() == "buy" else SELL
-    return OrderBook.place_order(ticker, order_side, price, volume, client)
+    return await matching_engine.place_order(ticker, order_side, price, volume, client)
 
 
 class MarketOrderRequest(BaseModel):
@@ -141,7 +170,7 @@ async def market_order(order: MarketOrderRequest):
         f"Placing order for stock {ticker}: {side} at market price for {volume} shares"
     )
     order_side = BUY if side.lower() == "buy" else SELL
-    return OrderBook.market_order(ticker, order_side, volume, client)
+    return await matching_engine.market_order(ticker, order_side, volume, client)
 
 
 @app.post("/api/cancel_order")
@@ -158,7 +187,7 @@ async def cancel_order(order_id: int):
 
     print(f"Cancelling order {order_id}")
     # print(OrderBook.cancel_order(order_id))
-    return OrderBook.cancel_order(order_id)
+    return await matching_engine.cancel_order(order_id)
 
 
 @app.post("/api/edit_order")
@@ -175,10 +204,85 @@ async def edit_order(order_id: int, price: float, volume: int):
     - success message if successful, or an error message.
     """
     print(f"Editing order {order_id}: new price {price}, new volume {volume}")
-    OrderBook.edit_order(order_id, price, volume)
+    await matching_engine.edit_order(order_id, price, volume)
     return "success"  # TODO Placeholder until we decide what to return
 
 
+@app.post("/api/amend_order")
+async def amend_order(order_id: int, price: float, volume: int):
+    """
+    Amend an existing order for a stock. An order keeping its price and not growing keeps
+    its place in the queue, otherwise it is placed again at its new price.
+
+    Parameters:
+    - order_id: The ID of the order to amend.
+    - price: The new price for the order.
+    - volume: The new volume for the order.
+
+    Returns:
+    - the state of the order once amended: order_id, ticker, side, price, volume (left),
+      executed_volume, volume_change, priority_kept and terminated.
+    """
+    print(f"Amending order {order_id}: new price {price}, new volume {volume}")
+    return await matching_engine.amend_order(order_id, price, volume)
+
+
+class OrderInstruction(BaseModel):
+    action: str  # new, cancel, replace or amend
+    ticker: str | None = None
+    side: str | None = None
+    price: float | None = None
+    volume: int | None = None
+    order_id: int | None = None
+
+
+class BatchOrderRequest(BaseModel):
+    client_user: str
+    orders: list[OrderInstruction]
+
+
+@app.post("/api/orders/batch")
+async def place_orders(batch: BatchOrderRequest):
+    """
+    Apply a batch of order instructions of a client in one pass, e.g. to quote both sides at once.
+
+    Parameters:
+    - client_user: The username of the client sending the instructions.
+    - orders: The instructions, applied in order. Each has an action:
+        - new: place a limit order, with ticker, side, price and volume.
+        - cancel: cancel the order with order_id.
+        - replace: change the price and volume of the order with order_id.
+        - amend: the same as replace, keeping the place in the queue when possible.
+
+    Returns:
+    - a list with the result of each instruction, {"ok": true, "result": ...} where result is
+      what /api/place_order, /api/cancel_order, /api/edit_order or /api/amend_order would
+      return, or {"ok": false, "error": ...}.
+    """
+    client = Client.get_client_by_username(batch.client_user)
+
+    if client is None:
+        raise ValueError(f"Client with username {batch.client_user} not found.")
+
+    instructions = [
+        Instruction(
+            order.action,
+            order.ticker,
+            (
+                None
+                if order.side is None
+                else BUY if order.side.lower() == "buy" else SELL
+            ),
+            order.price,
+            order.volume,
+            order.order_id,
+        )
+        for order in batch.orders
+    ]
+    print(f"Applying {len(instructions)} order instructions of {client.username}")
+    return await matching_engine.place_orders(instructions, client)
+
+
 @app.get("/api/get_best_bid")
 async def get_best_bid(ticker: str):
     """
@@ -192,7 +296,7 @@ async def get_best_bid(ticker: str):
     """
 
     print(f"Getting best bid for stock {ticker}")
-    return OrderBook.get_best_bid(ticker)
+    return await matching_engine.query(ticker, OrderBook.get_best_bid, ticker)
 
 
 @app.get("/api/get_best_ask")
@@ -208,7 +312,7 @@ async def get_best_ask(ticker: str):
     """
 
     print(f"Getting best ask for stock {ticker}")
-    return OrderBook.get_best_ask(ticker)
+    return await matching_engine.query(ticker, OrderBook.get_best_ask, ticker)
 
 
 @app.get("/api/get_best")
@@ -224,7 +328,7 @@ async def get_best(ticker: str):
     """
 
     print(f"Getting best bid and ask for stock {ticker}")
-    best_bid, best_ask = OrderBook.get_best(ticker)
+    best_bid, best_ask = await matching_engine.query(ticker, OrderBook.get_best, ticker)
     return {
         "best_bid": best_bid,
         "best_ask": best_ask,
@@ -246,7 +350,34 @@ async def get_volume_at_price(ticker: str, side: str, price: float):
 
     print(f"Getting volume at price {price} for stock {ticker}")
     order_side = BUY if side.lower() == "buy" else SELL
-    return OrderBook.get_volume_at_price(ticker, order_side, price)
+    return await matching_engine.query(
+        ticker, OrderBook.get_volume_at_price, ticker, order_side, price
+    )
+
+
+@app.get("/api/get_depth")
+async def get_depth(ticker: str, side: str, levels: int | None = None):
+    """
+    Get the aggregated depth of one side of the order book for a stock.
+
+    Parameters:
+    - ticker: The ticker of the order book.
+    - side: The side of the order book (buy/sell).
+    - levels: The number of price levels to return, best price first (all if omitted).
+
+    Returns:
+    - list of price levels with their total volume and number of orders.
+    """
+
+    print(f"Getting depth for stock {ticker}")
+    order_side = BUY if side.lower() == "buy" else SELL
+    depth = await matching_engine.query(
+        ticker, OrderBook.get_depth, ticker, order_side, levels
+    )
+    return [
+        {"price": price, "volume": volume, "orders": orders}
+        for price, volume, orders in depth
+    ]
 
 
 @app.get("/api/get_all_asks")
@@ -262,7 +393,7 @@ async def get_all_asks(ticker: str):
     """
 
     print(f"Getting all asks for stock {ticker}")
-    all_asks = OrderBook.get_all_asks(ticker)
+    all_asks = await matching_engine.query(ticker, OrderBook.get_all_asks, ticker)
     print(all_asks)
     return [
         {
@@ -289,7 +420,7 @@ async def get_all_bids(ticker: str):
     """
 
     print(f"Getting all bids for stock {ticker}")
-    all_bids = OrderBook.get_all_bids(ticker)
+    all_bids = await matching_engine.query(ticker, OrderBook.get_all_bids, ticker)
     print(all_bids)
     return [
         {
@@ -312,13 +443,28 @@ async def get_client_by_email(email: str):
     - email: The email we are looking for.
 
     Returns:
-    - The object of the client if it exists or None otherwise.
+    - The details of the client if it exists or None otherwise.
     """
 
     print(f"Getting information for client with email {email}")
     client = Client.get_client_by_email(email)
     print(client)
-    return client
+    return await matching_engine.run(client_details, client)
+
+
+def client_details(client: Client) -> dict | None:
+    """Returns what the endpoints send about a client, which cannot be encoded as it is once it has resting orders."""
+    if client is None:
+        return None
+    return {
+        "client_id": client.client_id,
+        "username": client.username,
+        "email": client.email,
+        "first_names": client.first_names,
+        "last_name": client.last_name,
+        "balance": client.balance,
+        "portfolio": dict(client.portfolio),
+    }
 
 
 class ClientData(BaseModel):
@@ -338,8 +484,14 @@ async def add_new_client(client_data: ClientData):
     - email, first name and last name
 
     Returns:
-    - The object of the client
+    - The details of the client
     """
+    # the new client reads the order books and the database, so it is made on the engine
+    client = await matching_engine.run(find_or_create_client, client_data)
+    return await matching_engine.run(client_details, client)
+
+
+def find_or_create_client(client_data: ClientData) -> Client:
     queryClient = Client.get_client_by_email(client_data.email)
 
     if queryClient != None:
@@ -359,6 +511,7 @@ async def add_new_client(client_data: ClientData):
                 client_data.last_name,
                 Database().retrieve_balance(details[0]),
                 dic,
+                db_id=details[0],
             )
         else:
             client = Client(
@@ -377,62 +530,120 @@ async def add_new_client(client_data: ClientData):
                 client_data.first_name,
                 client_data.last_name,
             )
+            client.set_db_id(id)
             for stock, volume in new_user.stocks.items():
                 Database().create_owned_stock(id, stock, volume)
         return client
 
 
 # Websocket used to get information about the orderbook once a second
+# By default every resting order of every ticker is sent. Send {"type": "subscribe", "ticker": ticker, "depth": n}
+# to only get the tickers subscribed to, with their best n levels aggregated by price (all levels without depth),
+# and {"type": "unsubscribe", "ticker": ticker} to stop getting a ticker
 @app.websocket("/ws")
 async def websocket_endpoint(
     websocket: WebSocket,
 ):  # Note: Place some orders before testing this
     await websocket.accept()
     try:
-        summary = dict()
         print(f"Client subscribed to order book")
+        if market_data_publisher.last_snapshot is not None:
+            await websocket.send_text(market_data_publisher.last_snapshot)
+        market_data_publisher.subscribe(websocket)
+        # the publisher sends the updates, this only handles the subscriptions
         while True:
-            for ticker in TICKERS:
-                best_bid = OrderBook.get_best_bid(ticker)
-                best_ask = OrderBook.get_best_ask(ticker)
-                all_bids = OrderBook.get_all_bids(ticker)
-                all_asks = OrderBook.get_all_asks(ticker)
-                last_price = OrderBook.get_last_price(ticker)
-                last_timestamp = OrderBook.get_last_timestamp(ticker)
-                pnl = OrderBook.calculate_pnl_24h(ticker)
-                summary[ticker] = {
-                    "ticker": ticker,
-                    "best_bid": best_bid,
-                    "best_ask": best_ask,
-                    "all_bids": [
-                        {
-                            "order_id": order_id,
-                            "timestamp": timestamp,
-                            "price": price,
-                            "volume": volume,
-                            "stock_id": stock_id,
-                        }
-                        for order_id, timestamp, price, volume, stock_id in all_bids
-                    ],
-                    "all_asks": [
-                        {
-                            "order_id": order_id,
-                            "timestamp": timestamp,
-                            "price": price,
-                            "volume": volume,
-                            "stock_id": stock_id,
-                        }
-                        for order_id, timestamp, price, volume, stock_id in all_asks
-                    ],
-                    "last_price": last_price,
-                    "last_timestamp": last_timestamp,
-                    "pnl": pnl,
-                }
-            encoded = jsonable_encoder(summary)
-            await websocket.send_text(json.dumps(encoded))
-            await asyncio.sleep(1)  # Updates pushed every second
+            request = json.loads(await websocket.receive_text())
+            ticker = request.get("ticker")
+            depth = request.get("depth")
+            if ticker not in TICKERS:
+                await websocket.send_text(
+                    json.dumps({"error": f"Ticker {ticker} not found"})
+                )
+            elif depth is not None and (not isinstance(depth, int) or depth <= 0):
+                await websocket.send_text(
+                    json.dumps({"error": "Depth must be a positive integer"})
+                )
+            elif request.get("type") == "subscribe":
+                market_data_publisher.subscribe(websocket, ticker, depth)
+                # send the new subscription straight away rather than on the next tick
+                await websocket.send_text(
+                    await market_data_publisher.snapshot(
+                        market_data_publisher.subscribers[websocket]
+                    )
+                )
+            elif request.get("type") == "unsubscribe":
+                market_data_publisher.unsubscribe(websocket, ticker)
+    except WebSocketDisconnect:
+        print(f"Client unsubscribed from order book")
     except Exception as e:
         print(f"OrderBook WebSocket error: {e}")
+    finally:
+        market_data_publisher.unsubscribe(websocket)
+
+
+# Websocket streaming a snapshot of every order book, then the deltas of the books as they change
+# Send {"type": "snapshot", "ticker": ticker} to get a new snapshot after a gap in the sequence numbers
+@app.websocket("/ws/market_data")
+async def market_data_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    queue = market_data_feed.subscribe()
+
+    async def send_updates():
+        while True:
+            await websocket.send_text(await queue.get())
+
+    sender = asyncio.create_task(send_updates())
+    try:
+        while True:
+            request = json.loads(await websocket.receive_text())
+            if request.get("type") == "snapshot" and request.get("ticker") in TICKERS:
+                market_data_feed.request_snapshot(queue, request["ticker"])
+    except WebSocketDisconnect:
+        print(f"Client unsubscribed from market data")
+    except Exception as e:
+        print(f"Market data WebSocket error: {e}")
+    finally:
+        sender.cancel()
+        market_data_feed.unsubscribe(queue)
+
+
+# Order entry session: log in once with {"type": "login", "client_user": username, "password": password}, then send
+# {"type": "new", "client_order_id": id, "ticker": ticker, "side": side, "price": price, "volume": volume},
+# {"type": "cancel", "client_order_id": id, "orig_client_order_id": id} (or "order_id": order_id) and
+# {"type": "replace", "client_order_id": id, "orig_client_order_id": id, "price": price, "volume": volume}
+# A replaced order keeps its place in the queue if its price is unchanged and its volume does not grow
+# Every instruction is answered with an execution report, and the fills of the client's orders are reported as they happen
+@app.websocket("/ws/orders")
+async def order_entry_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        client = login(json.loads(await websocket.receive_text()))
+    except (ValueError, AttributeError) as e:
+        await websocket.send_text(
+            json.dumps({"type": "login", "ok": False, "error": str(e)})
+        )
+        await websocket.close()
+        return
+    await websocket.send_text(json.dumps({"type": "login", "ok": True}))
+    print(f"Order entry session opened for {client.username}")
+
+    session = OrderEntrySession(matching_engine, client)
+
+    async def send_reports():
+        while True:
+            await websocket.send_text(await session.reports.get())
+
+    sender = asyncio.create_task(send_reports())
+    try:
+        while True:
+            await session.handle(await websocket.receive_text())
+    except WebSocketDisconnect:
+        print(f"Order entry session closed for {client.username}")
+    except Exception as e:
+        print(f"Order entry WebSocket error: {e}")
+    finally:
+        sender.cancel()
+        session.close()
 
 
 @app.websocket("/client_info")
@@ -455,22 +666,22 @@ async def client_info_websocket(websocket: WebSocket):
             await websocket.close()
             return
 
-        # Periodically send client information
-        while True:
-            pval = OrderBook.portfolio_value(client)
-            pnl = {}
-            portfolioPnl = OrderBook.portfolio_pnl(client)
-            for ticker in TICKERS:
-                pnl[ticker] = OrderBook.calculate_pnl_24h(ticker)
-            client_info = {
-                "balance": client.balance,
-                "portfolio": client.portfolio,
-                "portfolioValue": pval,
-                "pnlInfo": pnl,
-                "portfolioPnl": portfolioPnl,
-            }
-            await websocket.send_text(json.dumps(client_info))
-            await asyncio.sleep(1)  # Send updates every second
+        # Send the client information whenever it changes
+        subscription = client_info_publisher.subscribe(client)
+
+        async def send_updates():
+            while True:
+                await websocket.send_text(await subscription.next())
+
+        sender = asyncio.create_task(send_updates())
+        try:
+            while True:
+                await websocket.receive_text()  # until the client disconnects
+        finally:
+            sender.cancel()
+            client_info_publisher.unsubscribe(subscription)
+    except WebSocketDisconnect:
+        print(f"Client unsubscribed from information")
     except Exception as e:
         print(f"Client Info WebSocket error: {e}")
 
@@ -483,7 +694,7 @@ async def update_hourly_stock_data():
         )
         sleep_seconds = (next_hour - now).total_seconds()
         await asyncio.sleep(sleep_seconds)
-        OrderBook.update_all_last_times(next_hour)
+        await matching_engine.broadcast(OrderBook.update_all_last_times, next_hour)
 
 
 async def update_daily_portfolio_value():
@@ -494,13 +705,29 @@ async def update_daily_portfolio_value():
         )
         sleep_seconds = (next_day - now).total_seconds()
         await asyncio.sleep(sleep_seconds)
-        Client.update_all_daily_portfolio()
+        await matching_engine.run(Client.update_all_daily_portfolio)
 
 
 @app.on_event("startup")
 async def startup_event():
+    matching_engine.start()
+    # What happens when an order would trade with an order of the same client: skip, cancel_newest or cancel_oldest
+    await matching_engine.broadcast(
+        OrderBook.set_self_trade_prevention,
+        SelfTradePrevention(os.environ.get("SELF_TRADE_PREVENTION", "skip")),
+    )
     asyncio.create_task(update_hourly_stock_data())
     asyncio.create_task(update_daily_portfolio_value())
+    market_data_publisher.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    market_data_publisher.stop()
+    matching_engine.stop()
+    # write the fills that are still in the journal before exiting
+    Transaction.journal.close()
+    Database().close()
 
 
 # # *** Code for AR(1) price model
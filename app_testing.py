@@ -0,0 +1,91 @@
+# --------------------------------------------------------------------------------------------------------------
+# Module to test the endpoints of app.py that return clients
+# Every test runs in a directory holding a copy of the database, since new clients are written to it
+# --------------------------------------------------------------------------------------------------------------
+import os, shutil, tempfile, unittest
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+DATABASE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "stock_market_database.db"
+)
+
+# the app loads its order books when it is imported, so it is imported against a copy of the database too,
+# with fills written as they are made and a single engine thread
+_imported = tempfile.TemporaryDirectory()
+shutil.copy(DATABASE, _imported.name)
+_path = os.path.join(_imported.name, "stock_market_database.db")
+with patch.dict(os.environ, {"FILL_DURABILITY": "sync", "MATCHING_SHARDS": "0"}):
+    with patch("database.DATABASE_PATH", _path):
+        from app import *
+Database(_path).close()
+
+
+class TestClientEndpoints(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        shutil.copy(DATABASE, self.directory.name)
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        matching_engine.start()
+        self.http = TestClient(app)  # without the startup and shutdown events
+
+        name = f"app_{self._testMethodName}"
+        self.client = Client(name, "pw", f"{name}@test.com", "A", "Pp", 1_000_000)
+        self.client.portfolio["AAPL"] = 100
+
+    def tearDown(self):
+        matching_engine.submit(lambda: Database().close()).result()
+        matching_engine.stop()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    # Test that a client with resting orders is returned as its details
+    def test_client_with_resting_orders(self):
+        matching_engine.submit(
+            OrderBook.place_order, "AAPL", BUY, 1, 10, self.client
+        ).result()
+        matching_engine.submit(
+            OrderBook.place_order, "AAPL", SELL, 10_000, 5, self.client
+        ).result()
+        details = {
+            "client_id": self.client.client_id,
+            "username": self.client.username,
+            "email": self.client.email,
+            "first_names": "A",
+            "last_name": "Pp",
+            "balance": 1_000_000,
+            "portfolio": {"AAPL": 100},
+        }
+
+        response = self.http.get(
+            "/api/get_client_by_email", params={"email": self.client.email}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), details)
+
+        # a returning user logs in with the same endpoint as a new one
+        response = self.http.post(
+            "/api/add_new_client",
+            json={"email": self.client.email, "first_name": "A", "last_name": "Pp"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), details)
+
+    # Test that a new user is created and returned, and an unknown email gives nothing
+    def test_new_client(self):
+        email = f"app_{self._testMethodName}_new@test.com"
+        response = self.http.get("/api/get_client_by_email", params={"email": email})
+        self.assertIsNone(response.json())
+
+        response = self.http.post(
+            "/api/add_new_client",
+            json={"email": email, "first_name": "N", "last_name": "Ew"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["username"], email)
+        self.assertEqual(response.json()["balance"], new_user.money)
+
+
+if __name__ == "__main__":
+    unittest.main()
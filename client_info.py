@@ -0,0 +1,129 @@
+import asyncio
+import json
+import time
+from OrderBook.OrderBook import *
+from OrderBook.engine import MatchingEngine, call
+
+
+def client_summary(client: Client, tickers: list[str]) -> dict:
+    """Returns the information about a client sent on /client_info."""
+    return {
+        "balance": client.balance,
+        "portfolio": dict(client.portfolio),  # a copy, as it is encoded elsewhere
+        "portfolioValue": OrderBook.portfolio_value(client),
+        "pnlInfo": {ticker: OrderBook.calculate_pnl_24h(ticker) for ticker in tickers},
+        "portfolioPnl": OrderBook.portfolio_pnl(client),
+    }
+
+
+class ClientInfoSubscription:
+    """
+    A subscriber to the information about a client. It is marked dirty when something it
+    shows may have changed, and next() only returns once the information actually differs
+    from what was last sent.
+    """
+
+    def __init__(self, publisher: "ClientInfoPublisher", client: Client):
+        self.publisher = publisher
+        self.client = client
+        self.last_sent: str = None
+        self._dirty = asyncio.Event()
+        self._dirty.set()  # the first update is sent straight away
+        self._last_time = 0.0  # monotonic time of the last update sent
+
+    def mark_dirty(self):
+        self._dirty.set()
+
+    async def next(self) -> str:
+        """Waits for the next change of the information, encoded as JSON."""
+        while True:
+            # changes made until the interval is over are sent together
+            delay = self._last_time + self.publisher.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                # the 24h pnl moves with time alone, so check it now and then anyway
+                await asyncio.wait_for(self._dirty.wait(), self.publisher.refresh)
+            except asyncio.TimeoutError:
+                pass
+            self._dirty.clear()
+
+            summary = await call(
+                self.publisher.engine,
+                client_summary,
+                self.client,
+                self.publisher.tickers,
+            )
+            text = json.dumps(summary)
+            if text != self.last_sent:
+                self.last_sent = text
+                self._last_time = time.monotonic()
+                return text
+
+
+class ClientInfoPublisher:
+    """
+    Tracks which /client_info subscribers are dirty. A client's subscribers are marked dirty
+    when its balance or portfolio changes, and every subscriber is marked dirty when a trade
+    changes a last price, since the pnl of every ticker is sent. Nothing is computed for a
+    subscriber until it is dirty, and at most once per interval.
+
+    Usage:
+        publisher = ClientInfoPublisher(TICKERS)
+        subscription = publisher.subscribe(client)
+        text = await subscription.next()
+    """
+
+    def __init__(
+        self,
+        tickers: list[str],
+        interval: float = 1.0,
+        refresh: float = 60.0,
+        engine: MatchingEngine = None,
+    ):
+        self.tickers = tickers
+        self.interval = interval  # minimum seconds between two updates of a subscriber
+        self.refresh = refresh  # maximum seconds between two checks of a subscriber
+        self.engine = engine  # the clients and books are read on it, if given
+        self._subscriptions: dict[Client, set[ClientInfoSubscription]] = {}
+
+        # clients and books change on the engine thread, subscribers are marked on the event loop
+        self._client_listener = self._client_changed
+        self._book_listener = self._book_changed
+        if engine is not None:
+            self._client_listener = engine.on_loop(self._client_changed)
+            self._book_listener = engine.on_loop(self._book_changed)
+        for ticker in tickers:
+            OrderBook.get_book_by_ticker(ticker).add_listener(self._book_listener)
+
+    def close(self):
+        for ticker in self.tickers:
+            OrderBook.get_book_by_ticker(ticker).remove_listener(self._book_listener)
+
+    def subscribe(self, client: Client) -> ClientInfoSubscription:
+        subscription = ClientInfoSubscription(self, client)
+        if client not in self._subscriptions:
+            self._subscriptions[client] = set()
+            client.add_listener(self._client_listener)
+        self._subscriptions[client].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: ClientInfoSubscription):
+        client = subscription.client
+        subscriptions = self._subscriptions.get(client, set())
+        subscriptions.discard(subscription)
+        if not subscriptions and client in self._subscriptions:
+            del self._subscriptions[client]
+            client.remove_listener(self._client_listener)
+
+    def _client_changed(self, client: Client):
+        for subscription in self._subscriptions.get(client, ()):
+            subscription.mark_dirty()
+
+    def _book_changed(self, delta: dict):
+        if not delta["trades"]:
+            return  # only trades move the last price
+        for subscriptions in self._subscriptions.values():
+            for subscription in subscriptions:
+                subscription.mark_dirty()
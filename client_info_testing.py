@@ -0,0 +1,88 @@
+# --------------------------------------------------------------------------------------------------------------
+# Module to test the push-on-change client information behind /client_info
+# Every test runs in a directory holding a copy of the database, since the order books load their price history
+# --------------------------------------------------------------------------------------------------------------
+import asyncio, json, os, shutil, tempfile, unittest
+from unittest.mock import patch
+from client_info import *
+
+DATABASE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "stock_market_database.db"
+)
+
+
+class TestClientInfoPublisher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        shutil.copy(DATABASE, self.directory.name)
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.book = OrderBook("AAPL")
+        self.publisher = ClientInfoPublisher(["AAPL"], interval=0.05, refresh=10)
+
+        name = f"client_info_{self._testMethodName}"
+        self.buyer = Client(name, "pw", f"{name}@test.com", "B", "Uyer", 1_000_000)
+        self.seller = Client(
+            f"{name}_seller", "pw", f"{name}_seller@test.com", "S", "Eller", 0
+        )
+        self.seller.portfolio["AAPL"] = 100
+
+    def tearDown(self):
+        self.publisher.close()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    async def assertNoUpdate(self, subscription):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(subscription.next(), 0.2)
+
+    # Test that the first update is sent straight away, and nothing more until something changes
+    async def test_first_update(self):
+        subscription = self.publisher.subscribe(self.buyer)
+        info = json.loads(await asyncio.wait_for(subscription.next(), 1))
+        self.assertEqual(info["balance"], 1_000_000)
+        await self.assertNoUpdate(subscription)
+
+    # Test that a trade of the client is pushed
+    async def test_trade(self):
+        subscription = self.publisher.subscribe(self.buyer)
+        await subscription.next()
+
+        self.book._place_order(SELL, 100, 10, self.seller, False)
+        self.book._place_order(BUY, 100, 10, self.buyer, False)
+
+        info = json.loads(await asyncio.wait_for(subscription.next(), 1))
+        self.assertEqual(info["portfolio"], {"AAPL": 10})
+        self.assertEqual(info["balance"], 1_000_000 - 1000)
+
+    # Test that changes made within an interval are computed and sent once
+    async def test_coalesced(self):
+        subscription = self.publisher.subscribe(self.buyer)
+        await subscription.next()
+
+        with patch("client_info.client_summary", wraps=client_summary) as summary:
+            self.book._place_order(SELL, 100, 10, self.seller, False)
+            for _ in range(5):
+                self.book._place_order(BUY, 100, 1, self.buyer, False)
+            info = json.loads(await asyncio.wait_for(subscription.next(), 1))
+            self.assertEqual(summary.call_count, 1)
+        self.assertEqual(info["portfolio"], {"AAPL": 5})
+
+    # Test that a change which leaves the information as it was is not pushed
+    async def test_unchanged(self):
+        subscription = self.publisher.subscribe(self.buyer)
+        await subscription.next()
+
+        self.book._place_order(BUY, 1, 1, self.buyer, False)  # rests, no trade
+        self.buyer._changed()
+        await self.assertNoUpdate(subscription)
+
+    # Test that an unsubscribed client is not listened to anymore
+    async def test_unsubscribe(self):
+        subscription = self.publisher.subscribe(self.buyer)
+        self.publisher.unsubscribe(subscription)
+        self.assertEqual(self.buyer._listeners, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
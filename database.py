@@ -45,108 +45,194 @@
 # CREATE INDEX email_index On Client(email);
 # CREATE INDEX ticker_index On Transactions(ticker);
 # ----------------------------------------------------------------------------------------------------------------------------------------
+import os
 import sqlite3
+import threading
 from datetime import datetime
 
-# Each query should open a database connection, create a cursor and then close the connection, to prevent stale data
+DATABASE_PATH = os.environ.get("STOCK_MARKET_DB", "stock_market_database.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Client(
+  client_id INTEGER PRIMARY KEY,
+  username TEXT NOT NULL UNIQUE,
+  email TEXT NOT NULL UNIQUE,
+  balance REAL NOT NULL CHECK(balance >= 0.00) DEFAULT 100.00,
+  first_names TEXT,
+  last_name TEXT);
+
+CREATE TABLE IF NOT EXISTS OwnedStock(
+  owner_id INTEGER,
+  ticker TEXT,
+  average_price REAL NOT NULL CHECK(average_price > 0.00),
+  total_vol INTEGER NOT NULL CHECK(total_vol > 0),
+  PRIMARY KEY(owner_id, ticker),
+  FOREIGN KEY (owner_id)
+      REFERENCES Client (client_id)
+      ON DELETE CASCADE
+      ON UPDATE NO ACTION);
+
+CREATE TABLE IF NOT EXISTS Transactions(
+  transaction_id INTEGER PRIMARY KEY,
+  bidder_id INTEGER NOT NULL,
+  bid_price REAL NOT NULL CHECK(bid_price > 0.00),
+  asker_id INTEGER NOT NULL,
+  ask_price REAL NOT NULL CHECK(ask_price > 0.00),
+  vol INTEGER NOT NULL CHECK(vol > 0),
+  ticker TEXT NOT NULL,
+  time_stamp TEXT NOT NULL,
+  transaction_price REAL NOT NULL CHECK(transaction_price = bid_price OR transaction_price = ask_price)
+  CHECK(bid_price >= ask_price),
+  FOREIGN KEY (bidder_id)
+      REFERENCES Client (client_id)
+      ON DELETE CASCADE
+      ON UPDATE NO ACTION,
+  FOREIGN KEY (asker_id)
+      REFERENCES Client (client_id)
+      ON DELETE CASCADE
+      ON UPDATE NO ACTION);
+
+CREATE INDEX IF NOT EXISTS email_index ON Client(email);
+CREATE INDEX IF NOT EXISTS ticker_index On Transactions(ticker);
+"""
+
+
+# Each thread keeps one long-lived connection per database file, in autocommit mode so that reads never
+# hold a transaction open (and so never see stale data). Writes that touch several rows use an explicit
+# BEGIN/COMMIT. Statements are prepared once per connection and reused from sqlite's statement cache.
 class Database:
-    def __init__(self):
-        pass
+    _local = threading.local()
+
+    def __init__(self, path: str = None):
+        self.path = os.path.abspath(path if path is not None else DATABASE_PATH)
+
+    def _connection(self) -> sqlite3.Connection:
+        connections = getattr(Database._local, "connections", None)
+        if connections is None:
+            connections = Database._local.connections = {}
+        connection = connections.get(self.path)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, cached_statements=256
+            )
+            connection.execute("""PRAGMA journal_mode = WAL;""")
+            connection.execute("""PRAGMA synchronous = NORMAL;""")
+            connections[self.path] = connection
+        return connection
+
+    def _cursor(self) -> sqlite3.Cursor:
+        return self._connection().cursor()
+
+    # close: Closes this thread's connection to the database
+    # Pre: N/A
+    # Post: The connection is closed, the next query on this thread opens a new one
+    def close(self):
+        connections = getattr(Database._local, "connections", {})
+        connection = connections.pop(self.path, None)
+        if connection is not None:
+            connection.close()
+
+    # create_tables: Creates the tables and indexes if they do not exist yet, e.g. for a new database file
+    # Pre: N/A
+    # Post: All tables from SCHEMA exist
+    def create_tables(self):
+        self._connection().executescript(SCHEMA)
 
     # create_transaction: Takes information from a bid and ask and store into the database
     # Pre: Data must be validated - asker has the required stock, bidder has the required balance, bid_price >= ask_price, vol > 0, transaction_price == ask_price or transaction_price == bid_price
+    #      transaction_id and time_stamp are assigned by the database if not given
     # Post: transaction_id if successful, -1 if not
     def create_transaction(
-        self, bidder_id, bid_price, asker_id, ask_price, vol, ticker, transaction_price
+        self,
+        bidder_id,
+        bid_price,
+        asker_id,
+        ask_price,
+        vol,
+        ticker,
+        transaction_price,
+        transaction_id=None,
+        time_stamp=None,
     ):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
-        # Success tracks that all updates are made correctly
-        success = True
-        # Start
+        return self.create_transactions(
+            [
+                (
+                    bidder_id,
+                    bid_price,
+                    asker_id,
+                    ask_price,
+                    vol,
+                    ticker,
+                    transaction_price,
+                    transaction_id,
+                    time_stamp,
+                )
+            ]
+        )[0]
+
+    # create_transactions: Takes a list of fills, each a tuple of create_transaction's arguments, and stores them all in one commit
+    # The stock and balances of every client involved are read once, the fills are applied to them in order, and only the
+    # net result is written back: one row per (client, ticker) and per client, however many fills there are
+    # Pre: As create_transaction, for every fill
+    # Post: list with the transaction_id of each fill if successful, -1 if not. A failed fill does not undo the others
+    def create_transactions(self, fills):
+        if not fills:
+            return []
+        # transaction_id and time_stamp may be left out
+        fills = [tuple(fill) + (None,) * (9 - len(fill)) for fill in fills]
+        cursor = self._cursor()
         cursor.execute("""BEGIN TRANSACTION;""")
-        # Update owned_stock for seller
+        try:
+            results = self._apply_transactions(cursor, fills)
+            cursor.execute("""COMMIT TRANSACTION;""")
+        except BaseException as e:
+            # e.g. the database is locked, so nothing can be written; the connection is kept
+            # by the thread, so it must never be left inside the transaction
+            if cursor.connection.in_transaction:
+                cursor.execute("""ROLLBACK;""")
+            if not isinstance(e, sqlite3.IntegrityError):
+                raise
+            if len(fills) == 1:
+                return [-1]
+            # a fill broke a constraint the validation did not foresee: write the fills one
+            # by one, so that it does not take the others with it
+            return [self.create_transactions([fill])[0] for fill in fills]
+        return results
+
+    # _apply_transactions: Makes all the updates of create_transactions inside the caller's database transaction
+    # Pre: As create_transactions, and a transaction has been started on the cursor
+    # Post: list with the transaction_id of each fill if successful, -1 if not
+    def _apply_transactions(self, cursor, fills):
+        client_ids = list({fill[i] for fill in fills for i in (0, 2)})
+        tickers = list({fill[5] for fill in fills})
+        clients = ", ".join("?" * len(client_ids))
+        markets = ", ".join("?" * len(tickers))
+
+        # Read the current state of everyone involved
         cursor.execute(
-            """SELECT total_vol FROM OwnedStock WHERE owner_id = ? AND ticker = ? ;""",
-            (asker_id, ticker),
+            f"""SELECT client_id, balance FROM Client WHERE client_id IN ({clients}) ;""",
+            client_ids,
         )
-        previous_vol = cursor.fetchone()
-        # Error in validation
-        if previous_vol == None:
-            success = False
-        # Delete record if no stock remaining
-        elif previous_vol[0] == vol:
-            cursor.execute(
-                """DELETE FROM OwnedStock WHERE owner_id = ? AND ticker = ? ;""",
-                (asker_id, ticker),
-            )
-            if cursor.rowcount != 1:
-                success = False
-        # Else update the record
-        else:
-            cursor.execute(
-                """UPDATE OwnedStock SET total_vol = ? WHERE owner_id = ? AND ticker = ? ;""",
-                (previous_vol[0] - vol, asker_id, ticker),
-            )
-            if cursor.rowcount != 1:
-                success = False
-        # Update owned_stock for buyer
+        balances = dict(cursor.fetchall())
         cursor.execute(
-            """SELECT total_vol, average_price FROM OwnedStock WHERE owner_id = ? AND ticker = ? ;""",
-            (bidder_id, ticker),
+            f"""SELECT owner_id, ticker, total_vol, average_price FROM OwnedStock WHERE owner_id IN ({clients}) AND ticker IN ({markets}) ;""",
+            client_ids + tickers,
         )
-        previous_vol_price = cursor.fetchone()
-        # Buyer has no previous stock so insert
-        if previous_vol_price == None:
-            cursor.execute(
-                """INSERT INTO OwnedStock (owner_id, ticker, average_price, total_vol) VALUES (?, ?, ?, ?); """,
-                (bidder_id, ticker, ask_price, vol),
-            )
-            if cursor.rowcount != 1:
-                success = False
-        # Buyer has previous stock so update average price
-        else:
-            new_average_price = (
-                previous_vol_price[0] * previous_vol_price[1] + transaction_price * vol
-            ) / (previous_vol_price[0] + vol)
-            cursor.execute(
-                """UPDATE OwnedStock SET total_vol = ?, average_price = ? WHERE owner_id = ? AND ticker = ? ;""",
-                (
-                    previous_vol_price[0] + vol,
-                    round(new_average_price, 2),
-                    bidder_id,
-                    ticker,
-                ),
-            )
-            if cursor.rowcount != 1:
-                success = False
-        # Update balances of buyer and seller
+        # (owner_id, ticker) -> (total_vol, average_price), or None once all stock is sold
+        stock = {(row[0], row[1]): (row[2], row[3]) for row in cursor.fetchall()}
+        requested_ids = [fill[7] for fill in fills if fill[7] is not None]
         cursor.execute(
-            """SELECT balance, client_id FROM CLIENT WHERE client_id = ? OR client_id = ? ;""",
-            (bidder_id, asker_id),
+            f"""SELECT transaction_id FROM Transactions WHERE transaction_id IN ({", ".join("?" * len(requested_ids))}) ;""",
+            requested_ids,
         )
-        r = cursor.fetchall()
-        if len(r) != 2:
-            success = False
-        else:
-            for i in r:
-                if i[1] == bidder_id:
-                    cursor.execute(
-                        """UPDATE Client SET balance = ? WHERE client_id = ? ;""",
-                        (i[0] - transaction_price * vol, bidder_id),
-                    )
-                    if cursor.rowcount != 1:
-                        success = False
-                else:
-                    cursor.execute(
-                        """UPDATE Client SET balance = ? WHERE client_id = ? ;""",
-                        (i[0] + transaction_price * vol, asker_id),
-                    )
-                    if cursor.rowcount != 1:
-                        success = False
-        # Create transaction in database
-        cursor.execute(
-            """INSERT INTO Transactions (bidder_id, bid_price, asker_id, ask_price, vol, ticker, time_stamp, transaction_price) VALUES(?, ?, ?, ?, ?, ?, ?, ?);""",
+        used_ids = {row[0] for row in cursor.fetchall()}
+        next_id = None  # id for fills without one, after every id used or requested
+
+        results = []
+        transactions = []
+        changed_balances = set()
+        changed_stock = set()
+        for fill in fills:
             (
                 bidder_id,
                 bid_price,
@@ -154,35 +240,122 @@ class Database:
                 ask_price,
                 vol,
                 ticker,
-                str(datetime.now()),
                 transaction_price,
-            ),
+                transaction_id,
+                time_stamp,
+            ) = fill
+            seller = stock.get((asker_id, ticker))
+            buyer = stock.get((bidder_id, ticker))
+            cost = transaction_price * vol
+            # The average price the buyer will hold the stock at, checked as the table does
+            if buyer is None:
+                new_average_price = ask_price
+            elif buyer[0] + vol > 0:
+                new_average_price = round(
+                    (buyer[0] * buyer[1] + transaction_price * vol) / (buyer[0] + vol),
+                    2,
+                )
+            else:
+                new_average_price = 0
+            # Error in validation
+            if (
+                bidder_id not in balances
+                or asker_id not in balances
+                or bidder_id == asker_id
+                or seller is None
+                or seller[0] < vol
+                or vol <= 0
+                or ask_price <= 0
+                or bid_price < ask_price
+                or transaction_price not in (bid_price, ask_price)
+                or new_average_price <= 0
+                or balances[bidder_id] - cost < 0
+                or transaction_id in used_ids
+            ):
+                results.append(-1)
+                continue
+
+            if transaction_id is None:
+                if next_id is None:
+                    next_id = max([self.last_transaction_id()] + requested_ids) + 1
+                transaction_id = next_id
+                next_id += 1
+            used_ids.add(transaction_id)
+
+            # Update owned_stock for seller, removing the record if no stock remaining
+            stock[(asker_id, ticker)] = (
+                (seller[0] - vol, seller[1]) if seller[0] != vol else None
+            )
+            # Update owned_stock for buyer, with the new average price
+            if buyer is None:
+                stock[(bidder_id, ticker)] = (vol, new_average_price)
+            else:
+                stock[(bidder_id, ticker)] = (buyer[0] + vol, new_average_price)
+            changed_stock.update([(asker_id, ticker), (bidder_id, ticker)])
+            # Update balances of buyer and seller
+            balances[bidder_id] -= cost
+            balances[asker_id] += cost
+            changed_balances.update([bidder_id, asker_id])
+
+            transactions.append(
+                (
+                    transaction_id,
+                    bidder_id,
+                    bid_price,
+                    asker_id,
+                    ask_price,
+                    vol,
+                    ticker,
+                    time_stamp if time_stamp is not None else str(datetime.now()),
+                    transaction_price,
+                )
+            )
+            results.append(transaction_id)
+
+        # Write the net changes
+        cursor.executemany(
+            """DELETE FROM OwnedStock WHERE owner_id = ? AND ticker = ? ;""",
+            [key for key in changed_stock if stock[key] is None],
         )
-        result = cursor.lastrowid
-        if cursor.rowcount == 0 or result == None or success == False:
-            success = False
-            result = -1
-        if success:
-            cursor.execute("""COMMIT TRANSACTION;""")
-        else:
-            cursor.execute("""ROLLBACK;""")
-        connection.commit()
-        connection.close()
-        return result
+        cursor.executemany(
+            """INSERT INTO OwnedStock (owner_id, ticker, average_price, total_vol) VALUES (?, ?, ?, ?)
+            ON CONFLICT (owner_id, ticker) DO UPDATE SET average_price = excluded.average_price, total_vol = excluded.total_vol ;""",
+            [
+                (key[0], key[1], stock[key][1], stock[key][0])
+                for key in changed_stock
+                if stock[key] is not None
+            ],
+        )
+        cursor.executemany(
+            """UPDATE Client SET balance = ? WHERE client_id = ? ;""",
+            [(balances[client_id], client_id) for client_id in changed_balances],
+        )
+        # Create transactions in database
+        cursor.executemany(
+            """INSERT INTO Transactions (transaction_id, bidder_id, bid_price, asker_id, ask_price, vol, ticker, time_stamp, transaction_price) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+            transactions,
+        )
+        return results
+
+    # last_transaction_id: Returns the largest transaction_id used so far
+    # Pre: N/A
+    # Post: largest transaction_id in Transactions, 0 if there are none
+    def last_transaction_id(self):
+        cursor = self._cursor()
+        cursor.execute("""SELECT MAX(transaction_id) FROM Transactions;""")
+        result = cursor.fetchone()[0]
+        return result if result is not None else 0
 
     # retrieve_specific_stock: Takes a user and a specific stock market and returns the number of owned stock
     # Pre: N/A
     # Post: total_vol from record with key (user_id, ticker)
     def retrieve_specific_stock(self, owner_id, ticker):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute(
             """SELECT total_vol FROM OwnedStock WHERE owner_id = ? AND ticker = ?""",
             (owner_id, ticker),
         )
         result = cursor.fetchall()
-        connection.commit()
-        connection.close()
         if len(result) == 0:
             return 0
         else:
@@ -192,68 +365,83 @@ class Database:
     # Pre: client_id exists in clients
     # Post: balance from record with key client_id
     def retrieve_balance(self, client_id):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute(
             """SELECT balance FROM Client WHERE client_id = ?""", (client_id,)
         )
         result = cursor.fetchall()
-        connection.commit()
-        connection.close()
         if len(result) == 0:
             return 0
         else:
             return result[0][0]
 
+    # retrieve_transaction: Takes a transaction_id and returns the transaction
+    # Pre: N/A
+    # Post: tuple from transactions with key transaction_id, None if there is none
+    def retrieve_transaction(self, transaction_id):
+        cursor = self._cursor()
+        cursor.execute(
+            """SELECT * FROM Transactions WHERE transaction_id = ?;""",
+            (transaction_id,),
+        )
+        return cursor.fetchone()
+
     # retrieve_transactions_user: Takes a user and returns all transactions they are involved in
     # Pre: N/A
     # Post: list of tuples from transactions where client_id is either the bidder or the asker
     def retrieve_transactions_user(self, client_id):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute(
             """SELECT * FROM Transactions WHERE bidder_id = ? or asker_id = ?;""",
             (client_id, client_id),
         )
         result = cursor.fetchall()
-        connection.commit()
-        connection.close()
         return result
 
     # retrieve_transaction_stock: Takes a ticker and returns all transactions from that market
     # Pre: N/A
     # Post: list of tuples from transactions involing trading on ticker
     def retrieve_transactions_stock(self, ticker):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute("""SELECT * FROM Transactions WHERE ticker = ?;""", (ticker,))
         result = cursor.fetchall()
-        connection.commit()
-        connection.close()
         return result
 
+    # retrieve_transactions_between: Takes a range of time stamps and returns the transactions made in it, oldest first
+    # Pre: start and end are time stamps in the format of time_stamp, or None for no bound
+    # Post: list of tuples from transactions with start <= time_stamp < end, on ticker if given
+    def retrieve_transactions_between(self, start, end, ticker=None):
+        query = """SELECT * FROM Transactions WHERE 1"""
+        parameters = []
+        if start is not None:
+            query += """ AND time_stamp >= ?"""
+            parameters.append(start)
+        if end is not None:
+            query += """ AND time_stamp < ?"""
+            parameters.append(end)
+        if ticker is not None:
+            query += """ AND ticker = ?"""
+            parameters.append(ticker)
+        cursor = self._cursor()
+        cursor.execute(query + """ ORDER BY time_stamp, transaction_id;""", parameters)
+        return cursor.fetchall()
+
     # is_username_taken: Takes an username and returns if it exists in the database
     # Pre: N/A
     # Post: False if username does not belong to Client, True otherwise
     def is_username_taken(self, username):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute("""SELECT * FROM Client WHERE username = ?;""", (username,))
         result = cursor.fetchall()
-        connection.commit()
-        connection.close()
         return len(result) != 0
 
     # is_email_taken: Takes an email and returns if it exists in the database
     # Pre: N/A
     # Post: False if username does not belong to Client, True otherwise
     def is_email_taken(self, email):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute("""SELECT * FROM Client WHERE email = ?;""", (email,))
         result = cursor.fetchall()
-        connection.commit()
-        connection.close()
         return len(result) != 0
 
     # create_client: Takes a username and email and creates a new entry in the database
@@ -262,8 +450,7 @@ class Database:
     def create_client(
         self, username, email, balance=100, first_name=None, last_name=None
     ):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute(
             """INSERT INTO Client(username, email, balance, first_names, last_name) VALUES(?, ?, ?, ?, ?);""",
             (username, email, balance, first_name, last_name),
@@ -271,16 +458,13 @@ class Database:
         result = cursor.lastrowid
         if cursor.rowcount == 0 or result == None:
             result = -1
-        connection.commit()
-        connection.close()
         return result
 
     # account_from_email: Takes an email and returns the client_id and username associated with the email
     # Pre: N/A
     # Post: Associated (client_id, username) or (-1, "") if email is not in database
     def account_from_email(self, email):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute(
             """SELECT client_id, username FROM Client WHERE email = ?;""", (email,)
         )
@@ -295,23 +479,19 @@ class Database:
     # Pre: N/A
     # Post: (ticker, average_price, total_vol) from records with user_id
     def retrieve_stock(self, owner_id):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute(
             """SELECT ticker, average_price, total_vol FROM OwnedStock WHERE owner_id = ?""",
             (owner_id,),
         )
         result = cursor.fetchall()
-        connection.commit()
-        connection.close()
         return result
 
     # create_owned_stock: Takes a user and ticker and creates an owned stock record
     # Pre: owner_id belongs to database, vol > 0, owner_id does not own stock in ticker
     # Post: True if added, False if not
     def create_owned_stock(self, owner_id, ticker, vol):
-        connection = sqlite3.connect("stock_market_database.db")
-        cursor = connection.cursor()
+        cursor = self._cursor()
         cursor.execute(
             """INSERT INTO OwnedStock(owner_id, ticker, average_price, total_vol) VALUES(?, ?, 0.01, ?);""",
             (owner_id, ticker, vol),
@@ -321,6 +501,4 @@ class Database:
             result = False
         else:
             result = True
-        connection.commit()
-        connection.close()
         return result
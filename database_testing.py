@@ -13,7 +13,8 @@
 #   duplicate (owner_id, ticker) are used in create_owned_stock due to database errors at execution
 #   invalid owner_id in create_owned_stock due to database errors at execution
 # --------------------------------------------------------------------------------------------------------------
-import unittest, sqlite3
+import os, tempfile, unittest, sqlite3
+from unittest import mock
 from database import Database
 
 
@@ -407,5 +408,95 @@ class TestDatabase(unittest.TestCase):
         connection.close()
 
 
+class TestDatabaseConnection(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.db")
+        Database(self.path).create_tables()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    # Test that a database at a given path is created with all tables
+    def test_create_tables(self):
+        result = Database(self.path).create_client("A", "a@a.com")
+        self.assertEqual(result, 1)
+        self.assertEqual(Database(self.path).account_from_email("a@a.com"), (1, "A"))
+
+    # Test that the same connection is reused by every Database on a thread
+    def test_connection_is_reused(self):
+        self.assertIs(
+            Database(self.path)._connection(), Database(self.path)._connection()
+        )
+
+    # Test that connections use write-ahead logging
+    def test_journal_mode_wal(self):
+        cursor = Database(self.path)._cursor()
+        cursor.execute("""PRAGMA journal_mode;""")
+        self.assertEqual(cursor.fetchone()[0], "wal")
+
+    # Test that a failed constraint rolls the transaction back and leaves the connection usable
+    def test_add_transaction_oversell(self):
+        database = Database(self.path)
+        seller = database.create_client("A", "a@a.com")
+        buyer = database.create_client("B", "b@b.com")
+        database.create_owned_stock(seller, "A", 5)
+        result = database.create_transaction(buyer, 2, seller, 1, 10, "A", 1)
+        self.assertEqual(result, -1)
+        self.assertEqual(database.retrieve_specific_stock(seller, "A"), 5)
+        self.assertNotEqual(
+            database.create_transaction(buyer, 2, seller, 1, 5, "A", 1), -1
+        )
+
+    # Test that a sweep through several sellers is applied in one call, with the net stock and balances
+    def test_create_transactions_sweep(self):
+        database = Database(self.path)
+        buyer = database.create_client("B", "b@b.com", 1000)
+        sellers = [database.create_client(f"S{i}", f"s{i}@s.com") for i in range(5)]
+        for seller in sellers:
+            database.create_owned_stock(seller, "A", 10)
+        fills = [(buyer, 3, seller, 2, 10, "A", 2) for seller in sellers]
+        fills.append((buyer, 3, sellers[0], 2, 1, "A", 2))  # no stock left
+        result = database.create_transactions(fills)
+        self.assertEqual(result[-1], -1)
+        self.assertEqual(len(set(result[:-1])), 5)
+        self.assertEqual(database.retrieve_stock(buyer), [("A", 2, 50)])
+        self.assertEqual(database.retrieve_balance(buyer), 900)
+        for seller in sellers:
+            self.assertEqual(database.retrieve_specific_stock(seller, "A"), 0)
+            self.assertEqual(database.retrieve_balance(seller), 120)
+
+    # Test that any error rolls the batch back, and leaves the connection of the thread usable
+    def test_create_transactions_error(self):
+        database = Database(self.path)
+        seller = database.create_client("A", "a@a.com")
+        buyer = database.create_client("B", "b@b.com")
+        database.create_owned_stock(seller, "A", 5)
+        with mock.patch.object(
+            Database, "_apply_transactions", side_effect=RuntimeError("bug")
+        ):
+            with self.assertRaises(RuntimeError):
+                database.create_transaction(buyer, 2, seller, 1, 1, "A", 1)
+        self.assertFalse(database._connection().in_transaction)
+        self.assertNotEqual(
+            database.create_transaction(buyer, 2, seller, 1, 1, "A", 1), -1
+        )
+
+    # Test that a fill breaking a constraint in the database only fails on its own
+    def test_create_transactions_constraint(self):
+        database = Database(self.path)
+        seller = database.create_client("A", "a@a.com")
+        buyer = database.create_client("B", "b@b.com", 1000)
+        database.create_owned_stock(seller, "A", 5)
+        database._cursor().execute(
+            """CREATE TRIGGER reject BEFORE INSERT ON Transactions WHEN NEW.transaction_id = 13
+            BEGIN SELECT RAISE(ABORT, 'rejected'); END;"""
+        )
+        fills = [(buyer, 2, seller, 1, 1, "A", 1, i) for i in (12, 13, 14)]
+        self.assertEqual(database.create_transactions(fills), [12, -1, 14])
+        self.assertEqual(database.retrieve_specific_stock(seller, "A"), 3)
+        self.assertEqual(database.retrieve_balance(buyer), 998)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,186 @@
+import sqlite3
+import threading
+import time
+from collections import deque
+from enum import Enum
+from typing import NamedTuple
+
+from database import Database
+
+
+class DurabilityMode(Enum):
+    SYNC = "sync"  # every fill is committed before matching carries on
+    BATCHED = (
+        "batched"  # the fills of an order are committed together once it is matched
+    )
+    ASYNC = "async"  # fills are committed in the background by a writer thread
+
+
+SYNC = DurabilityMode.SYNC
+BATCHED = DurabilityMode.BATCHED
+ASYNC = DurabilityMode.ASYNC
+
+
+class Fill(NamedTuple):
+    """A fill waiting to be written, with the arguments of Database.create_transaction."""
+
+    bidder_id: int
+    bid_price: float
+    asker_id: int
+    ask_price: float
+    vol: int
+    ticker: str
+    transaction_price: float
+    transaction_id: int
+    time_stamp: str
+
+
+class FillJournal:
+    """
+    In-memory journal of the fills made by the matching engine, written to the database
+    according to the durability mode. Batches of fills are written in a single commit.
+
+    Usage:
+        journal = FillJournal(ASYNC)
+        journal.append(fill)  # returns straight away, the writer thread commits it
+        journal.flush()  # waits until everything appended so far is in the database
+    """
+
+    def __init__(
+        self,
+        mode: DurabilityMode = SYNC,
+        database_path: str = None,
+        max_batch: int = 1000,
+        retry_delay: float = 0.05,
+        max_retry_delay: float = 5.0,
+        max_retries: int = 10,
+    ):
+        self.mode = mode
+        self.database_path = database_path
+        self.max_batch = max_batch
+        # a batch that cannot be committed while the database is locked is retried up to
+        # max_retries times, after a delay doubling up to max_retry_delay; any other error
+        # is logged straight away, as matching must not wait on a batch that never commits
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_retries = max_retries
+
+        self._pending: deque[Fill] = deque()
+        self._writing = 0  # number of fills taken by the writer but not committed yet
+        self._condition = threading.Condition()
+        self._writer: threading.Thread = None
+        self._closed = False
+
+    def set_mode(self, mode: DurabilityMode):
+        """Changes the durability mode, writing everything pending in the old mode first."""
+        self.flush()
+        self.mode = mode
+
+    def append(self, fill: Fill):
+        """Records a fill. Only in SYNC mode is it in the database when this returns."""
+        if self.mode == SYNC:
+            self._write([fill])
+            return
+
+        with self._condition:
+            self._pending.append(fill)
+            if self.mode == ASYNC:
+                self._start_writer()
+                self._condition.notify_all()
+
+    def end_batch(self):
+        """Called by the engine once an order has been matched."""
+        if self.mode == BATCHED:
+            self.flush()
+
+    def flush(self):
+        """Writes all pending fills and waits until they are committed."""
+        if self._writer is None or not self._writer.is_alive():
+            with self._condition:
+                fills = list(self._pending)
+                self._pending.clear()
+            for start in range(0, len(fills), self.max_batch):
+                self._write(fills[start : start + self.max_batch])
+            return
+
+        with self._condition:
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: not self._pending and not self._writing)
+
+    def close(self):
+        """Writes all pending fills and stops the writer thread."""
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        self._closed = False
+
+    def database(self) -> Database:
+        """Returns the database the fills are written to."""
+        return Database(self.database_path)
+
+    def pending(self) -> int:
+        """Returns the number of fills that are not committed yet."""
+        with self._condition:
+            return len(self._pending) + self._writing
+
+    def _start_writer(self):
+        # precondition: self._condition is held
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(
+                target=self._run, name="fill-journal-writer", daemon=True
+            )
+            self._writer.start()
+
+    def _run(self):
+        """Writer thread: drains the journal in batches until closed."""
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:  # closed and drained
+                    self.database().close()
+                    return
+                count = min(len(self._pending), self.max_batch)
+                fills = [self._pending.popleft() for _ in range(count)]
+                self._writing = count
+
+            self._write(fills)
+
+            with self._condition:
+                self._writing = 0
+                self._condition.notify_all()
+
+    def _write(self, fills: list[Fill]):
+        """Writes a batch of fills, retrying while the database is locked."""
+        delay = self.retry_delay
+        retries = 0
+        while True:
+            try:
+                results = self.database().create_transactions(fills)
+                break
+            except Exception as e:  # the writer and matching must survive a bad batch
+                if not _is_transient(e) or retries == self.max_retries:
+                    ids = [fill.transaction_id for fill in fills]
+                    print(f"Transactions {ids} could not be written: {e!r}")
+                    return
+                print(
+                    f"Failed to write {len(fills)} transactions to the database, "
+                    f"retrying in {delay:.2f}s: {e}"
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                retries += 1
+
+        for fill, result in zip(fills, results):
+            if result == -1:
+                print(f"Transaction {fill.transaction_id} could not be recorded")
+
+
+def _is_transient(error: Exception) -> bool:
+    """Returns whether a write failed only because another connection held the database."""
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in str(error) or "busy" in str(error)
+    )
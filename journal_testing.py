@@ -0,0 +1,110 @@
+# --------------------------------------------------------------------------------------------------------------
+# Module to test the fill journal
+# Every test runs against a new database file with a seller (client 1) owning 100 of stock "A", and a buyer (client 2)
+# --------------------------------------------------------------------------------------------------------------
+import os, sqlite3, tempfile, unittest
+from unittest import mock
+from database import Database
+from journal import *
+
+
+def fill(transaction_id, vol=1):
+    return Fill(2, 2, 1, 1, vol, "A", 1, transaction_id, "2025-05-05 10:00:00.000000")
+
+
+class TestFillJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.db")
+        self.database = Database(self.path)
+        self.database.create_tables()
+        seller = self.database.create_client("A", "a@a.com", 1000)
+        self.database.create_client("B", "b@b.com", 1000)
+        self.database.create_owned_stock(seller, "A", 100)
+
+    def tearDown(self):
+        self.database.close()
+        self.directory.cleanup()
+
+    def transaction_ids(self):
+        cursor = self.database._cursor()
+        cursor.execute("""SELECT transaction_id FROM Transactions;""")
+        return [row[0] for row in cursor.fetchall()]
+
+    # Test that a fill is in the database as soon as it is appended in sync mode
+    def test_sync(self):
+        journal = FillJournal(SYNC, self.path)
+        journal.append(fill(10))
+        self.assertEqual(self.transaction_ids(), [10])
+
+    # Test that fills are only written at the end of a batch in batched mode
+    def test_batched(self):
+        journal = FillJournal(BATCHED, self.path)
+        journal.append(fill(10))
+        journal.append(fill(11))
+        self.assertEqual(self.transaction_ids(), [])
+        journal.end_batch()
+        self.assertEqual(self.transaction_ids(), [10, 11])
+
+    # Test that the writer thread writes every fill in async mode
+    def test_async(self):
+        journal = FillJournal(ASYNC, self.path, max_batch=7)
+        for transaction_id in range(1, 51):
+            journal.append(fill(transaction_id))
+        journal.flush()
+        self.assertEqual(journal.pending(), 0)
+        self.assertEqual(self.transaction_ids(), list(range(1, 51)))
+        self.assertEqual(self.database.retrieve_specific_stock(2, "A"), 50)
+        journal.close()
+
+    # Test that a fill which cannot be recorded does not undo the rest of its batch
+    def test_failed_fill(self):
+        journal = FillJournal(BATCHED, self.path)
+        journal.append(fill(10, vol=60))
+        journal.append(fill(11, vol=60))  # the seller only has 40 left
+        journal.append(fill(12, vol=40))
+        journal.end_batch()
+        self.assertEqual(self.transaction_ids(), [10, 12])
+        self.assertEqual(self.database.retrieve_specific_stock(1, "A"), 0)
+
+    # Test that a batch failing to commit, e.g. while the database is locked, is retried
+    def test_failed_batch_is_retried(self):
+        journal = FillJournal(ASYNC, self.path, retry_delay=0.001)
+        create_transactions = Database.create_transactions
+        failures = []
+
+        def locked(database, fills):
+            if len(failures) < 3:
+                failures.append(fills)
+                raise sqlite3.OperationalError("database is locked")
+            return create_transactions(database, fills)
+
+        with mock.patch.object(Database, "create_transactions", locked):
+            for transaction_id in range(1, 6):
+                journal.append(fill(transaction_id))
+            journal.flush()
+        journal.close()
+        self.assertEqual(len(failures), 3)
+        self.assertEqual(self.transaction_ids(), [1, 2, 3, 4, 5])
+
+    # Test that a batch failing for good is given up on, rather than holding up the caller
+    def test_failed_batch_is_given_up(self):
+        journal = FillJournal(SYNC, self.path, retry_delay=0.001, max_retries=2)
+        errors = [sqlite3.OperationalError("database is locked")] * 3 + [
+            sqlite3.OperationalError("no such table: Transactions"),
+            TypeError("bad fill"),
+        ]
+        with mock.patch.object(
+            Database, "create_transactions", side_effect=errors
+        ) as create_transactions:
+            journal.append(fill(10))  # locked three times, so retried twice
+            self.assertEqual(create_transactions.call_count, 3)
+            journal.append(fill(11))  # not retried
+            journal.append(fill(12))
+            self.assertEqual(create_transactions.call_count, 5)
+        journal.append(fill(13))
+        self.assertEqual(self.transaction_ids(), [13])
+
+
+if __name__ == "__main__":
+    unittest.main()
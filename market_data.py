@@ -0,0 +1,290 @@
+import asyncio
+import json
+from fastapi import WebSocket
+from fastapi.encoders import jsonable_encoder
+from OrderBook.OrderBook import *
+from OrderBook.engine import MatchingEngine, call_for
+
+
+def ticker_summary(ticker: str) -> dict:
+    """Returns the summary of the order book of a stock sent on /ws."""
+    all_bids = OrderBook.get_all_bids(ticker)
+    all_asks = OrderBook.get_all_asks(ticker)
+    return {
+        "ticker": ticker,
+        "best_bid": OrderBook.get_best_bid(ticker),
+        "best_ask": OrderBook.get_best_ask(ticker),
+        "all_bids": [
+            {
+                "order_id": order_id,
+                "timestamp": timestamp,
+                "price": price,
+                "volume": volume,
+                "stock_id": stock_id,
+            }
+            for order_id, timestamp, price, volume, stock_id in all_bids
+        ],
+        "all_asks": [
+            {
+                "order_id": order_id,
+                "timestamp": timestamp,
+                "price": price,
+                "volume": volume,
+                "stock_id": stock_id,
+            }
+            for order_id, timestamp, price, volume, stock_id in all_asks
+        ],
+        "last_price": OrderBook.get_last_price(ticker),
+        "last_timestamp": OrderBook.get_last_timestamp(ticker),
+        "pnl": OrderBook.calculate_pnl_24h(ticker),
+    }
+
+
+def ticker_depth_summary(ticker: str, depth: int = None) -> dict:
+    """
+    Returns the summary of a stock sent to a /ws subscriber of that ticker, with the best
+    depth levels of each side aggregated by price (all levels if depth is None).
+    """
+    return {
+        "ticker": ticker,
+        "best_bid": OrderBook.get_best_bid(ticker),
+        "best_ask": OrderBook.get_best_ask(ticker),
+        "all_bids": [
+            {"price": price, "volume": volume, "orders": orders}
+            for price, volume, orders in OrderBook.get_depth(ticker, BUY, depth)
+        ],
+        "all_asks": [
+            {"price": price, "volume": volume, "orders": orders}
+            for price, volume, orders in OrderBook.get_depth(ticker, SELL, depth)
+        ],
+        "last_price": OrderBook.get_last_price(ticker),
+        "last_timestamp": OrderBook.get_last_timestamp(ticker),
+        "pnl": OrderBook.calculate_pnl_24h(ticker),
+    }
+
+
+class SnapshotPublisher:
+    """
+    Builds the summary of the order books once per tick, serializes it once, and sends the
+    same text to every subscribed websocket. The cost of a tick does not depend on the
+    number of subscribers, except for the sends themselves.
+
+    A websocket subscribed without a ticker gets every resting order of every ticker. Once it
+    subscribes to a ticker, it only gets the tickers it subscribed to, each with its best
+    levels aggregated by price. The summary of a ticker at a given depth is only built if
+    someone watches it, and only once per tick.
+
+    Usage:
+        publisher = SnapshotPublisher(TICKERS)
+        publisher.start()  # from a running event loop
+        publisher.subscribe(websocket)  # full books
+        publisher.subscribe(websocket, "AAPL", depth=10)  # only the top 10 levels of AAPL
+    """
+
+    def __init__(
+        self, tickers: list[str], interval: float = 1.0, engine: MatchingEngine = None
+    ):
+        self.tickers = tickers
+        self.interval = interval  # seconds between two snapshots
+        self.engine = engine  # reads the books, if they are matched on an engine
+        # websocket -> { ticker -> depth } it subscribed to, or None for the full books
+        self.subscribers: dict[WebSocket, dict[str, int] | None] = {}
+        self.last_snapshot: str = None  # text of the last full snapshot sent
+        self._task: asyncio.Task = None
+        self._sending: dict[WebSocket, asyncio.Task] = {}  # sends not done yet
+
+    def subscribe(self, websocket: WebSocket, ticker: str = None, depth: int = None):
+        """Subscribes to a ticker with the given depth (all levels if None), or to the full books if no ticker is given."""
+        if ticker is None:
+            self.subscribers.setdefault(websocket, None)
+            return
+        tickers = self.subscribers.get(websocket) or {}
+        tickers[ticker] = depth
+        self.subscribers[websocket] = tickers
+
+    def unsubscribe(self, websocket: WebSocket, ticker: str = None):
+        """Unsubscribes from a ticker, or from everything if no ticker is given."""
+        if ticker is None:
+            self.subscribers.pop(websocket, None)
+            return
+        tickers = self.subscribers.get(websocket, {})
+        if tickers is None:  # full books so far, keep the full books of the others
+            tickers = {other: None for other in self.tickers}
+            self.subscribers[websocket] = tickers
+        tickers.pop(ticker, None)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _parts(self, tickers: dict[str, int] | None) -> list[tuple[str, tuple]]:
+        """Returns the tickers a subscriber watches, each with the key of its summary."""
+        if tickers is None:
+            return [(ticker, ("orders", ticker)) for ticker in self.tickers]
+        return [(ticker, ("levels", ticker, tickers[ticker])) for ticker in tickers]
+
+    async def _summary(self, key: tuple) -> dict:
+        """Builds the summary of a key where its book is matched."""
+        if key[0] == "orders":
+            return await call_for(self.engine, key[1], ticker_summary, key[1])
+        return await call_for(self.engine, key[1], ticker_depth_summary, *key[1:])
+
+    async def render(self, subscriptions: list[dict[str, int] | None]) -> list[str]:
+        """
+        Returns the summaries of the books watched by each subscription encoded as JSON, where
+        None stands for all the full books. Each ticker is built and encoded once per depth.
+        """
+        parts = [self._parts(tickers) for tickers in subscriptions]
+        keys = list({key for watched in parts for _, key in watched})
+        # the books are only read on the engine, the encoding is done here
+        summaries = await asyncio.gather(*(self._summary(key) for key in keys))
+        encoded = {
+            key: json.dumps(jsonable_encoder(summary))
+            for key, summary in zip(keys, summaries)
+        }
+        return [
+            "{"
+            + ", ".join(
+                f"{json.dumps(ticker)}: {encoded[key]}" for ticker, key in watched
+            )
+            + "}"
+            for watched in parts
+        ]
+
+    async def snapshot(self, tickers: dict[str, int] = None) -> str:
+        """Returns the summary of the books watched, or of all the full books if tickers is None."""
+        return (await self.render([tickers]))[0]
+
+    async def publish(self):
+        """
+        Sends one snapshot to every subscriber, and waits for the sends for at most an
+        interval. A subscriber still receiving the last one is skipped until it is done, as
+        a send cut short would corrupt its stream, and one that cannot receive is closed.
+        """
+        subscribers = [
+            (websocket, tickers)
+            for websocket, tickers in self.subscribers.items()
+            if tickers != {}  # unsubscribed from every ticker
+            and websocket not in self._sending
+        ]
+        if not subscribers:
+            return
+        texts = await self.render([tickers for _, tickers in subscribers])
+        for (_, tickers), text in zip(subscribers, texts):
+            if tickers is None:
+                self.last_snapshot = text
+                break
+
+        sends = []
+        for (websocket, _), text in zip(subscribers, texts):
+            send = asyncio.create_task(self._send(websocket, text))
+            self._sending[websocket] = send
+            send.add_done_callback(
+                lambda _, websocket=websocket: self._sending.pop(websocket, None)
+            )
+            sends.append(send)
+        # a subscriber that cannot keep up must not hold up the others
+        await asyncio.wait(sends, timeout=self.interval)
+
+    async def _send(self, websocket: WebSocket, text: str):
+        try:
+            await websocket.send_text(text)
+        except Exception as e:
+            print(f"OrderBook WebSocket error: {e!r}")
+            self.unsubscribe(websocket)
+            # the handler of /ws only waits for messages, so it takes closing the
+            # websocket for the client to notice and reconnect
+            try:
+                await websocket.close()
+            except Exception:
+                pass  # already closed
+
+    async def run(self):
+        while True:
+            try:
+                await self.publish()
+            except Exception as e:
+                print(f"OrderBook snapshot error: {e}")
+            await asyncio.sleep(self.interval)  # Updates pushed every second
+
+
+class DeltaFeed:
+    """
+    Sequenced market data feed. Every subscriber first receives a snapshot of each book, then
+    the deltas published by the books as soon as they change. Each delta carries the sequence
+    number of its book, which increases by one per delta, so a subscriber that sees a gap
+    can ask for a new snapshot with {"type": "snapshot", "ticker": ticker}.
+
+    With an engine, snapshots are taken on the engine and reach the queues in the same order
+    as the deltas, but a subscriber may still get deltas older than its first snapshot.
+    Deltas up to the sequence number of the snapshot of their book are to be ignored.
+
+    Usage:
+        feed = DeltaFeed(TICKERS)
+        queue = feed.subscribe()  # messages to send, already encoded as JSON
+        feed.request_snapshot(queue, "AAPL")
+    """
+
+    def __init__(
+        self,
+        tickers: list[str],
+        max_queued: int = 10_000,
+        engine: MatchingEngine = None,
+    ):
+        self.tickers = tickers
+        self.max_queued = max_queued  # a subscriber further behind is resynchronised
+        self.engine = engine  # the books are matched on it, if given
+        self.subscribers: set[asyncio.Queue] = set()
+        # the books publish on the engine thread, the queues are filled on the event loop
+        self._listener = (
+            self.publish if engine is None else engine.on_loop(self.publish)
+        )
+        for ticker in tickers:
+            OrderBook.get_book_by_ticker(ticker).add_listener(self._listener)
+
+    def close(self):
+        for ticker in self.tickers:
+            OrderBook.get_book_by_ticker(ticker).remove_listener(self._listener)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        for ticker in self.tickers:
+            self.request_snapshot(queue, ticker)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def request_snapshot(self, queue: asyncio.Queue, ticker: str):
+        """Queues a snapshot of a book, after the deltas already published."""
+        if self.engine is None:
+            queue.put_nowait(json.dumps(OrderBook.get_snapshot(ticker)))
+            return
+
+        def queue_snapshot(future):
+            # called where the snapshot was taken, it takes the same way to the queue
+            # as the deltas, so that they stay in order
+            if future.exception() is None:
+                self.engine.on_loop(queue.put_nowait)(json.dumps(future.result()))
+
+        future = self.engine.submit_to(ticker, OrderBook.get_snapshot, ticker)
+        future.add_done_callback(queue_snapshot)
+
+    def publish(self, delta: dict):
+        """Listener of the order books: queues a delta for every subscriber."""
+        text = json.dumps(delta)
+        for queue in self.subscribers:
+            if queue.qsize() >= self.max_queued:
+                # the subscriber cannot keep up: drop what it has not read and start it over
+                while not queue.empty():
+                    queue.get_nowait()
+                for ticker in self.tickers:
+                    self.request_snapshot(queue, ticker)  # already include this delta
+                continue
+            queue.put_nowait(text)
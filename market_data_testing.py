@@ -0,0 +1,203 @@
+# --------------------------------------------------------------------------------------------------------------
+# Module to test the market data publisher behind /ws
+# Every test runs in a directory holding a copy of the database, since the order books load their price history
+# --------------------------------------------------------------------------------------------------------------
+import asyncio, json, os, shutil, tempfile, unittest
+from unittest.mock import AsyncMock, patch
+from market_data import *
+
+DATABASE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "stock_market_database.db"
+)
+
+
+class TestSnapshotPublisher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        shutil.copy(DATABASE, self.directory.name)
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.books = [OrderBook("AAPL"), OrderBook("MSFT")]
+        self.publisher = SnapshotPublisher(["AAPL", "MSFT"], interval=0.1)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    # Test that the snapshot has the format the front end reads
+    async def test_snapshot(self):
+        summary = json.loads(await self.publisher.snapshot())
+        self.assertEqual(list(summary), ["AAPL", "MSFT"])
+        self.assertEqual(summary["AAPL"]["ticker"], "AAPL")
+        self.assertEqual(summary["AAPL"]["all_bids"], [])
+        self.assertIn("last_price", summary["MSFT"])
+
+    # Test that a tick builds one snapshot and sends the same text to every subscriber
+    async def test_publish_once(self):
+        websockets = [AsyncMock() for _ in range(5)]
+        for websocket in websockets:
+            self.publisher.subscribe(websocket)
+
+        with patch("market_data.ticker_summary", wraps=ticker_summary) as summary:
+            await self.publisher.publish()
+            self.assertEqual(summary.call_count, 2)  # once per ticker
+
+        for websocket in websockets:
+            websocket.send_text.assert_awaited_once_with(self.publisher.last_snapshot)
+
+    # Test that no snapshot is built when nobody is subscribed
+    async def test_publish_without_subscribers(self):
+        with patch("market_data.ticker_summary") as summary:
+            await self.publisher.publish()
+            summary.assert_not_called()
+
+    # Test that a subscriber whose send fails is closed, so that it reconnects, without affecting the others
+    async def test_failing_subscriber(self):
+        healthy, broken = AsyncMock(), AsyncMock()
+        broken.send_text.side_effect = RuntimeError("disconnected")
+        self.publisher.subscribe(healthy)
+        self.publisher.subscribe(broken)
+
+        await self.publisher.publish()
+        self.assertEqual(list(self.publisher.subscribers), [healthy])
+        broken.close.assert_awaited_once()
+
+        await self.publisher.publish()
+        self.assertEqual(healthy.send_text.await_count, 2)
+        self.assertEqual(broken.send_text.await_count, 1)
+
+    # Test that a slow subscriber is skipped until its send is done, rather than having it cut short
+    async def test_slow_subscriber(self):
+        healthy, slow = AsyncMock(), AsyncMock()
+        received, sent = asyncio.Event(), []
+
+        async def send_text(text):
+            await received.wait()
+            sent.append(text)
+
+        slow.send_text.side_effect = send_text
+        self.publisher.subscribe(healthy)
+        self.publisher.subscribe(slow)
+
+        await self.publisher.publish()  # gives up waiting after an interval
+        await self.publisher.publish()
+        self.assertEqual(healthy.send_text.await_count, 2)
+        self.assertEqual(slow.send_text.call_count, 1)
+
+        received.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(sent), 1)  # the first snapshot, sent in full
+        await self.publisher.publish()
+        self.assertEqual(slow.send_text.call_count, 2)
+        slow.close.assert_not_awaited()
+
+    # Test that a subscriber to a ticker only gets that ticker, aggregated to the depth it asked for
+    async def test_ticker_subscription(self):
+        client = Client(
+            "subscriber", "pw", "subscriber@test.com", "Sub", "Scriber", 1_000_000
+        )
+        for price in (97, 98, 99, 99):
+            self.books[0]._place_order(BUY, price, 1, client, False)
+        full, watcher = AsyncMock(), AsyncMock()
+        self.publisher.subscribe(full)
+        self.publisher.subscribe(watcher, "AAPL", depth=2)
+
+        await self.publisher.publish()
+
+        summary = json.loads(watcher.send_text.await_args.args[0])
+        self.assertEqual(list(summary), ["AAPL"])
+        self.assertEqual(
+            summary["AAPL"]["all_bids"],
+            [
+                {"price": 99, "volume": 2, "orders": 2},
+                {"price": 98, "volume": 1, "orders": 1},
+            ],
+        )
+        full_summary = json.loads(full.send_text.await_args.args[0])
+        self.assertEqual(list(full_summary), ["AAPL", "MSFT"])
+        self.assertEqual(len(full_summary["AAPL"]["all_bids"]), 4)
+
+    # Test that each ticker is only built for the depths watched, once per tick
+    async def test_shared_subscriptions(self):
+        websockets = [AsyncMock() for _ in range(3)]
+        for websocket in websockets:
+            self.publisher.subscribe(websocket, "MSFT", depth=5)
+        self.publisher.subscribe(websockets[0], "AAPL", depth=5)
+
+        with (
+            patch(
+                "market_data.ticker_depth_summary", wraps=ticker_depth_summary
+            ) as summary,
+            patch("market_data.ticker_summary") as full_summary,
+        ):
+            await self.publisher.publish()
+            self.assertEqual(summary.call_count, 2)
+            full_summary.assert_not_called()
+
+        self.assertEqual(
+            list(json.loads(websockets[0].send_text.await_args.args[0])),
+            ["MSFT", "AAPL"],
+        )
+
+    # Test that unsubscribing from a ticker stops it being sent
+    async def test_unsubscribe(self):
+        full, watcher = AsyncMock(), AsyncMock()
+        self.publisher.subscribe(full)
+        self.publisher.subscribe(watcher, "AAPL")
+        self.publisher.unsubscribe(full, "AAPL")
+        self.publisher.unsubscribe(watcher, "AAPL")
+
+        await self.publisher.publish()
+
+        self.assertEqual(list(json.loads(full.send_text.await_args.args[0])), ["MSFT"])
+        watcher.send_text.assert_not_awaited()
+        self.assertIn(watcher, self.publisher.subscribers)
+
+
+class TestDeltaFeed(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        shutil.copy(DATABASE, self.directory.name)
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.book = OrderBook("AAPL")
+        self.feed = DeltaFeed(["AAPL"], max_queued=3)
+        name = f"delta_feed_{self._testMethodName}"
+        self.client = Client(name, "pw", f"{name}@test.com", "Delta", "Feed", 1_000_000)
+
+    def tearDown(self):
+        self.feed.close()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def messages(self, queue):
+        return [json.loads(queue.get_nowait()) for _ in range(queue.qsize())]
+
+    # Test that a subscriber gets a snapshot, then the deltas numbered from the snapshot on
+    def test_snapshot_then_deltas(self):
+        self.book._place_order(BUY, 100, 1, self.client, False)
+        queue = self.feed.subscribe()
+        self.book._place_order(BUY, 99, 1, self.client, False)
+
+        snapshot, delta = self.messages(queue)
+        self.assertEqual(snapshot["type"], "snapshot")
+        self.assertEqual(snapshot["bids"], [[100, 1, 1]])
+        self.assertEqual(delta["type"], "delta")
+        self.assertEqual(delta["sequence"], snapshot["sequence"] + 1)
+        self.assertEqual(delta["bids"], [["add", 99, 1, 1]])
+
+    # Test that a subscriber that falls too far behind is sent a new snapshot instead of the backlog
+    def test_slow_subscriber(self):
+        queue = self.feed.subscribe()
+        for price in range(90, 95):
+            self.book._place_order(BUY, price, 1, self.client, False)
+
+        messages = self.messages(queue)
+        self.assertEqual(messages[0]["type"], "snapshot")
+        self.assertEqual(messages[0]["sequence"], 3)
+        self.assertEqual([message["sequence"] for message in messages[1:]], [4, 5])
+        self.assertEqual(len(messages[0]["bids"]), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+import asyncio
+import hmac
+import json
+from OrderBook.OrderBook import *
+from OrderBook.engine import MatchingEngine, Termination, Trade
+
+
+def login(message: dict) -> Client:
+    """Returns the client logging in with {"type": "login", "client_user": ..., "password": ...}."""
+    client = Client.get_client_by_username(message.get("client_user"))
+    password = message.get("password")
+    if (
+        message.get("type") != "login"
+        or client is None
+        or not isinstance(password, str)
+        or not hmac.compare_digest(client.password.encode(), password.encode())
+    ):
+        raise ValueError("Invalid username or password")
+    return client
+
+
+class OrderEntrySession:
+    """
+    Order entry session of a logged in client, behind /ws/orders. Every instruction carries a
+    client order id chosen by the client, and is answered with an execution report carrying
+    it: new, cancelled, replaced or rejected. The fills of the client's orders are reported
+    as they happen, including those of orders resting in the books, and never before the
+    report of the order they fill.
+
+    Orders placed in the session can be cancelled or replaced by their client order id
+    (orig_client_order_id) as well as by their order id, until they are filled or cancelled,
+    including by self-trade prevention or for lack of funds: after that, cancelling or
+    replacing them is rejected as too late.
+
+    Usage:
+        session = OrderEntrySession(engine, client)
+        await session.handle('{"type": "new", "client_order_id": "q1", "ticker": "AAPL", ...}')
+        report = await session.reports.get()  # already encoded as JSON
+        session.close()
+    """
+
+    def __init__(self, engine: MatchingEngine, client: Client):
+        self.engine = engine
+        self.client = client
+        self.reports: asyncio.Queue[str] = asyncio.Queue()
+        self._order_ids: dict[str, int] = {}  # client order id -> order id
+        self._client_order_ids: dict[int, str] = {}  # order id -> client order id
+        self._pending = 0  # instructions sent to the engine and not reported yet
+        # fills held until the pending instructions are reported
+        self._fills: list[Trade] = []
+        # orders terminated other than by a fill, forgotten once their fills are reported
+        self._terminated: list[int] = []
+        engine.add_trade_listener(self._trade)
+        engine.add_termination_listener(self._order_terminated)
+
+    def close(self):
+        self.engine.remove_trade_listener(self._trade)
+        self.engine.remove_termination_listener(self._order_terminated)
+
+    async def handle(self, text: str):
+        """Runs an instruction of the client, then reports its result."""
+        client_order_id = None
+        try:
+            message = json.loads(text)
+            if not isinstance(message, dict):
+                raise ValueError("expected a JSON object")
+            client_order_id = message.get("client_order_id")
+            instruction = self._instruction(message)
+        except (KeyError, TypeError, ValueError) as e:
+            self._report(client_order_id, "rejected", error=f"Invalid message: {e}")
+            return
+
+        self._pending += 1
+        try:
+            (result,) = await self.engine.place_orders([instruction], self.client)
+        except Exception as e:
+            result = {"ok": False, "error": str(e)}
+        finally:
+            self._pending -= 1
+
+        if not result["ok"]:
+            self._report(client_order_id, "rejected", error=result["error"])
+        elif instruction.action == "new":
+            order_id = result["result"]
+            self._order_ids[client_order_id] = order_id
+            self._client_order_ids[order_id] = client_order_id
+            self._report(client_order_id, "new", order_id=order_id)
+        elif instruction.action == "cancel":
+            self._forget(instruction.order_id)
+            self._report(
+                client_order_id,
+                "cancelled",
+                order_id=instruction.order_id,
+                log=result["result"],
+            )
+        else:
+            if result["result"]["terminated"]:  # e.g. replaced with no volume left
+                self._terminated.append(instruction.order_id)
+            self._report(client_order_id, "replaced", **result["result"])
+        self._report_fills()
+
+    def _instruction(self, message: dict) -> Instruction:
+        if message.get("client_order_id") is None:
+            raise ValueError("Missing client_order_id")
+        kind = message.get("type")
+        if kind == "new":
+            if message.get("client_order_id") in self._order_ids:
+                raise ValueError(
+                    f"Client order id {message['client_order_id']} is already used"
+                )
+            side = message["side"].lower()
+            if side not in ("buy", "sell"):
+                raise ValueError(f"Unknown side {side}")
+            return Instruction(
+                "new",
+                message["ticker"],
+                BUY if side == "buy" else SELL,
+                float(message["price"]),
+                int(message["volume"]),
+            )
+        if kind == "cancel":
+            return Instruction("cancel", order_id=self._order_id(message))
+        if kind == "replace":
+            return Instruction(
+                "amend",
+                price=float(message["price"]),
+                volume=int(message["volume"]),
+                order_id=self._order_id(message),
+            )
+        raise ValueError(f"Unknown message type {kind}")
+
+    def _order_id(self, message: dict) -> int:
+        if "order_id" in message:
+            return int(message["order_id"])
+        original = message.get("orig_client_order_id")
+        if original not in self._order_ids:
+            raise ValueError(f"Unknown client order id {original}")
+        return self._order_ids[original]
+
+    def _trade(self, trade: Trade):
+        """Trade listener of the engine, called on the event loop."""
+        if self.client.username in (trade.bidder, trade.asker):
+            self._fills.append(trade)
+            self._report_fills()
+
+    def _order_terminated(self, termination: Termination):
+        """Termination listener of the engine, called on the event loop."""
+        if termination.username == self.client.username:
+            self._terminated.append(termination.order_id)
+            self._report_fills()
+
+    def _report_fills(self):
+        # a fill may be of the order being placed, whose id is not known until it is reported
+        if self._pending:
+            return
+        fills, self._fills = self._fills, []
+        for trade in fills:
+            for side, username, order_id, volume_left in (
+                ("buy", trade.bidder, trade.bid_order_id, trade.bid_volume_left),
+                ("sell", trade.asker, trade.ask_order_id, trade.ask_volume_left),
+            ):
+                if username != self.client.username:
+                    continue
+                self._report(
+                    self._client_order_ids.get(order_id),
+                    "fill",
+                    order_id=order_id,
+                    ticker=trade.ticker,
+                    side=side,
+                    price=trade.price,
+                    volume=trade.vol,
+                    volume_left=volume_left,
+                    transaction_id=trade.transaction_id,
+                    timestamp=trade.timestamp.isoformat(),
+                )
+                if volume_left == 0:
+                    self._forget(order_id)
+        terminated, self._terminated = self._terminated, []
+        for order_id in terminated:
+            self._forget(order_id)
+
+    def _forget(self, order_id: int):
+        """Drops the client order id of an order that is terminated."""
+        original = self._client_order_ids.pop(order_id, None)
+        self._order_ids.pop(original, None)
+
+    def _report(self, client_order_id: str, status: str, **fields):
+        self.reports.put_nowait(
+            json.dumps(
+                {
+                    "type": "execution_report",
+                    "client_order_id": client_order_id,
+                    "status": status,
+                    **fields,
+                }
+            )
+        )
@@ -0,0 +1,216 @@
+# --------------------------------------------------------------------------------------------------------------
+# Module to test the order entry sessions behind /ws/orders
+# Every test runs in a directory holding a copy of the database, since the order books load their price history
+# --------------------------------------------------------------------------------------------------------------
+import asyncio, json, os, shutil, tempfile, unittest
+from order_entry import *
+
+DATABASE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "stock_market_database.db"
+)
+
+
+class TestOrderEntrySession(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        shutil.copy(DATABASE, self.directory.name)
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.book = OrderBook("AAPL")
+        self.engine = MatchingEngine()
+        self.engine.start()
+
+        name = f"order_entry_{self._testMethodName}"
+        self.trader = Client(name, "pw", f"{name}@test.com", "T", "Rader", 1_000_000)
+        self.trader.portfolio["AAPL"] = 100
+        self.other = Client(
+            f"{name}_other", "pw", f"{name}_other@test.com", "O", "Ther", 1_000_000
+        )
+        self.other.portfolio["AAPL"] = 100
+        self.session = OrderEntrySession(self.engine, self.trader)
+
+    async def asyncTearDown(self):
+        self.session.close()
+        self.engine.stop()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    async def send(self, **message):
+        await self.session.handle(json.dumps(message))
+
+    def reports(self):
+        queue = self.session.reports
+        return [json.loads(queue.get_nowait()) for _ in range(queue.qsize())]
+
+    # Test that a client logs in with its username and password only
+    def test_login(self):
+        message = {"type": "login", "client_user": self.trader.username}
+        self.assertIs(login({**message, "password": "pw"}), self.trader)
+        for wrong in ({**message, "password": "no"}, message, {"type": "login"}):
+            with self.assertRaises(ValueError):
+                login(wrong)
+
+    # Test that a new order is acknowledged with its order id, before the fills it makes
+    async def test_new_order_and_fills(self):
+        await self.send(
+            type="new",
+            client_order_id="q1",
+            ticker="AAPL",
+            side="sell",
+            price=100,
+            volume=10,
+        )
+        (acknowledged,) = self.reports()
+        self.assertEqual(acknowledged["status"], "new")
+        self.assertEqual(acknowledged["client_order_id"], "q1")
+
+        # a resting order filled by another client
+        await self.engine.place_order("AAPL", BUY, 100, 4, self.other)
+        await asyncio.sleep(0)  # the fills reach the session on the event loop
+        (fill,) = self.reports()
+        self.assertEqual(fill["status"], "fill")
+        self.assertEqual(fill["client_order_id"], "q1")
+        self.assertEqual(fill["order_id"], acknowledged["order_id"])
+        self.assertEqual((fill["side"], fill["volume"]), ("sell", 4))
+
+        # an order filled as it is placed
+        await self.engine.place_order("AAPL", SELL, 99, 3, self.other)
+        await self.send(
+            type="new",
+            client_order_id="q2",
+            ticker="AAPL",
+            side="buy",
+            price=99,
+            volume=3,
+        )
+        self.assertEqual(
+            [
+                (report["status"], report["client_order_id"])
+                for report in self.reports()
+            ],
+            [("new", "q2"), ("fill", "q2")],
+        )
+
+    # Test that orders are cancelled and replaced by their client order id
+    async def test_cancel_and_replace(self):
+        await self.send(
+            type="new",
+            client_order_id="q1",
+            ticker="AAPL",
+            side="buy",
+            price=90,
+            volume=10,
+        )
+        await self.send(
+            type="replace",
+            client_order_id="q2",
+            orig_client_order_id="q1",
+            price=91,
+            volume=5,
+        )
+        await self.send(type="cancel", client_order_id="q3", orig_client_order_id="q1")
+        await self.send(type="cancel", client_order_id="q4", orig_client_order_id="q1")
+
+        new, replaced, cancelled, rejected = self.reports()
+        self.assertEqual(replaced["status"], "replaced")
+        self.assertEqual(replaced["volume_change"], -5)
+        self.assertEqual((replaced["price"], replaced["volume"]), (91, 5))
+        self.assertFalse(replaced["priority_kept"])
+        self.assertEqual(cancelled["status"], "cancelled")
+        self.assertIn("terminated after 0/5", cancelled["log"])
+        self.assertEqual(rejected["status"], "rejected")
+        self.assertEqual(
+            await self.engine.query("AAPL", OrderBook.get_depth, "AAPL", BUY), []
+        )
+
+    # Test that a filled order is forgotten, and too late to cancel or replace
+    async def test_filled_order(self):
+        await self.send(
+            type="new",
+            client_order_id="q1",
+            ticker="AAPL",
+            side="sell",
+            price=100,
+            volume=5,
+        )
+        (acknowledged,) = self.reports()
+        await self.engine.place_order("AAPL", BUY, 100, 5, self.other)
+        await asyncio.sleep(0)
+        (fill,) = self.reports()
+        self.assertEqual((fill["volume"], fill["volume_left"]), (5, 0))
+        self.assertEqual(self.session._order_ids, {})
+        self.assertEqual(self.session._client_order_ids, {})
+
+        order_id = acknowledged["order_id"]
+        await self.send(type="cancel", client_order_id="q2", order_id=order_id)
+        await self.send(
+            type="replace", client_order_id="q3", order_id=order_id, price=1, volume=1
+        )
+        await self.send(type="cancel", client_order_id="q4", orig_client_order_id="q1")
+        reports = self.reports()
+        self.assertEqual([report["status"] for report in reports], ["rejected"] * 3)
+        self.assertIn("already terminated", reports[0]["error"])
+        self.assertIn("already terminated", reports[1]["error"])
+
+    # Test that orders cancelled by self-trade prevention or for lack of funds are forgotten
+    async def test_orders_cancelled_by_the_books(self):
+        async def new(client_order_id, side):
+            await self.send(
+                type="new",
+                client_order_id=client_order_id,
+                ticker="AAPL",
+                side=side,
+                price=100,
+                volume=5,
+            )
+            await asyncio.sleep(0)
+            return list(self.session._order_ids)
+
+        self.addCleanup(
+            OrderBook.set_self_trade_prevention, OrderBook.self_trade_prevention
+        )
+        await new("q1", "sell")
+        OrderBook.set_self_trade_prevention(SelfTradePrevention.CANCEL_NEWEST)
+        self.assertEqual(await new("q2", "buy"), ["q1"])
+        OrderBook.set_self_trade_prevention(SelfTradePrevention.CANCEL_OLDEST)
+        self.assertEqual(await new("q3", "buy"), ["q3"])
+
+        def spend_everything():
+            self.trader.balance = 0
+            self.trader._purge_unfunded()
+
+        await self.engine.run(spend_everything)
+        await asyncio.sleep(0)
+        self.assertEqual(self.session._order_ids, {})
+        self.assertEqual(self.session._client_order_ids, {})
+        statuses = [report["status"] for report in self.reports()]
+        self.assertEqual(statuses, ["new"] * 3)
+
+    # Test that invalid instructions are rejected without reaching the books
+    async def test_rejected(self):
+        foreign = await self.engine.place_order("AAPL", BUY, 90, 1, self.other)
+        await self.session.handle("not json")
+        await self.send(type="new", client_order_id="q1", ticker="AAPL", side="up")
+        await self.send(type="cancel", client_order_id="q2", order_id=foreign)
+        await self.send(
+            type="new",
+            client_order_id="q3",
+            ticker="NONE",
+            side="buy",
+            price=1,
+            volume=1,
+        )
+        await self.send(type="new", ticker="AAPL", side="buy", price=1, volume=1)
+
+        reports = self.reports()
+        self.assertEqual([report["status"] for report in reports], ["rejected"] * 5)
+        self.assertEqual(
+            [report["client_order_id"] for report in reports],
+            [None, "q1", "q2", "q3", None],
+        )
+        self.assertIn("Missing client_order_id", reports[4]["error"])
+        self.assertIn("does not belong", reports[2]["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
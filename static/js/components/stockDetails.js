@@ -214,9 +214,18 @@ const primarySocketAddress = "ws://localhost:8000/ws";
 const fallbackSocketAddress = "ws://mtomecki.pl:8000/ws";
 let socket = new WebSocket(primarySocketAddress);
 const stockDataDynamic = {};
+const orderBookDepth = 20; // price levels shown on each side of the order book
+
+// Only get the stocks shown on the page, with their best levels aggregated by price
+function subscribeToOrderBooks(socket) {
+  ['AAPL', 'GOOG', 'TSLA'].forEach(ticker => {
+    socket.send(JSON.stringify({ type: "subscribe", ticker: ticker, depth: orderBookDepth }));
+  });
+}
 
 socket.addEventListener("open", () => {
   console.log(`Connected to OrderBook WebSocket`);
+  subscribeToOrderBooks(socket);
 });
 
 socket.addEventListener("error", (error) => {
@@ -228,6 +237,7 @@ socket.addEventListener("error", (error) => {
 
     socket.addEventListener("open", () => {
       console.log(`Connected to OrderBook WebSocket`);
+      subscribeToOrderBooks(socket);
   });
     socket.addEventListener("error", (error) => {
     console.error(`Failed to connect to ${fallbackSocketAddress}:`, error);
@@ -240,6 +250,7 @@ socket.addEventListener("message", event => {
   let tickers = ['AAPL', 'GOOG', 'TSLA'];
   console.log("Data from OrderBook socket", data);
   tickers.forEach(ticker => {
+    if (!(ticker in data)) return; // not subscribed to yet
     stockDataDynamic[ticker] = data[ticker];
 
     // Append to historic prices if timestamp is new